@@ -0,0 +1,197 @@
+"""
+Local stand-ins for an OAI-PMH endpoint and a dataset file-listing API,
+serving a synthetic corpus for the harvest benchmark.
+
+The corpus is fully determined by its size and seed: record `i` is
+"doi:10.5072/bench-<seed>-<i>", datestamps are spread evenly over
+`days` days before 2024-01-01, and dataset `i` lists between 1 and
+2 * files_per_dataset - 1 files.
+"""
+import hashlib
+import json
+import multiprocessing
+import time
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse, unquote
+
+import requests
+
+OAI_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>'
+              '<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">'
+              '<responseDate>2024-01-01T00:00:00Z</responseDate>')
+LAST_DAY = date(2024, 1, 1)
+
+
+class Corpus:
+    def __init__(self, size, seed=0, days=365, files_per_dataset=10):
+        self.size = size
+        self.seed = seed
+        self.days = days
+        self.files_per_dataset = files_per_dataset
+
+    def pid(self, i):
+        return f"doi:10.5072/bench-{self.seed}-{i}"
+
+    def index(self, pid):
+        return int(pid.rsplit("-", 1)[1])
+
+    def day(self, i):
+        return LAST_DAY - timedelta(days=self.days - 1 - i * self.days // self.size)
+
+    def between(self, low, high):
+        """
+        Indexes of the records with low <= datestamp <= high.
+        """
+        if not hasattr(self, "_days"):
+            self._days = [self.day(i) for i in range(self.size)]
+        return range(bisect_left(self._days, low), bisect_right(self._days, high))
+
+    def file_count(self, i):
+        digest = hashlib.sha256(f"{self.seed}:{i}".encode()).digest()
+        return 1 + digest[0] % (2 * self.files_per_dataset - 1)
+
+    def files(self, i):
+        dataset_pid = self.pid(i)[len("doi:"):]
+        return [
+            {
+                "name": f"file-{n}.csv",
+                "dataset_pid": dataset_pid,
+                "link": f"https://example.org/{dataset_pid}/file-{n}.csv",
+                "size": str(1024 * (n + 1)),
+                "mime_type": "text/csv",
+                "ext": "csv",
+                "checksum_value": hashlib.md5(f"{dataset_pid}/{n}".encode()).hexdigest(),
+                "checksum_type": "MD5",
+                "access_request": False,
+                "publication_date": self.day(i).isoformat(),
+                "embargo": None,
+                "file_pid": f"{dataset_pid}/F{n}",
+            }
+            for n in range(self.file_count(i))
+        ]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    corpus = None
+    page_size = 100
+    latency = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body, content_type):
+        body = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        if url.path == "/oai":
+            self._send(self._oai(parse_qs(url.query)), "text/xml")
+        elif url.path.startswith("/datasets/"):
+            i = self.corpus.index(unquote(url.path[len("/datasets/"):]))
+            self._send(json.dumps({"files": self.corpus.files(i)}), "application/json")
+        else:
+            self.send_error(404)
+
+    def _oai(self, query):
+        verb = query.get("verb", [""])[0]
+        if verb == "Identify":
+            return (OAI_HEADER + "<Identify><repositoryName>bench</repositoryName>"
+                    f"<earliestDatestamp>{self.corpus.day(0).isoformat()}</earliestDatestamp>"
+                    "<granularity>YYYY-MM-DD</granularity></Identify></OAI-PMH>")
+        if verb == "ListMetadataFormats":
+            return (OAI_HEADER + "<ListMetadataFormats><metadataFormat>"
+                    "<metadataPrefix>oai_dc</metadataPrefix></metadataFormat>"
+                    "</ListMetadataFormats></OAI-PMH>")
+        if verb == "ListSets":
+            return OAI_HEADER + '<error code="noSetHierarchy"/></OAI-PMH>'
+        if verb == "ListIdentifiers":
+            return self._list_identifiers(query)
+        return OAI_HEADER + '<error code="badVerb"/></OAI-PMH>'
+
+    def _list_identifiers(self, query):
+        if "resumptionToken" in query:
+            start, from_date, until_date = query["resumptionToken"][0].split("|")
+            start = int(start)
+        else:
+            start = 0
+            from_date = query.get("from", [""])[0][:10]
+            until_date = query.get("until", [""])[0][:10]
+        low = date.fromisoformat(from_date) if from_date else date.min
+        high = date.fromisoformat(until_date) if until_date else date.max
+        matching = self.corpus.between(low, high)
+        if not matching:
+            return OAI_HEADER + '<error code="noRecordsMatch"/></OAI-PMH>'
+        page = matching[start:start + self.page_size]
+        headers = "".join(
+            f"<header><identifier>{self.corpus.pid(i)}</identifier>"
+            f"<datestamp>{self.corpus.day(i).isoformat()}</datestamp></header>"
+            for i in page
+        )
+        end = start + self.page_size
+        token = f"{end}|{from_date}|{until_date}" if end < len(matching) else ""
+        return (OAI_HEADER + f"<ListIdentifiers>{headers}"
+                f'<resumptionToken completeListSize="{len(matching)}">{token}</resumptionToken>'
+                "</ListIdentifiers></OAI-PMH>")
+
+
+def _serve(port, corpus, page_size, latency):
+    handler = type("Handler", (_Handler,), {
+        "corpus": corpus, "page_size": page_size, "latency": latency,
+    })
+    ThreadingHTTPServer(("127.0.0.1", port), handler).serve_forever()
+
+
+def start_servers(corpus, port, page_size=100, latency=0.0):
+    """
+    Serve the corpus from a separate process (so it does not count towards
+    the benchmark's CPU and memory) and wait until it answers.
+
+    Returns:
+        multiprocessing.Process: call terminate() to stop the servers
+    """
+    process = multiprocessing.Process(target=_serve, args=(port, corpus, page_size, latency),
+                                      daemon=True)
+    process.start()
+    for _ in range(100):
+        try:
+            requests.get(f"http://127.0.0.1:{port}/oai?verb=Identify", timeout=1)
+            return process
+        except requests.ConnectionError:
+            time.sleep(0.05)
+    process.terminate()
+    raise RuntimeError(f"Fake servers did not start on port {port}")
+
+
+class FakeFileFetcher:
+    """
+    Stand-in for the filefetcher module that reads the fake file-listing
+    API. Both calls request the same listing URL; file_records returns
+    the dates parsed, as the normalized records carry them.
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def _listing(self, pid):
+        response = requests.get(f"{self.base_url}/datasets/doi:{pid}", timeout=60)
+        response.raise_for_status()
+        return response.json()
+
+    def file_raw_records(self, pid):
+        return self._listing(pid)
+
+    def file_records(self, pid):
+        files = self._listing(pid)["files"]
+        for f in files:
+            for field in ("publication_date", "embargo"):
+                if f[field]:
+                    f[field] = datetime.fromisoformat(f[field]).replace(tzinfo=timezone.utc)
+        return files
@@ -0,0 +1,233 @@
+"""
+End-to-end harvest benchmark against local stand-ins.
+
+Starts a fake OAI-PMH endpoint and a fake file-listing API (see
+fake_servers.py) serving a synthetic corpus, then runs fetch_pids and
+process_pending_pids against the Postgres database of config/config.toml
+and writes the measurements as JSON.
+
+    PYTHONPATH=src python benchmarks/harvest_benchmark.py --datasets 2000 \\
+        --latency 0.02 --fetch-concurrency 8 --output bench.json
+
+The benchmark only touches rows of its own synthetic corpus: the
+endpoint "bench-<seed>" and datasets "10.5072/bench-<seed>-*". They are
+removed before the run and, unless --keep is given, after it.
+"""
+import argparse
+import functools
+import json
+import resource
+import subprocess
+import sys
+import threading
+from collections import defaultdict
+from time import perf_counter
+
+import psycopg
+from sqlalchemy import event, text
+
+from fake_servers import Corpus, FakeFileFetcher, start_servers
+
+
+class Recorder:
+    """
+    Collects per-stage latencies and counts database round trips.
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.round_trips = 0
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.latencies[stage].append(seconds)
+
+    def count_round_trip(self):
+        with self._lock:
+            self.round_trips += 1
+
+    def timed(self, stage, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, perf_counter() - start)
+        return wrapper
+
+    def timed_pages(self, stage, func):
+        # times every page of a generator, i.e. the request plus its parsing
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            pages = func(*args, **kwargs)
+            while True:
+                start = perf_counter()
+                try:
+                    page = next(pages)
+                except StopIteration:
+                    return
+                self.add(stage, perf_counter() - start)
+                yield page
+        return wrapper
+
+    def cursor_factory(self):
+        recorder = self
+
+        class CountingCursor(psycopg.Cursor):
+            def execute(self, *args, **kwargs):
+                recorder.count_round_trip()
+                return super().execute(*args, **kwargs)
+
+            def executemany(self, *args, **kwargs):
+                recorder.count_round_trip()
+                return super().executemany(*args, **kwargs)
+
+            def copy(self, *args, **kwargs):
+                recorder.count_round_trip()
+                return super().copy(*args, **kwargs)
+
+        return CountingCursor
+
+    def percentiles(self):
+        result = {}
+        for stage, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+            result[stage] = {
+                "count": len(values),
+                "total_s": sum(values),
+                "p50_ms": pick(0.50) * 1000,
+                "p90_ms": pick(0.90) * 1000,
+                "p99_ms": pick(0.99) * 1000,
+                "max_ms": values[-1] * 1000,
+            }
+        return result
+
+
+def instrument(recorder, tasks):
+    from filemeta_harvester.oai.harvester import OAIHarvester
+    from filemeta_harvester.db.pidstore import PIDStore
+    from filemeta_harvester.db.filestore import FileRecordStore, FileRawRecordStore
+
+    OAIHarvester.get_pid_pages = recorder.timed_pages("oai_page", OAIHarvester.get_pid_pages)
+    tasks._fetch_dataset = recorder.timed("fetch", tasks._fetch_dataset)
+    tasks._build_records = recorder.timed("transform", tasks._build_records)
+    PIDStore.save_pid_page = recorder.timed("db_save_pids", PIDStore.save_pid_page)
+    PIDStore.claim_pids = recorder.timed("db_claim", PIDStore.claim_pids)
+    PIDStore.set_statuses = recorder.timed("db_status", PIDStore.set_statuses)
+    FileRawRecordStore.upsert_many = recorder.timed("db_write_raw", FileRawRecordStore.upsert_many)
+    FileRecordStore.sync_datasets = recorder.timed("db_write_files", FileRecordStore.sync_datasets)
+
+
+def cleanup(engine, endpoint_id, seed):
+    prefix = f"10.5072/bench-{seed}-%"
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM harvest_pids WHERE endpoint_id = :e"), {"e": endpoint_id})
+        conn.execute(text("DELETE FROM harvest_checkpoints WHERE endpoint_id = :e"),
+                     {"e": endpoint_id})
+        conn.execute(text("DELETE FROM harvest_runs WHERE endpoint_id = :e"), {"e": endpoint_id})
+        conn.execute(text("DELETE FROM harvest_state WHERE endpoint_id = :e"), {"e": endpoint_id})
+        conn.execute(text("DELETE FROM harvest_datasets WHERE dataset_pid LIKE :p"), {"p": prefix})
+        conn.execute(text("DELETE FROM file_metadata WHERE dataset_pid LIKE :p"), {"p": prefix})
+        conn.execute(text("""
+            DELETE FROM raw_metadata_blobs WHERE content_hash IN (
+                SELECT content_hash FROM file_raw_metadata WHERE dataset_pid LIKE :p)
+        """), {"p": prefix})
+        conn.execute(text("DELETE FROM file_raw_metadata WHERE dataset_pid LIKE :p"),
+                     {"p": prefix})
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--datasets", type=int, default=1000, help="corpus size")
+    parser.add_argument("--files-per-dataset", type=int, default=10, help="mean files per dataset")
+    parser.add_argument("--page-size", type=int, default=100, help="OAI-PMH page size")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds added to every fake server response")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--fetch-concurrency", type=int, default=4)
+    parser.add_argument("--write-batch-size", type=int, default=50)
+    parser.add_argument("--harvest-parallelism", type=int, default=1)
+    parser.add_argument("--output", help="JSON result file (default: stdout)")
+    parser.add_argument("--keep", action="store_true", help="keep the benchmark rows")
+    args = parser.parse_args(argv)
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    corpus = Corpus(args.datasets, seed=args.seed, files_per_dataset=args.files_per_dataset)
+    servers = start_servers(corpus, args.port, page_size=args.page_size, latency=args.latency)
+
+    # the fake file-listing API replaces the real filefetcher
+    fetcher = FakeFileFetcher(base_url)
+    sys.modules["filefetcher"] = fetcher
+    from filemeta_harvester.config import HarvestConfig, PipelineConfig
+    from filemeta_harvester.db.connection import get_engine
+    from filemeta_harvester.tasks import harvester_tasks as tasks
+    tasks.filefetcher = fetcher
+
+    recorder = Recorder()
+    engine = get_engine()
+    endpoint_id = f"bench-{args.seed}"
+    try:
+        tasks.initialize_db()
+        tasks.initialize_file_db()
+        cleanup(engine, endpoint_id, args.seed)
+        engine.dispose()
+        event.listen(engine, "connect", lambda dbapi_conn, _: setattr(
+            dbapi_conn, "cursor_factory", recorder.cursor_factory()))
+        instrument(recorder, tasks)
+
+        result = {"commit": git_commit(), "params": vars(args)}
+
+        start, trips = perf_counter(), recorder.round_trips
+        pids = tasks.fetch_pids(f"{base_url}/oai", endpoint_id, "benchmark", "oai_dc",
+                                HarvestConfig(parallelism=args.harvest_parallelism))
+        seconds = perf_counter() - start
+        result["fetch_pids"] = {
+            "seconds": seconds,
+            "pids": pids,
+            "pids_per_s": pids / seconds,
+            "db_round_trips": recorder.round_trips - trips,
+        }
+
+        start, trips = perf_counter(), recorder.round_trips
+        counts = tasks.process_pending_pids(endpoint_id, PipelineConfig(
+            fetch_concurrency=args.fetch_concurrency,
+            write_batch_size=args.write_batch_size,
+        ))
+        seconds = perf_counter() - start
+        files = sum(corpus.file_count(i) for i in range(corpus.size))
+        result["process_pending_pids"] = {
+            "seconds": seconds,
+            **counts,
+            "pids_per_s": counts["done"] / seconds,
+            "files_per_s": files / seconds,
+            "db_round_trips": recorder.round_trips - trips,
+        }
+        result["stages"] = recorder.percentiles()
+        result["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        if not args.keep:
+            cleanup(engine, endpoint_id, args.seed)
+        servers.terminate()
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,88 @@ class DatabaseConfig:
     user: str
     password: str
     name: str
+    pool_size: int = 5
+    max_overflow: int = 5
+    statement_timeout_ms: int = 0
+    prepare_threshold: int = 5
+
+
+@dataclass(frozen=True)
+class CacheConfig:
+    directory: str | None = None
+    max_bytes: int = 512 * 1024 * 1024
+
+
+@dataclass(frozen=True)
+class StorageConfig:
+    # "jsonb" keeps raw payloads in file_raw_metadata.raw_metadata, "blob"
+    # compressed and deduplicated in raw_metadata_blobs
+    raw_metadata: str = "jsonb"
+    # partition harvest_pids by endpoint (see PIDStore.partition_by_endpoint)
+    partition_harvest_pids: bool = False
+    # hash partitions of file_metadata by dataset_pid; 0 keeps one table
+    file_metadata_partitions: int = 0
+
+
+@dataclass(frozen=True)
+class MetricsConfig:
+    # 0 disables the Prometheus endpoint
+    port: int = 0
+    profile_dir: str | None = None
+    profile_interval: float = 0.01
+
+
+@dataclass(frozen=True)
+class SchedulerConfig:
+    # endpoints harvested at the same time
+    workers: int = 4
+    # harvests at the same time against one OAI-PMH host
+    max_per_host: int = 1
+    min_interval: int = 300
+    max_interval: int = 24 * 3600
+    # fraction of the interval by which each next run is randomly shifted
+    jitter: float = 0.1
+
+
+@dataclass(frozen=True)
+class ScheduleConfig:
+    # seconds until the first re-harvest; adapted to the change rate afterwards
+    poll_interval: int = 3600
+    # among due endpoints, higher priorities start first
+    priority: int = 0
+
+
+@dataclass(frozen=True)
+class HarvestConfig:
+    parallelism: int = 1
+    windows: int = 1
+    # True harvests every set of the endpoint, a list only those sets
+    sets: bool | tuple[str, ...] = False
+    # with sets = True, whether every record is in at least one set; if not,
+    # the whole repository is listed next to the sets
+    sets_cover_repository: bool = False
+    # seconds the metadata formats and Identify answer of an endpoint are
+    # reused before it is probed again
+    probe_ttl: int = 24 * 3600
+
+
+@dataclass(frozen=True)
+class PipelineConfig:
+    fetch_concurrency: int = 4
+    queue_size: int = 100
+    write_batch_size: int = 50
+    lease_seconds: int = 900
+    # failed PIDs are retried with exponential backoff up to max_attempts
+    max_attempts: int = 8
+    retry_base_delay: int = 60
+    retry_max_delay: int = 6 * 3600
+    # "auto" loads in bulk (db.bulkload.InitialLoad) until a PID of the
+    # endpoint is done, true/false force or disable it
+    initial_load: bool | str = "auto"
+    initial_load_merge_rows: int = 50000
+    # drop file_metadata's secondary indexes during an initial load; only
+    # safe when no other process writes or reads the tables meanwhile
+    initial_load_defer_indexes: bool = False
 
 
 def load_config(path: Path | None = None) -> DatabaseConfig:
@@ -25,6 +107,84 @@ def load_config(path: Path | None = None) -> DatabaseConfig:
         user=db["user"],
         password=db["password"],
         name=db["name"],
+        pool_size=db.get("pool_size", DatabaseConfig.pool_size),
+        max_overflow=db.get("max_overflow", DatabaseConfig.max_overflow),
+        statement_timeout_ms=db.get("statement_timeout_ms", DatabaseConfig.statement_timeout_ms),
+        prepare_threshold=db.get("prepare_threshold", DatabaseConfig.prepare_threshold),
+    )
+
+def load_cache_config(path: Path | None = None) -> CacheConfig:
+    """
+    Read the optional [cache] section of config.toml. Without a `directory`
+    responses are only shared within the fetch of one dataset.
+    """
+    path = path or Path(__file__).parent.parent.parent / "config/config.toml"
+
+    with path.open("rb") as f:
+        data = tomllib.load(f)
+
+    cache = data.get("cache", {})
+    return CacheConfig(
+        directory=cache.get("directory") or None,
+        max_bytes=cache.get("max_bytes", CacheConfig.max_bytes),
+    )
+
+def load_storage_config(path: Path | None = None) -> StorageConfig:
+    """
+    Read the optional [storage] section of config.toml.
+    """
+    path = path or Path(__file__).parent.parent.parent / "config/config.toml"
+
+    with path.open("rb") as f:
+        data = tomllib.load(f)
+
+    storage = data.get("storage", {})
+    raw_metadata = storage.get("raw_metadata", StorageConfig.raw_metadata)
+    if raw_metadata not in ("jsonb", "blob"):
+        raise ValueError(f"[storage] raw_metadata must be 'jsonb' or 'blob', not '{raw_metadata}'")
+    partitions = storage.get("file_metadata_partitions", StorageConfig.file_metadata_partitions)
+    if partitions < 0:
+        raise ValueError("[storage] file_metadata_partitions must not be negative")
+    return StorageConfig(
+        raw_metadata=raw_metadata,
+        partition_harvest_pids=storage.get("partition_harvest_pids",
+                                           StorageConfig.partition_harvest_pids),
+        file_metadata_partitions=partitions,
+    )
+
+def load_metrics_config(path: Path | None = None) -> MetricsConfig:
+    """
+    Read the optional [metrics] section of config.toml. Without a
+    `profile_dir` harvest runs are not profiled.
+    """
+    path = path or Path(__file__).parent.parent.parent / "config/config.toml"
+
+    with path.open("rb") as f:
+        data = tomllib.load(f)
+
+    metrics = data.get("metrics", {})
+    return MetricsConfig(
+        port=metrics.get("port", MetricsConfig.port),
+        profile_dir=metrics.get("profile_dir") or None,
+        profile_interval=metrics.get("profile_interval", MetricsConfig.profile_interval),
+    )
+
+def load_scheduler_config(path: Path | None = None) -> SchedulerConfig:
+    """
+    Read the optional [scheduler] section of config.toml.
+    """
+    path = path or Path(__file__).parent.parent.parent / "config/config.toml"
+
+    with path.open("rb") as f:
+        data = tomllib.load(f)
+
+    scheduler = data.get("scheduler", {})
+    return SchedulerConfig(
+        workers=scheduler.get("workers", SchedulerConfig.workers),
+        max_per_host=scheduler.get("max_per_host", SchedulerConfig.max_per_host),
+        min_interval=scheduler.get("min_interval", SchedulerConfig.min_interval),
+        max_interval=scheduler.get("max_interval", SchedulerConfig.max_interval),
+        jitter=scheduler.get("jitter", SchedulerConfig.jitter),
     )
 
 def load_endpoints_config(path: Path | None = None) -> list[dict]:
@@ -35,3 +195,49 @@ def load_endpoints_config(path: Path | None = None) -> list[dict]:
 
     return data["endpoints"]
 
+
+def load_pipeline_config(endpoint: dict) -> PipelineConfig:
+    """
+    Read the per-endpoint pipeline settings from an `[[endpoints]]` entry,
+    falling back to the PipelineConfig defaults.
+    """
+    defaults = PipelineConfig()
+    return PipelineConfig(
+        fetch_concurrency=endpoint.get("fetch_concurrency", defaults.fetch_concurrency),
+        queue_size=endpoint.get("queue_size", defaults.queue_size),
+        write_batch_size=endpoint.get("write_batch_size", defaults.write_batch_size),
+        lease_seconds=endpoint.get("lease_seconds", defaults.lease_seconds),
+        max_attempts=endpoint.get("max_attempts", defaults.max_attempts),
+        retry_base_delay=endpoint.get("retry_base_delay", defaults.retry_base_delay),
+        retry_max_delay=endpoint.get("retry_max_delay", defaults.retry_max_delay),
+        initial_load=endpoint.get("initial_load", defaults.initial_load),
+        initial_load_merge_rows=endpoint.get("initial_load_merge_rows",
+                                             defaults.initial_load_merge_rows),
+        initial_load_defer_indexes=endpoint.get("initial_load_defer_indexes",
+                                                defaults.initial_load_defer_indexes),
+    )
+
+def load_harvest_config(endpoint: dict) -> HarvestConfig:
+    """
+    Read the per-endpoint PID harvest settings from an `[[endpoints]]` entry.
+    `harvest_windows` defaults to `harvest_parallelism`.
+    """
+    parallelism = endpoint.get("harvest_parallelism", HarvestConfig.parallelism)
+    sets = endpoint.get("harvest_sets", HarvestConfig.sets)
+    return HarvestConfig(
+        parallelism=parallelism,
+        windows=endpoint.get("harvest_windows", parallelism),
+        sets=tuple(sets) if isinstance(sets, list) else sets,
+        sets_cover_repository=endpoint.get("harvest_sets_cover_repository",
+                                           HarvestConfig.sets_cover_repository),
+        probe_ttl=endpoint.get("probe_ttl", HarvestConfig.probe_ttl),
+    )
+
+def load_schedule_config(endpoint: dict) -> ScheduleConfig:
+    """
+    Read the per-endpoint scheduling settings from an `[[endpoints]]` entry.
+    """
+    return ScheduleConfig(
+        poll_interval=endpoint.get("poll_interval", ScheduleConfig.poll_interval),
+        priority=endpoint.get("priority", ScheduleConfig.priority),
+    )
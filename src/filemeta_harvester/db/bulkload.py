@@ -0,0 +1,277 @@
+import uuid
+from psycopg.types.json import Jsonb
+from filemeta_harvester.db.filestore import (FILE_KEY, FILE_VALUES, FileRawRecord, FileRecord,
+                                             content_hash, file_fingerprint)
+
+DEFAULT_MERGE_ROWS = 50000
+# advisory lock held by every initial load for its whole run: shared by
+# loads that keep the indexes, exclusively by the one that drops them
+INITIAL_LOAD_LOCK_KEY = 0x66696c656c6f6164
+
+_FILE_COLUMNS = FILE_KEY + FILE_VALUES + ("fingerprint",)
+
+
+class InitialLoad:
+    """
+    Bulk ingest mode for the first harvest of an endpoint.
+
+    Instead of upserting each batch into file_metadata and
+    file_raw_metadata, `add` streams the rows with COPY into two UNLOGGED
+    staging tables of this load. `merge` moves them into the real tables
+    with one INSERT ... SELECT ... ON CONFLICT per table, after which file
+    rows no longer listed for the merged datasets are deleted. Call it
+    whenever `add` reports that enough rows are staged and before exiting:
+    rows still staged on exit are dropped.
+
+    With `defer_indexes` the secondary indexes of both tables (everything
+    but the primary keys and the unique constraints the merge relies on)
+    are dropped on entry and built once on exit. Only enable it when the
+    harvester is the tables' only writer, e.g. for a one-off load of a
+    fresh database: other processes would write and read without the
+    indexes until the load ends. Loads coordinate through a session-level
+    advisory lock on their connection, held from entry to exit since a
+    load spans many transactions: a deferring load takes it exclusively
+    and drops the indexes only if no other load is running (otherwise it
+    keeps them), and the other loads wait for it to rebuild them.
+
+    Use as a context manager; it holds one connection from the engine's
+    pool until it exits. A RecordCache passed as `cache` is invalidated for
+    the datasets of each merge. With a RawBlobStore as `blobs`, raw payloads
+    are written to it (see FileRawRecordStore's compact mode).
+    """
+
+    def __init__(self, engine, merge_rows: int = DEFAULT_MERGE_ROWS,
+                 defer_indexes: bool = False, cache=None, blobs=None):
+        self.engine = engine
+        self.cache = cache
+        self.blobs = blobs
+        self.merge_rows = merge_rows
+        self.defer_indexes = defer_indexes
+        suffix = uuid.uuid4().hex[:8]
+        self.files_staging = f"file_metadata_load_{suffix}"
+        self.raw_staging = f"file_raw_metadata_load_{suffix}"
+        self.staged_rows = 0
+        self.staged_pids = []
+        self.staged_datasets = set()
+        self.conn = None
+
+    def __enter__(self):
+        self.conn = self.engine.connect()
+        try:
+            self._lock()
+            self._create_staging()
+        except BaseException:
+            self._unlock()
+            raise
+        return self
+
+    def _lock(self):
+        with self.conn.begin(), self._cursor() as cur:
+            if self.defer_indexes:
+                cur.execute("SELECT pg_try_advisory_lock(%s)", (INITIAL_LOAD_LOCK_KEY,))
+                self.defer_indexes = cur.fetchone()[0]
+                if not self.defer_indexes:
+                    print("Another initial load is running: keeping the file metadata indexes")
+            if not self.defer_indexes:
+                # waits for a deferring load to finish, however long it takes
+                cur.execute("SET LOCAL statement_timeout = 0")
+                cur.execute("SELECT pg_advisory_lock_shared(%s)", (INITIAL_LOAD_LOCK_KEY,))
+
+    def _unlock(self):
+        # session-level locks outlive transactions and would stay with the
+        # pooled connection; closes it when the unlock itself fails
+        try:
+            with self.conn.begin(), self._cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock_shared(%s)" if not self.defer_indexes
+                            else "SELECT pg_advisory_unlock(%s)", (INITIAL_LOAD_LOCK_KEY,))
+        except Exception:
+            self.conn.invalidate()
+            raise
+        finally:
+            self.conn.close()
+
+    def _create_staging(self):
+        with self.conn.begin(), self._cursor() as cur:
+            cur.execute(f"""
+                CREATE UNLOGGED TABLE {self.files_staging} (
+                    seq BIGINT GENERATED ALWAYS AS IDENTITY,
+                    dataset_pid TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    link TEXT NOT NULL,
+                    size BIGINT,
+                    mime_type TEXT,
+                    ext TEXT,
+                    checksum_value TEXT,
+                    checksum_type TEXT,
+                    access_request BOOLEAN,
+                    publication_date TIMESTAMP,
+                    embargo TIMESTAMP,
+                    file_pid TEXT,
+                    fingerprint TEXT
+                )
+            """)
+            cur.execute(f"""
+                CREATE UNLOGGED TABLE {self.raw_staging} (
+                    seq BIGINT GENERATED ALWAYS AS IDENTITY,
+                    dataset_pid TEXT NOT NULL,
+                    raw_metadata JSONB,
+                    content_hash TEXT
+                )
+            """)
+            if self.defer_indexes:
+                for index in self._deferrable_indexes():
+                    cur.execute(f"DROP INDEX IF EXISTS {index.name}")
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            with self.conn.begin():
+                if self.defer_indexes:
+                    print("Building the deferred file metadata indexes")
+                    with self._cursor() as cur:
+                        # builds over the whole tables take longer than
+                        # the configured statement_timeout allows
+                        cur.execute("SET LOCAL statement_timeout = 0")
+                    for index in self._deferrable_indexes():
+                        index.create(self.conn, checkfirst=True)
+                with self._cursor() as cur:
+                    cur.execute(f"DROP TABLE IF EXISTS {self.files_staging}, {self.raw_staging}")
+                    if self.defer_indexes:
+                        cur.execute("ANALYZE file_metadata")
+                        cur.execute("ANALYZE file_raw_metadata")
+        finally:
+            self._unlock()
+
+    def add(self, datasets):
+        """
+        Stage datasets with COPY, in a transaction of their own: when it
+        fails, e.g. on a malformed value, only these datasets are rolled
+        back and the exception is re-raised.
+        datasets = [(pid, (FileRawRecord, [FileRecord or FileRow, ...])), ...]
+
+        Returns:
+            bool: whether enough rows are staged to `merge`
+        """
+        rows = 0
+        raws = [(raw.dataset_pid, raw.raw_metadata,
+                 raw.content_hash or content_hash(raw.raw_metadata))
+                for _, (raw, _) in datasets]
+        with self.conn.begin():
+            if self.blobs is not None:
+                self.blobs.save_many({digest: raw_metadata for _, raw_metadata, digest in raws},
+                                     connection=self.conn)
+            with self._cursor() as cur:
+                with cur.copy(f"""
+                    COPY {self.raw_staging} (dataset_pid, raw_metadata, content_hash) FROM STDIN
+                """) as copy:
+                    for dataset_pid, raw_metadata, digest in raws:
+                        copy.write_row((dataset_pid, None if self.blobs is not None
+                                        else Jsonb(raw_metadata), digest))
+                with cur.copy(f"""
+                    COPY {self.files_staging} ({", ".join(_FILE_COLUMNS)}) FROM STDIN
+                """) as copy:
+                    for _, (_, files) in datasets:
+                        for record in files:
+                            row = {c: getattr(record, c) for c in FILE_KEY + FILE_VALUES}
+                            row["fingerprint"] = file_fingerprint(row)
+                            copy.write_row([row[c] for c in _FILE_COLUMNS])
+                            rows += 1
+        self.staged_rows += rows
+        self.staged_pids.extend(pid for pid, _ in datasets)
+        self.staged_datasets.update(raw.dataset_pid for _, (raw, _) in datasets)
+        return self.staged_rows >= self.merge_rows
+
+    def merge(self, before_commit=None):
+        """
+        Merge the staged rows into the real tables and empty the staging
+        tables, in one transaction. `before_commit(connection)` is called
+        inside it, e.g. to record the merged PIDs as done.
+
+        Returns:
+            Dict: {"inserted": int, "updated": int, "deleted": int} file rows
+        """
+        counts = {"inserted": 0, "updated": 0, "deleted": 0}
+        if not self.staged_pids:
+            return counts
+        values = ", ".join(f"{c} = EXCLUDED.{c}" for c in FILE_VALUES + ("fingerprint",))
+        with self.conn.begin():
+            with self._cursor() as cur:
+                if self.blobs is not None:
+                    # `add` saved the blobs in earlier transactions, so
+                    # touch them again in this one, the one that refers
+                    # to them; one pruned since cannot be merged
+                    cur.execute(f"SELECT DISTINCT content_hash FROM {self.raw_staging}")
+                    staged = {row[0] for row in cur.fetchall()}
+                    missing = staged - self.blobs.touch(staged, self.conn)
+                    if missing:
+                        raise RuntimeError(f"{len(missing)} staged raw payloads were pruned "
+                                           "before the merge")
+                cur.execute(f"""
+                    INSERT INTO file_raw_metadata (dataset_pid, raw_metadata, content_hash)
+                    SELECT DISTINCT ON (dataset_pid) dataset_pid, raw_metadata, content_hash
+                    FROM {self.raw_staging}
+                    ORDER BY dataset_pid, seq DESC
+                    ON CONFLICT ON CONSTRAINT uq_file_raw_record DO UPDATE
+                    SET raw_metadata = EXCLUDED.raw_metadata,
+                        content_hash = EXCLUDED.content_hash,
+                        last_updated = now()
+                    WHERE file_raw_metadata.content_hash IS DISTINCT FROM EXCLUDED.content_hash
+                """)
+                # the last staged version of a file wins. The join sees the
+                # table as it was before the insert, so rows it finds were
+                # updated (xmax cannot be returned from a partitioned table)
+                cur.execute(f"""
+                    WITH merged AS (
+                        INSERT INTO file_metadata ({", ".join(_FILE_COLUMNS)})
+                        SELECT DISTINCT ON (dataset_pid, name, link) {", ".join(_FILE_COLUMNS)}
+                        FROM {self.files_staging}
+                        ORDER BY dataset_pid, name, link, seq DESC
+                        ON CONFLICT ON CONSTRAINT uq_file_record DO UPDATE
+                        SET {values}, last_updated = now()
+                        WHERE file_metadata.fingerprint IS DISTINCT FROM EXCLUDED.fingerprint
+                        RETURNING dataset_pid, name, link
+                    )
+                    SELECT count(*) FILTER (WHERE f.id IS NULL),
+                           count(*) FILTER (WHERE f.id IS NOT NULL)
+                    FROM merged m
+                    LEFT JOIN file_metadata f
+                      ON f.dataset_pid = m.dataset_pid AND f.name = m.name AND f.link = m.link
+                """)
+                counts["inserted"], counts["updated"] = cur.fetchone()
+                # files no longer listed; found through the uq_file_record index
+                cur.execute(f"""
+                    DELETE FROM file_metadata f
+                    USING (SELECT DISTINCT dataset_pid FROM {self.raw_staging}) d
+                    WHERE f.dataset_pid = d.dataset_pid
+                      AND NOT EXISTS (
+                          SELECT 1 FROM {self.files_staging} s
+                          WHERE s.dataset_pid = f.dataset_pid
+                            AND s.name = f.name AND s.link = f.link
+                      )
+                """)
+                counts["deleted"] = cur.rowcount
+                cur.execute(f"TRUNCATE {self.files_staging}, {self.raw_staging}")
+            if before_commit is not None:
+                before_commit(self.conn)
+        if self.cache is not None:
+            self.cache.invalidate(self.staged_datasets)
+        self.staged_rows = 0
+        self.staged_pids = []
+        self.staged_datasets = set()
+        return counts
+
+    def discard(self):
+        """
+        Drop the staged rows without merging them.
+        """
+        with self.conn.begin(), self._cursor() as cur:
+            cur.execute(f"TRUNCATE {self.files_staging}, {self.raw_staging}")
+        self.staged_rows = 0
+        self.staged_pids = []
+        self.staged_datasets = set()
+
+    def _cursor(self):
+        return self.conn.connection.driver_connection.cursor()
+
+    def _deferrable_indexes(self):
+        for table in (FileRecord.__table__, FileRawRecord.__table__):
+            yield from table.indexes
@@ -0,0 +1,63 @@
+import threading
+from contextlib import contextmanager
+from sqlalchemy import create_engine
+from filemeta_harvester.config import DatabaseConfig, load_config
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def pg_url(db: DatabaseConfig) -> str:
+    return f"postgresql+psycopg://{db.user}:{db.password}@{db.host}:{db.port}/{db.name}"
+
+
+def get_engine(db: DatabaseConfig | None = None):
+    """
+    Return the process-wide pooled engine for a database.
+
+    All stores (PIDStore, FileRecordStore, FileRawRecordStore) share this
+    engine, so connections are opened once per process and reused instead
+    of being set up per call. Pool size, statement timeout and the psycopg
+    prepare threshold come from the [database] section of config.toml.
+    """
+    db = db or load_config()
+    with _engines_lock:
+        engine = _engines.get(db)
+        if engine is None:
+            connect_args = {"prepare_threshold": db.prepare_threshold}
+            if db.statement_timeout_ms:
+                connect_args["options"] = f"-c statement_timeout={db.statement_timeout_ms}"
+            engine = create_engine(
+                pg_url(db),
+                pool_size=db.pool_size,
+                max_overflow=db.max_overflow,
+                pool_pre_ping=True,
+                echo=False,
+                connect_args=connect_args,
+            )
+            _engines[db] = engine
+        return engine
+
+
+@contextmanager
+def pg_connection(engine, connection=None):
+    """
+    Borrow a psycopg connection from the engine's pool for one transaction.
+
+    Commits when the block succeeds, rolls back when it raises, and hands
+    the connection back to the pool in both cases. When `connection` (an
+    open SQLAlchemy Connection) is given, its psycopg connection is used
+    as is and the caller stays in charge of the transaction.
+    """
+    if connection is not None:
+        yield connection.connection.driver_connection
+        return
+    conn = engine.raw_connection()
+    try:
+        yield conn.driver_connection
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
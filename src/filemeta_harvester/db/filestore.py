@@ -1,10 +1,21 @@
+import hashlib
+import json
+from collections import namedtuple
+from contextlib import contextmanager
 from typing import Optional, List
 from sqlmodel import SQLModel, BigInteger, Field, Session, Column, select, create_engine, DateTime, func
 from datetime import datetime, timezone
 from pydantic import field_validator
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import String, UniqueConstraint, any_, bindparam, text
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, insert
+from sqlalchemy.schema import CreateIndex
+from filemeta_harvester.db.connection import pg_connection
+from filemeta_harvester.db.rawblobs import RawBlobStore
+from filemeta_harvester.db.schema import is_partitioned
+
+DEFAULT_UPSERT_CHUNK_SIZE = 1000
+DEFAULT_FETCH_SIZE = 1000
 
 class FileRawRecord(SQLModel, table=True):
     __tablename__ = "file_raw_metadata"
@@ -15,9 +26,12 @@ class FileRawRecord(SQLModel, table=True):
 
     id: Optional[int] = Field(default=None, primary_key=True)
     dataset_pid: str = Field(nullable=False, index=True)
+    # NULL when the payload is kept in raw_metadata_blobs (see rawblobs)
     raw_metadata: str = Field(
-        sa_column=Column(JSONB, nullable=False)
+        sa_column=Column(JSONB(none_as_null=True), nullable=True)
     )
+    # content_hash(raw_metadata); unchanged datasets are not rewritten
+    content_hash: Optional[str] = Field(default=None)
     last_updated: datetime = Field(
         sa_column=Column(
             DateTime(timezone=False),
@@ -68,6 +82,9 @@ class FileRecord(SQLModel, table=True):
         index=True,
     )
 
+    # file_fingerprint() of the stored values, set by bulk_upsert
+    fingerprint: Optional[str] = Field(default=None)
+
     last_updated: datetime = Field(
         sa_column=Column(
             DateTime(timezone=False),
@@ -89,58 +106,374 @@ class FileRecord(SQLModel, table=True):
     @field_validator("size", mode="before")
     @classmethod
     def safe_int(cls, s):
-        if s is None:
+        return to_int(s)
+
+# columns identifying a file; the other columns are its values
+FILE_KEY = ("dataset_pid", "name", "link")
+FILE_VALUES = ("size", "mime_type", "ext", "checksum_value", "checksum_type",
+               "access_request", "publication_date", "embargo", "file_pid")
+
+# A file as a plain tuple of its columns. The bulk writers only read the
+# column attributes, so they take FileRows and FileRecords alike; FileRows
+# skip the pydantic and SQLAlchemy instance machinery.
+FileRow = namedtuple("FileRow", FILE_KEY + FILE_VALUES)
+
+_BOOLEANS = {
+    "true": True, "t": True, "yes": True, "y": True, "on": True, "1": True,
+    "false": False, "f": False, "no": False, "n": False, "off": False, "0": False,
+}
+
+def to_int(value):
+    """
+    A size given as int, float or (padded) string as int, or None if it is
+    not a number.
+    """
+    if value is None or type(value) is int:
+        return value
+    try:
+        return int(value.strip() if isinstance(value, str) else value)
+    except (ValueError, TypeError):
+        return None
+
+def to_utc_datetime(value):
+    """
+    A datetime, date or ISO 8601 string as a naive UTC datetime, the way
+    the timestamp columns store it (see FileRecord.normalise_datetime);
+    naive values are taken to be UTC already.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        if not value.strip():
             return None
-        try:
-            return int(s.strip())
-        except (ValueError, TypeError):
+        value = datetime.fromisoformat(value.strip())
+    elif not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+def to_bool(value):
+    """
+    A flag given as bool, number or string ("true", "f", "yes", "0", ...)
+    as bool.
+    """
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        if not value.strip():
             return None
+        try:
+            return _BOOLEANS[value.strip().lower()]
+        except KeyError:
+            raise ValueError(f"Not a boolean: {value!r}") from None
+    return bool(value)
+
+def _convert_distinct(values, convert):
+    # the files of a dataset mostly share their dates and flags: convert
+    # each distinct value once
+    converted = {}
+    return [converted[v] if v in converted else converted.setdefault(v, convert(v))
+            for v in values]
+
+def file_rows(files: list[dict]) -> list[FileRow]:
+    """
+    Build FileRows from file listings (dicts keyed by column), normalising
+    the batch column by column: sizes to int, dates to naive UTC datetimes
+    and access_request to bool.
+
+    Raises:
+        ValueError: for a date or flag that cannot be parsed
+    """
+    columns = {c: [f.get(c) for f in files] for c in FileRow._fields}
+    columns["size"] = [v if type(v) is int else to_int(v) for v in columns["size"]]
+    columns["publication_date"] = _convert_distinct(columns["publication_date"], to_utc_datetime)
+    columns["embargo"] = _convert_distinct(columns["embargo"], to_utc_datetime)
+    columns["access_request"] = _convert_distinct(columns["access_request"], to_bool)
+    return list(map(FileRow._make, zip(*columns.values())))
+
+def content_hash(raw_metadata) -> str:
+    """
+    Stable SHA-256 of a raw metadata payload: key order and whitespace do
+    not change the hash.
+    """
+    payload = json.dumps(raw_metadata, sort_keys=True, separators=(",", ":"),
+                         ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def file_fingerprint(row: dict) -> str:
+    """
+    SHA-256 over the values of a file row (a dict of column values).
+    """
+    payload = json.dumps([row.get(c) for c in FILE_VALUES], separators=(",", ":"),
+                         ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
 
 def create_pg_engine(dsn):
     return create_engine(dsn, pool_pre_ping=True, echo=False)
 
+@contextmanager
+def _begin(engine, connection=None):
+    """
+    Yield `connection` unchanged (the caller owns its transaction), or a
+    new connection from `engine` in a transaction of its own.
+    """
+    if connection is not None:
+        yield connection
+        return
+    with engine.begin() as conn:
+        yield conn
+
 class FileRawRecordStore:
-    def __init__(self, engine):
+    def __init__(self, engine, compact: bool = False):
+        """
+        Args:
+            engine: SQLAlchemy engine
+            compact (bool): write payloads compressed and deduplicated to
+                raw_metadata_blobs instead of the raw_metadata column; reads
+                decode both
+        """
         self.engine = engine
-
-    def init_schema(self):
-        SQLModel.metadata.create_all(self.engine)
+        self.compact = compact
+        self.blobs = RawBlobStore(engine)
+
+    def init_schema(self, connection=None):
+        with _begin(self.engine, connection) as conn:
+            SQLModel.metadata.create_all(conn)
+            conn.execute(text(
+                "ALTER TABLE file_raw_metadata ADD COLUMN IF NOT EXISTS content_hash VARCHAR"
+            ))
+            conn.execute(text(
+                "ALTER TABLE file_raw_metadata ALTER COLUMN raw_metadata DROP NOT NULL"
+            ))
+            self.blobs.init_schema(conn)
         return True
 
+    def _stored(self, records, connection=None):
+        """
+        The records as written: in compact mode their payloads go to the
+        blob store and the returned copies only keep the content_hash.
+        """
+        if not self.compact:
+            return records
+        payloads = {}
+        stored = []
+        for r in records:
+            digest = r.content_hash or content_hash(r.raw_metadata)
+            payloads[digest] = r.raw_metadata
+            stored.append(FileRawRecord(dataset_pid=r.dataset_pid, raw_metadata=None,
+                                        content_hash=digest))
+        self.blobs.save_many(payloads, connection=connection)
+        return stored
+
     def create_one(self, record: FileRawRecord) -> FileRawRecord:
+        stored = self._stored([record])[0]
         try:
             with Session(self.engine) as session:
-                session.add(record)
+                session.add(stored)
                 session.commit()
-                session.refresh(record)
+                session.refresh(stored)
+                if stored is not record:
+                    record.id, record.content_hash = stored.id, stored.content_hash
                 return record
         except IntegrityError as e:
                 session.rollback()
                 raise
     
-    def create_many(self, records: list[FileRawRecord]) -> list[FileRawRecord]:
+    def create_many(self, records: list[FileRawRecord], connection=None) -> list[FileRawRecord]:
+        """
+        Insert records in one transaction. With `connection` the rows are
+        inserted in that connection's transaction instead.
+        """
+        if connection is not None:
+            table = FileRawRecord.__table__
+            if records:
+                connection.execute(insert(table), [
+                    {"dataset_pid": r.dataset_pid, "raw_metadata": r.raw_metadata,
+                     "content_hash": r.content_hash}
+                    for r in self._stored(records, connection)
+                ])
+            return records
         try:
             with Session(self.engine) as session:
-                session.add_all(records)
+                session.add_all(self._stored(records))
                 session.commit()
                 return records
         except IntegrityError as e:
             session.rollback()
             raise
 
+    def get_hashes(self, dataset_pids: list[str], connection=None) -> dict:
+        """
+        Look up the stored content hashes of many datasets in one query.
+
+        Returns:
+            Dict: {dataset_pid: content_hash} for the datasets that exist
+        """
+        table = FileRawRecord.__table__
+        stmt = select(table.c.dataset_pid, table.c.content_hash).where(
+            table.c.dataset_pid.in_(dataset_pids)
+        )
+        with _begin(self.engine, connection) as conn:
+            return dict(conn.execute(stmt).all())
+
+    def upsert_many(self, records: list[FileRawRecord], connection=None) -> int:
+        """
+        Insert or replace the raw metadata of many datasets, keyed on
+        dataset_pid. Rows with the same content_hash are left untouched.
+
+        Returns:
+            int: number of inserted or updated rows
+        """
+        if not records:
+            return 0
+        table = FileRawRecord.__table__
+        rows = {}
+        for r in self._stored(records, connection):
+            rows[r.dataset_pid] = {
+                "dataset_pid": r.dataset_pid,
+                "raw_metadata": r.raw_metadata,
+                "content_hash": r.content_hash or content_hash(r.raw_metadata),
+            }
+        stmt = insert(table).values(list(rows.values()))
+        stmt = stmt.on_conflict_do_update(
+            constraint="uq_file_raw_record",
+            set_={
+                "raw_metadata": stmt.excluded.raw_metadata,
+                "content_hash": stmt.excluded.content_hash,
+                "last_updated": func.now(),
+            },
+            where=table.c.content_hash.is_distinct_from(stmt.excluded.content_hash),
+        )
+        with _begin(self.engine, connection) as conn:
+            return conn.execute(stmt).rowcount
+
     def get_by_pid(self, dataset_pid: str) -> Optional[FileRawRecord]:
+        """
+        The raw record of a dataset, with its payload decoded from the blob
+        store if it is kept there.
+        """
         with Session(self.engine) as session:
             stmt = select(FileRawRecord).where(
                 FileRawRecord.dataset_pid == dataset_pid
             )
-            return session.exec(stmt).first()
+            record = session.exec(stmt).first()
+        if record is not None and record.raw_metadata is None and record.content_hash:
+            record.raw_metadata = self.blobs.load_many([record.content_hash])[record.content_hash]
+        return record
+
+    def compact_existing(self, batch_size: int = DEFAULT_FETCH_SIZE) -> int:
+        """
+        Move the payloads still kept in the raw_metadata column to the blob
+        store, `batch_size` rows per transaction. Trains a dictionary first
+        if there is none yet.
+
+        Returns:
+            int: number of rows moved
+        """
+        if self.blobs.current_dictionary() is None:
+            self.blobs.train_dictionary()
+        table = FileRawRecord.__table__
+        moved, after_id = 0, 0
+        while True:
+            with self.engine.begin() as conn:
+                page = conn.execute(
+                    select(table.c.id, table.c.raw_metadata, table.c.content_hash)
+                    .where(table.c.id > after_id, table.c.raw_metadata.is_not(None))
+                    .order_by(table.c.id).limit(batch_size)
+                ).all()
+                if not page:
+                    return moved
+                hashes = {row.id: row.content_hash or content_hash(row.raw_metadata)
+                          for row in page}
+                self.blobs.save_many({hashes[row.id]: row.raw_metadata for row in page},
+                                     connection=conn)
+                conn.execute(
+                    table.update()
+                    .where(table.c.id == bindparam("row_id"))
+                    .values(raw_metadata=None, content_hash=bindparam("digest")),
+                    [{"row_id": row_id, "digest": digest} for row_id, digest in hashes.items()],
+                )
+            moved += len(page)
+            after_id = page[-1].id
 
 class FileRecordStore:
-    def __init__(self, engine):
+    def __init__(self, engine, cache=None):
+        """
+        Args:
+            engine: SQLAlchemy engine
+            cache (RecordCache): optional cache of `get_many_by_dataset_pids`,
+                invalidated by the writes of this store object only
+        """
         self.engine = engine
+        self.cache = cache
+
+    def _invalidate(self, dataset_pids):
+        # with a caller's connection this runs before its commit: a read in
+        # between may cache the old files, for at most the cache's max_age
+        if self.cache is not None:
+            self.cache.invalidate(dataset_pids)
+
+    def init_schema(self, connection=None):
+        with _begin(self.engine, connection) as conn:
+            SQLModel.metadata.create_all(conn)
+            conn.execute(text(
+                "ALTER TABLE file_metadata ADD COLUMN IF NOT EXISTS fingerprint VARCHAR"
+            ))
+        return True
 
-    def init_schema(self):
-        SQLModel.metadata.create_all(self.engine)
+    def partition_by_hash(self, partitions: int) -> bool:
+        """
+        Turn file_metadata into a table of `partitions` hash partitions of
+        dataset_pid. Lookups and writes of a dataset then touch one
+        partition, and each partition is indexed and vacuumed on its own.
+
+        The primary key becomes (id, dataset_pid), as a partitioned table
+        needs the partition key in it; ids still come from the same
+        sequence. uq_file_record and the indexes of FileRecord are kept.
+        The rows are copied under an exclusive lock, so run it while no
+        harvest runs, e.g. through `python -m filemeta_harvester.db.schema`
+        with [storage] file_metadata_partitions.
+
+        Returns:
+            bool: whether the table was converted, False if it already was
+            partitioned
+        """
+        with pg_connection(self.engine) as conn:
+            with conn.cursor() as cur:
+                # copying and indexing the whole table outlasts the
+                # configured statement_timeout
+                cur.execute("SET LOCAL statement_timeout = 0")
+                cur.execute("LOCK TABLE file_metadata IN ACCESS EXCLUSIVE MODE")
+                if is_partitioned(cur, "file_metadata"):
+                    return False
+                cur.execute("SELECT pg_get_serial_sequence('file_metadata', 'id')")
+                sequence = cur.fetchone()[0]
+                # or it would be dropped with the old table
+                cur.execute(f"ALTER SEQUENCE {sequence} OWNED BY NONE")
+                cur.execute("""
+                    CREATE TABLE file_metadata_partitioned (LIKE file_metadata INCLUDING DEFAULTS)
+                    PARTITION BY HASH (dataset_pid)
+                """)
+                for remainder in range(partitions):
+                    cur.execute(f"""
+                        CREATE TABLE file_metadata_p{remainder}
+                        PARTITION OF file_metadata_partitioned
+                        FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})
+                    """)
+                cur.execute("INSERT INTO file_metadata_partitioned SELECT * FROM file_metadata")
+                cur.execute("DROP TABLE file_metadata")
+                cur.execute("ALTER TABLE file_metadata_partitioned RENAME TO file_metadata")
+                # indexes are built once the rows are in
+                cur.execute("ALTER TABLE file_metadata ADD PRIMARY KEY (id, dataset_pid)")
+                cur.execute("""
+                    ALTER TABLE file_metadata
+                    ADD CONSTRAINT uq_file_record UNIQUE (dataset_pid, name, link)
+                """)
+                for index in FileRecord.__table__.indexes:
+                    cur.execute(str(CreateIndex(index).compile(dialect=self.engine.dialect)))
+                cur.execute(f"ALTER SEQUENCE {sequence} OWNED BY file_metadata.id")
+                cur.execute("ANALYZE file_metadata")
         return True
 
     def create_one(self, record: FileRecord) -> FileRecord:
@@ -149,6 +482,7 @@ class FileRecordStore:
                 session.add(record)
                 session.commit()
                 session.refresh(record)
+                self._invalidate([record.dataset_pid])
                 return record
         except IntegrityError as e:
                 session.rollback()
@@ -159,6 +493,7 @@ class FileRecordStore:
             with Session(self.engine) as session:
                 session.add_all(records)
                 session.commit()
+                self._invalidate({r.dataset_pid for r in records})
                 return records
         except IntegrityError as e:
             session.rollback()
@@ -175,27 +510,107 @@ class FileRecordStore:
             )
             return session.exec(stmt).first()
 
-    def list(self, limit: int = 100, offset: int = 0) -> List[FileRecord]:
+    def get_many_by_dataset_pids(self, dataset_pids: list[str]) -> dict:
+        """
+        Look up the files of many datasets with one `= ANY(...)` query.
+        With a cache, only the datasets not cached are queried.
+
+        Returns:
+            Dict: {dataset_pid: [FileRecord, ...]} for every requested PID,
+            an empty list for a dataset without files; records ordered by id
+        """
+        dataset_pids = list(dict.fromkeys(dataset_pids))
+        found = self.cache.get_many(dataset_pids) if self.cache is not None else {}
+        missing = [pid for pid in dataset_pids if pid not in found]
+        if missing:
+            version = self.cache.version() if self.cache is not None else None
+            loaded = {pid: [] for pid in missing}
+            for record in self._select_any(FileRecord.dataset_pid, missing):
+                loaded[record.dataset_pid].append(record)
+            if self.cache is not None:
+                self.cache.put_many(loaded, version)
+            found.update(loaded)
+        return {pid: list(found[pid]) for pid in dataset_pids}
+
+    def get_by_file_pids(self, file_pids: list[str]) -> dict:
+        """
+        Look up files by their own PID with one `= ANY(...)` query. These
+        lookups are not cached.
+
+        Returns:
+            Dict: {file_pid: FileRecord} for the PIDs found
+        """
+        return {record.file_pid: record
+                for record in self._select_any(FileRecord.file_pid, list(set(file_pids)))}
+
+    def _select_any(self, column, keys: list[str]) -> List[FileRecord]:
+        # one array parameter whatever the number of keys, unlike IN (...)
+        stmt = select(FileRecord).where(
+            column == any_(bindparam("keys", keys, type_=ARRAY(String)))
+        ).order_by(FileRecord.id)
         with Session(self.engine) as session:
-            stmt = (
-                select(FileRecord)
-                .limit(limit)
-                .offset(offset)
-            )
             return session.exec(stmt).all()
 
+    def list(self, limit: int = 100, offset: int = 0,
+             after_id: Optional[int] = None) -> List[FileRecord]:
+        """
+        Return up to `limit` records ordered by id.
+
+        Pass the id of the last record of the previous page as `after_id`
+        (keyset pagination): unlike `offset`, its cost does not grow with
+        the position in the table.
+        """
+        with Session(self.engine) as session:
+            stmt = select(FileRecord).order_by(FileRecord.id).limit(limit)
+            if after_id is not None:
+                stmt = stmt.where(FileRecord.id > after_id)
+            else:
+                stmt = stmt.offset(offset)
+            return session.exec(stmt).all()
+
+    def iter_all(self, fetch_size: int = DEFAULT_FETCH_SIZE,
+                 dataset_pid: Optional[str] = None):
+        """
+        Yield all records (of one dataset, with `dataset_pid`) ordered by id.
+
+        Records are read in keyset pages of `fetch_size` rows, each in a
+        short transaction of its own, so walking the whole table uses
+        constant memory and holds no snapshot open between pages.
+
+        Yields:
+            FileRecord: detached records
+        """
+        after_id = 0
+        while True:
+            with Session(self.engine) as session:
+                stmt = (
+                    select(FileRecord)
+                    .where(FileRecord.id > after_id)
+                    .order_by(FileRecord.id)
+                    .limit(fetch_size)
+                )
+                if dataset_pid is not None:
+                    stmt = stmt.where(FileRecord.dataset_pid == dataset_pid)
+                page = session.exec(stmt).all()
+            yield from page
+            if len(page) < fetch_size:
+                return
+            after_id = page[-1].id
+
     def update(self, file_id: int, data: dict) -> Optional[FileRecord]:
         with Session(self.engine) as session:
             record = session.get(FileRecord, file_id)
             if not record:
                 return None
 
+            dataset_pid = record.dataset_pid
             for key, value in data.items():
                 setattr(record, key, value)
 
             session.add(record)
             session.commit()
             session.refresh(record)
+            self._invalidate({dataset_pid, record.dataset_pid})
             return record
 
     def upsert(self, record: FileRecord) -> FileRecord:
@@ -211,16 +626,117 @@ class FileRecordStore:
                 ).items():
                     setattr(existing, field, value)
 
+                dataset_pid = existing.dataset_pid
                 session.add(existing)
                 session.commit()
                 session.refresh(existing)
+                self._invalidate({dataset_pid, existing.dataset_pid})
                 return existing
 
             session.add(record)
             session.commit()
             session.refresh(record)
+            self._invalidate([record.dataset_pid])
             return record
 
+    def bulk_upsert(self, records: List[FileRecord | FileRow],
+                    chunk_size: int = DEFAULT_UPSERT_CHUNK_SIZE,
+                    connection=None, stored: set | None = None) -> dict:
+        """
+        Insert or update records on the uq_file_record key with multi-row
+        INSERT ... ON CONFLICT DO UPDATE statements of `chunk_size` rows,
+        all in one transaction (the one of `connection`, if given).
+        Existing rows are only updated when their fingerprint, i.e. one of
+        their values, actually changed.
+
+        Inserts and updates are told apart by the keys (dataset_pid, name,
+        link) already stored: `stored` if the caller has read them, else
+        they are read first. (xmax cannot be returned from a partitioned
+        table.)
+
+        Returns:
+            Dict: {"inserted": int, "updated": int}
+        """
+        table = FileRecord.__table__
+        columns = FILE_KEY + FILE_VALUES
+
+        # one row per key, the last one wins: a statement may not update
+        # the same row twice
+        rows = {}
+        for record in records:
+            row = {c: getattr(record, c) for c in columns}
+            row["fingerprint"] = file_fingerprint(row)
+            rows[tuple(row[c] for c in FILE_KEY)] = row
+        rows = list(rows.values())
+
+        counts = {"inserted": 0, "updated": 0}
+        if not rows:
+            return counts
+        key = (table.c.dataset_pid, table.c.name, table.c.link)
+        # rows go in as executemany parameters: the statement compiles once
+        # (and is cached), SQLAlchemy batches them into multi-row VALUES
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(
+            constraint="uq_file_record",
+            set_={
+                **{c: stmt.excluded[c] for c in FILE_VALUES + ("fingerprint",)},
+                "last_updated": func.now(),
+            },
+            where=table.c.fingerprint.is_distinct_from(stmt.excluded.fingerprint),
+        ).returning(*key)
+        with _begin(self.engine, connection) as conn:
+            if stored is None:
+                stored = set(conn.execute(select(*key).where(
+                    table.c.dataset_pid.in_({row["dataset_pid"] for row in rows}))))
+            for start in range(0, len(rows), chunk_size):
+                for written in conn.execute(stmt, rows[start:start + chunk_size]):
+                    counts["updated" if tuple(written) in stored else "inserted"] += 1
+        self._invalidate({row["dataset_pid"] for row in rows})
+        return counts
+
+    def sync_datasets(self, datasets: dict, connection=None) -> dict:
+        """
+        Make the stored files of each dataset match a new listing, writing
+        only the difference: added and changed files are upserted, files
+        no longer listed are deleted, unchanged files are not touched.
+        datasets = {dataset_pid: [FileRecord or FileRow, ...], ...}
+
+        Returns:
+            Dict: {"inserted": int, "updated": int, "deleted": int}
+        """
+        if not datasets:
+            return {"inserted": 0, "updated": 0, "deleted": 0}
+        table = FileRecord.__table__
+        stmt = select(
+            table.c.id, table.c.dataset_pid, table.c.name, table.c.link,
+            table.c.fingerprint,
+        ).where(table.c.dataset_pid.in_(list(datasets)))
+
+        with _begin(self.engine, connection) as conn:
+            stored = {
+                (dataset_pid, name, link): (file_id, fingerprint)
+                for file_id, dataset_pid, name, link, fingerprint in conn.execute(stmt)
+            }
+            changed = []
+            listed = set()
+            for records in datasets.values():
+                for record in records:
+                    row = {c: getattr(record, c) for c in FILE_KEY + FILE_VALUES}
+                    key = tuple(row[c] for c in FILE_KEY)
+                    listed.add(key)
+                    if key not in stored or stored[key][1] != file_fingerprint(row):
+                        changed.append(record)
+            removed = [file_id for key, (file_id, _) in stored.items() if key not in listed]
+
+            counts = self.bulk_upsert(changed, connection=conn, stored=set(stored))
+            counts["deleted"] = 0
+            if removed:
+                counts["deleted"] = conn.execute(
+                    table.delete().where(table.c.id.in_(removed))
+                ).rowcount
+        self._invalidate(datasets)
+        return counts
+
     def delete(self, file_id: int) -> bool:
         with Session(self.engine) as session:
             record = session.get(FileRecord, file_id)
@@ -229,5 +745,6 @@ class FileRecordStore:
 
             session.delete(record)
             session.commit()
+            self._invalidate([record.dataset_pid])
             return True
 
@@ -1,12 +1,65 @@
-import psycopg
+import hashlib
+import os
+import re
+import socket
+import threading
+import uuid
+from itertools import islice
+from time import monotonic
+from psycopg import sql
 from psycopg.rows import dict_row
+from psycopg.types.json import Jsonb
+from filemeta_harvester.db.connection import pg_connection
+from filemeta_harvester.db.schema import is_partitioned
+
+DEFAULT_BATCH_SIZE = 5000
+DEFAULT_CLAIM_SIZE = 100
+DEFAULT_LEASE_SECONDS = 900
+DEFAULT_STATUS_BUFFER = 500
+DEFAULT_STATUS_FLUSH_INTERVAL = 10.0
+DEFAULT_FETCH_SIZE = 5000
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_RETRY_BASE_DELAY = 60
+DEFAULT_RETRY_MAX_DELAY = 6 * 3600
+DEFAULT_PARTITION = "harvest_pids_default"
+
+# claims and pending scans only touch this (small) part of the table
+_PENDING_INDEX = """
+    CREATE INDEX IF NOT EXISTS harvest_pids_pending_idx
+    ON harvest_pids (endpoint_id, pid)
+    WHERE status = 'pending'
+"""
+
+# (database, endpoint) pairs whose partition this process made sure of
+_partitions = set()
+_partitions_lock = threading.Lock()
+
+
+def endpoint_partition(endpoint_id):
+    """
+    Name of the harvest_pids partition of an endpoint: a valid identifier
+    whatever the endpoint id, and unique through the hash suffix.
+    """
+    slug = re.sub(r"[^a-z0-9]+", "_", endpoint_id.lower()).strip("_")[:32]
+    digest = hashlib.md5(endpoint_id.encode()).hexdigest()[:8]
+    return f"harvest_pids_{slug}_{digest}"
+
+
+def _batched(iterable, size):
+    """
+    Yield lists of at most `size` items from `iterable`.
+    """
+    it = iter(iterable)
+    while batch := list(islice(it, size)):
+        yield batch
+
 
 class PIDStore:
-    def __init__(self, dsn):
-        self.dsn = dsn
+    def __init__(self, engine):
+        self.engine = engine
 
-    def init_schema(self):
-        with psycopg.connect(self.dsn) as conn:
+    def init_schema(self, connection=None):
+        with pg_connection(self.engine, connection) as conn:
             with conn.cursor() as cur:
                 cur.execute("""
                     CREATE TABLE IF NOT EXISTS harvest_pids (
@@ -18,66 +71,777 @@ class PIDStore:
                         PRIMARY KEY (endpoint_id, pid)
                     )
                 """)
+                cur.execute("""
+                    ALTER TABLE harvest_pids
+                    ADD COLUMN IF NOT EXISTS claimed_by TEXT,
+                    ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ,
+                    ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0,
+                    ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMPTZ,
+                    ADD COLUMN IF NOT EXISTS error_class TEXT,
+                    ADD COLUMN IF NOT EXISTS last_error TEXT
+                """)
+                cur.execute(_PENDING_INDEX)
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS harvest_checkpoints (
+                        endpoint_id TEXT NOT NULL,
+                        window_id TEXT NOT NULL DEFAULT '',
+                        from_date TEXT,
+                        until_date TEXT,
+                        set_spec TEXT,
+                        resumption_token TEXT,
+                        updated_at TIMESTAMPTZ DEFAULT now(),
+                        PRIMARY KEY (endpoint_id, window_id)
+                    )
+                """)
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS harvest_state (
+                        endpoint_id TEXT PRIMARY KEY,
+                        watermark TIMESTAMPTZ,
+                        granularity TEXT,
+                        last_success_at TIMESTAMPTZ,
+                        updated_at TIMESTAMPTZ DEFAULT now()
+                    )
+                """)
+                # checkpoints used to be one per endpoint
+                cur.execute("""
+                    ALTER TABLE harvest_checkpoints
+                    ADD COLUMN IF NOT EXISTS window_id TEXT NOT NULL DEFAULT '',
+                    ADD COLUMN IF NOT EXISTS until_date TEXT,
+                    ADD COLUMN IF NOT EXISTS set_spec TEXT,
+                    ALTER COLUMN resumption_token DROP NOT NULL
+                """)
+                cur.execute("""
+                    DO $$
+                    BEGIN
+                        IF (SELECT array_length(conkey, 1) FROM pg_constraint
+                            WHERE conname = 'harvest_checkpoints_pkey') = 1 THEN
+                            ALTER TABLE harvest_checkpoints
+                            DROP CONSTRAINT harvest_checkpoints_pkey,
+                            ADD PRIMARY KEY (endpoint_id, window_id);
+                        END IF;
+                    END $$
+                """)
 
-    def get_most_recent_timestamp(self, endpoint_id):
-        with psycopg.connect(self.dsn, row_factory=dict_row) as conn:
+    def partition_by_endpoint(self):
+        """
+        Turn harvest_pids into a table partitioned by endpoint, with a
+        partition per endpoint and a default one. Queries of one endpoint
+        then only touch its partition, and `drop_endpoint` drops it whole.
+
+        The rows are copied into the new table under an exclusive lock, so
+        run it while no harvest runs, e.g. through `python -m
+        filemeta_harvester.db.schema` with [storage] partition_harvest_pids.
+
+        Returns:
+            bool: whether the table was converted, False if it already was
+            partitioned
+        """
+        with pg_connection(self.engine) as conn:
             with conn.cursor() as cur:
+                # copying and indexing the whole table outlasts the
+                # configured statement_timeout
+                cur.execute("SET LOCAL statement_timeout = 0")
+                cur.execute("LOCK TABLE harvest_pids IN ACCESS EXCLUSIVE MODE")
+                if is_partitioned(cur, "harvest_pids"):
+                    return False
                 cur.execute("""
-                    SELECT MAX(datestamp) AS last_done
-                    FROM harvest_pids
-                    WHERE endpoint_id = %s
+                    CREATE TABLE harvest_pids_partitioned (LIKE harvest_pids INCLUDING DEFAULTS)
+                    PARTITION BY LIST (endpoint_id)
+                """)
+                cur.execute(sql.SQL(
+                    "CREATE TABLE {} PARTITION OF harvest_pids_partitioned DEFAULT"
+                ).format(sql.Identifier(DEFAULT_PARTITION)))
+                cur.execute("SELECT DISTINCT endpoint_id FROM harvest_pids")
+                for (endpoint_id,) in cur.fetchall():
+                    cur.execute(sql.SQL(
+                        "CREATE TABLE {} PARTITION OF harvest_pids_partitioned FOR VALUES IN ({})"
+                    ).format(sql.Identifier(endpoint_partition(endpoint_id)),
+                             sql.Literal(endpoint_id)))
+                cur.execute("INSERT INTO harvest_pids_partitioned SELECT * FROM harvest_pids")
+                cur.execute("DROP TABLE harvest_pids")
+                cur.execute("ALTER TABLE harvest_pids_partitioned RENAME TO harvest_pids")
+                # indexes are built once the rows are in
+                cur.execute("ALTER TABLE harvest_pids ADD PRIMARY KEY (endpoint_id, pid)")
+                cur.execute(_PENDING_INDEX)
+                cur.execute("ANALYZE harvest_pids")
+        return True
+
+    def ensure_partition(self, endpoint_id):
+        """
+        Give the endpoint a partition of its own if harvest_pids is
+        partitioned; a no-op otherwise. Checked once per process. PIDs of
+        the endpoint in the default partition, e.g. saved by a process
+        started before the table was partitioned, move into it.
+        """
+        key = (str(self.engine.url), endpoint_id)
+        with _partitions_lock:
+            if key in _partitions:
+                return
+        name = endpoint_partition(endpoint_id)
+        with pg_connection(self.engine) as conn:
+            with conn.cursor() as cur:
+                if is_partitioned(cur, "harvest_pids"):
+                    # one process creates it, the others find it
+                    cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (name,))
+                    cur.execute("SELECT to_regclass(%s) IS NULL", (name,))
+                    if cur.fetchone()[0]:
+                        partition = sql.Identifier(name)
+                        cur.execute(sql.SQL(
+                            "CREATE TABLE {} (LIKE harvest_pids INCLUDING DEFAULTS)"
+                        ).format(partition))
+                        cur.execute(sql.SQL("""
+                            WITH moved AS (
+                                DELETE FROM {} WHERE endpoint_id = %s RETURNING *
+                            )
+                            INSERT INTO {} SELECT * FROM moved
+                        """).format(sql.Identifier(DEFAULT_PARTITION), partition),
+                            (endpoint_id,))
+                        cur.execute(sql.SQL(
+                            "ALTER TABLE harvest_pids ATTACH PARTITION {} FOR VALUES IN ({})"
+                        ).format(partition, sql.Literal(endpoint_id)))
+        with _partitions_lock:
+            _partitions.add(key)
+
+    def drop_endpoint(self, endpoint_id):
+        """
+        Forget an endpoint: its PIDs, checkpoints and harvest state, and its
+        claim on the datasets it harvested, in one transaction. PIDs of
+        other endpoints marked as duplicates of it become pending again, so
+        they fetch those datasets themselves. File records are shared
+        between endpoints and stay. With partitioned harvest_pids the PIDs
+        go with their partition instead of through a DELETE.
+
+        To reload an endpoint, drop it and harvest it again: it is then
+        listed from the start, as an initial load.
+        """
+        name = endpoint_partition(endpoint_id)
+        with pg_connection(self.engine) as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT to_regclass(%s) IS NOT NULL", (name,))
+                if cur.fetchone()[0]:
+                    cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+                # the rows of an unpartitioned table or of the default partition
+                cur.execute("DELETE FROM harvest_pids WHERE endpoint_id = %s", (endpoint_id,))
+                cur.execute("""
+                    UPDATE harvest_pids
+                    SET status = 'pending', duplicate_of = NULL,
+                        attempts = 0, next_attempt_at = NULL, updated_at = now()
+                    WHERE status = 'duplicate' AND duplicate_of = %s
+                """, (endpoint_id,))
+                for table in ("harvest_checkpoints", "harvest_state", "harvest_datasets"):
+                    cur.execute(sql.SQL("DELETE FROM {} WHERE endpoint_id = %s").format(
+                        sql.Identifier(table)), (endpoint_id,))
+        with _partitions_lock:
+            _partitions.discard((str(self.engine.url), endpoint_id))
+
+    def get_most_recent_timestamp(self, endpoint_id):
+        watermark = self.get_state(endpoint_id)["watermark"]
+        return watermark.isoformat() if watermark else None
+
+    def get_state(self, endpoint_id):
+        """
+        Retrieve the harvest state of an endpoint: the newest datestamp
+        listed so far (`watermark`), the granularity reported by Identify
+        and when the last harvest finished. The in-progress resumption
+        tokens are the checkpoints, see `get_checkpoints`.
+
+        The watermark is kept up to date by the page saves, so this is a
+        primary-key lookup. An endpoint harvested before the state table
+        existed gets its state seeded from harvest_pids once.
+
+        Returns:
+            Dict: {"watermark": datetime, "granularity": str, "last_success_at": datetime}
+        """
+        with pg_connection(self.engine) as conn:
+            with conn.cursor(row_factory=dict_row) as cur:
+                cur.execute("""
+                    SELECT watermark, granularity, last_success_at
+                    FROM harvest_state WHERE endpoint_id = %s
                 """, (endpoint_id,))
                 row = cur.fetchone()
-                if row and row["last_done"]:
-                    return row["last_done"].isoformat()
-                return None
+                if row is None:
+                    cur.execute("""
+                        INSERT INTO harvest_state (endpoint_id, watermark)
+                        SELECT %(endpoint_id)s, MAX(datestamp)
+                        FROM harvest_pids WHERE endpoint_id = %(endpoint_id)s
+                        ON CONFLICT (endpoint_id) DO UPDATE
+                        SET endpoint_id = EXCLUDED.endpoint_id
+                        RETURNING watermark, granularity, last_success_at
+                    """, {"endpoint_id": endpoint_id})
+                    row = cur.fetchone()
+                return row
+
+    def set_granularity(self, endpoint_id, granularity):
+        with pg_connection(self.engine) as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO harvest_state (endpoint_id, granularity) VALUES (%s, %s)
+                    ON CONFLICT (endpoint_id) DO UPDATE
+                    SET granularity = EXCLUDED.granularity, updated_at = now()
+                """, (endpoint_id, granularity))
 
-    def save_pids(self, endpoint_id, pids):
+    def get_capabilities(self, endpoint_id, max_age):
         """
-        Save list of PIDs to the database.
-        pids = [{'pid': str, 'datestamp': str}, ...]
+        The capabilities of an endpoint (see OAIHarvester.probe) if they
+        were probed less than `max_age` seconds ago, else None.
         """
-        with psycopg.connect(self.dsn) as conn:
+        with pg_connection(self.engine) as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT capabilities FROM harvest_state
+                    WHERE endpoint_id = %s AND probed_at > now() - make_interval(secs => %s)
+                """, (endpoint_id, max_age))
+                row = cur.fetchone()
+                return row[0] if row else None
+
+    def save_capabilities(self, endpoint_id, capabilities):
+        with pg_connection(self.engine) as conn:
             with conn.cursor() as cur:
-                for record in pids:
+                cur.execute("""
+                    INSERT INTO harvest_state (endpoint_id, capabilities, probed_at)
+                    VALUES (%s, %s, now())
+                    ON CONFLICT (endpoint_id) DO UPDATE
+                    SET capabilities = EXCLUDED.capabilities, probed_at = now(),
+                        updated_at = now()
+                """, (endpoint_id, Jsonb(capabilities)))
+
+    def finish_harvest(self, endpoint_id):
+        """
+        Record that every window of the current harvest was listed.
+        """
+        with pg_connection(self.engine) as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO harvest_state (endpoint_id, last_success_at) VALUES (%s, now())
+                    ON CONFLICT (endpoint_id) DO UPDATE
+                    SET last_success_at = now(), updated_at = now()
+                """, (endpoint_id,))
+
+    def _advance_watermark(self, cur, endpoint_id, pids):
+        # normalized datestamps ("YYYY-MM-DDTHH:MM:SSZ") sort chronologically
+        newest = max((record["datestamp"] for record in pids if record.get("datestamp")),
+                     default=None)
+        if newest is None:
+            return
+        cur.execute("""
+            INSERT INTO harvest_state (endpoint_id, watermark) VALUES (%s, %s)
+            ON CONFLICT (endpoint_id) DO UPDATE
+            SET watermark = GREATEST(harvest_state.watermark, EXCLUDED.watermark),
+                updated_at = now()
+        """, (endpoint_id, newest))
+
+    def save_pids(self, endpoint_id, pids, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Save PIDs to the database in bounded batches.
+        pids = iterable of {'pid': str, 'datestamp': str, 'deleted': bool}
+
+        Each batch is streamed with COPY into a temporary staging table and
+        merged into harvest_pids with a single INSERT ... SELECT, so `pids`
+        can be a generator and memory stays bounded by `batch_size`.
+
+        Returns:
+            int: number of PIDs read from `pids`
+        """
+        total = 0
+        self.ensure_partition(endpoint_id)
+        with pg_connection(self.engine) as conn:
+            with conn.cursor() as cur:
+                for batch in _batched(pids, batch_size):
+                    self._merge_pids(cur, endpoint_id, batch)
+                    self._advance_watermark(cur, endpoint_id, batch)
+                    # commit per batch so progress survives an interrupted harvest
+                    conn.commit()
+                    total += len(batch)
+        return total
+
+    def save_pid_page(self, endpoint_id, pids, resumption_token, window=None):
+        """
+        Save one page of PIDs together with the resumption token of the next
+        page, in a single transaction.
+        window = {'window_id': str, 'from_date': str, 'until_date': str, 'set_spec': str}
+
+        A crashed harvest can then continue from `get_checkpoints` without
+        losing or re-listing pages. The window's checkpoint is removed when
+        `resumption_token` is None, i.e. after its last page. The endpoint's
+        watermark advances in the same transaction.
+
+        Returns:
+            int: number of PIDs saved
+        """
+        window = window or {"window_id": ""}
+        self.ensure_partition(endpoint_id)
+        with pg_connection(self.engine) as conn:
+            with conn.cursor() as cur:
+                if pids:
+                    self._merge_pids(cur, endpoint_id, pids)
+                    self._advance_watermark(cur, endpoint_id, pids)
+                if resumption_token:
+                    self._save_checkpoint(cur, endpoint_id, window, resumption_token)
+                else:
                     cur.execute("""
-                        INSERT INTO harvest_pids(endpoint_id, pid, status, datestamp)
-                        VALUES (%s, %s, %s, %s)
-                        ON CONFLICT(endpoint_id, pid) DO NOTHING
-                    """, (
-                        endpoint_id,
-                        record['pid'],
-                        'pending',               # explicitly set status
-                        record.get('datestamp')
-                    ))
+                        DELETE FROM harvest_checkpoints
+                        WHERE endpoint_id = %s AND window_id = %s
+                    """, (endpoint_id, window["window_id"]))
+        return len(pids)
 
-    def get_pending_pids(self, endpoint_id):
+    def start_windows(self, endpoint_id, windows):
         """
-        Retrieve PIDs not yet harvested
+        Register the windows of a new harvest. A window keeps its checkpoint
+        row until its last page is saved, so after a crash the remaining
+        rows are exactly the unfinished windows.
         """
-        with psycopg.connect(self.dsn, row_factory=dict_row) as conn:
+        with pg_connection(self.engine) as conn:
             with conn.cursor() as cur:
+                for window in windows:
+                    self._save_checkpoint(cur, endpoint_id, window, None)
+
+    def get_checkpoints(self, endpoint_id):
+        """
+        Retrieve the unfinished windows of an interrupted harvest.
+
+        Returns:
+            List[Dict]: {"window_id", "from_date", "until_date", "set_spec",
+            "resumption_token"} per window; the token is None for windows
+            that did not save a page yet
+        """
+        with pg_connection(self.engine) as conn:
+            with conn.cursor(row_factory=dict_row) as cur:
                 cur.execute("""
-                    SELECT pid FROM harvest_pids
-                    WHERE endpoint_id = %s AND status = 'pending'
+                    SELECT window_id, from_date, until_date, set_spec, resumption_token
+                    FROM harvest_checkpoints
+                    WHERE endpoint_id = %s
+                    ORDER BY window_id
                 """, (endpoint_id,))
-                return [row['pid'] for row in cur.fetchall()]
+                return cur.fetchall()
 
-    def mark_done(self, endpoint_id, pid):
-        with psycopg.connect(self.dsn) as conn:
+    def clear_checkpoint(self, endpoint_id, window_id=""):
+        with pg_connection(self.engine) as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    DELETE FROM harvest_checkpoints
+                    WHERE endpoint_id = %s AND window_id = %s
+                """, (endpoint_id, window_id))
+
+    def _save_checkpoint(self, cur, endpoint_id, window, resumption_token):
+        cur.execute("""
+            INSERT INTO harvest_checkpoints(endpoint_id, window_id, from_date,
+                                            until_date, set_spec, resumption_token)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT(endpoint_id, window_id) DO UPDATE
+            SET resumption_token = EXCLUDED.resumption_token,
+                updated_at = now()
+        """, (endpoint_id, window["window_id"], window.get("from_date"),
+              window.get("until_date"), window.get("set_spec"), resumption_token))
+
+    def _merge_pids(self, cur, endpoint_id, pids):
+        """
+        COPY `pids` into the session's staging table and merge them into
+        harvest_pids. Runs inside the caller's transaction.
+
+        Known PIDs listed with a newer datestamp are set back to pending,
+        so their datasets are checked for changes again. PIDs listed as
+        deleted get status 'deleted' and are not fetched. A PID listed more
+        than once (e.g. in overlapping sets) is merged with its newest
+        listing.
+        """
+        cur.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS harvest_pids_staging (
+                pid TEXT NOT NULL,
+                datestamp TIMESTAMPTZ,
+                deleted BOOLEAN NOT NULL DEFAULT false
+            ) ON COMMIT DELETE ROWS
+        """)
+        with cur.copy(
+            "COPY harvest_pids_staging (pid, datestamp, deleted) FROM STDIN"
+        ) as copy:
+            for record in pids:
+                copy.write_row((record['pid'], record.get('datestamp'),
+                                record.get('deleted', False)))
+        cur.execute("""
+            INSERT INTO harvest_pids(endpoint_id, pid, status, datestamp)
+            SELECT DISTINCT ON (pid) %s, pid,
+                   CASE WHEN deleted THEN 'deleted' ELSE 'pending' END,
+                   datestamp
+            FROM harvest_pids_staging
+            ORDER BY pid, datestamp DESC NULLS LAST
+            ON CONFLICT(endpoint_id, pid) DO UPDATE
+            SET status = EXCLUDED.status, datestamp = EXCLUDED.datestamp, updated_at = now(),
+                attempts = 0, next_attempt_at = NULL, error_class = NULL, last_error = NULL,
+                duplicate_of = NULL
+            WHERE EXCLUDED.datestamp > harvest_pids.datestamp
+               OR harvest_pids.datestamp IS NULL
+        """, (endpoint_id,))
+        cur.execute("TRUNCATE harvest_pids_staging")
+
+    def get_pending_pids(self, endpoint_id):
+        """
+        Retrieve PIDs not yet harvested. Use `iter_pids` to walk a large
+        backlog without loading it.
+        """
+        return list(self.iter_pids(endpoint_id))
+
+    def has_pids(self, endpoint_id, status):
+        """
+        Whether the endpoint has at least one PID with `status`.
+        """
+        with pg_connection(self.engine) as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT EXISTS (
+                        SELECT 1 FROM harvest_pids WHERE endpoint_id = %s AND status = %s
+                    )
+                """, (endpoint_id, status))
+                return cur.fetchone()[0]
+
+    def iter_pids(self, endpoint_id, status="pending", fetch_size=DEFAULT_FETCH_SIZE):
+        """
+        Yield the PIDs of an endpoint with `status`, ordered by PID.
+
+        PIDs are read in keyset pages of `fetch_size` (pid > last pid of the
+        previous page) along the (endpoint_id, pid) key, or the partial
+        pending index, so memory stays constant and every page costs the
+        same however far into the backlog it is. Each page is a short
+        transaction of its own.
+        """
+        after = ""
+        while True:
+            with pg_connection(self.engine) as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        SELECT pid FROM harvest_pids
+                        WHERE endpoint_id = %s AND status = %s AND pid > %s
+                        ORDER BY pid
+                        LIMIT %s
+                    """, (endpoint_id, status, after, fetch_size))
+                    page = [row[0] for row in cur.fetchall()]
+            yield from page
+            if len(page) < fetch_size:
+                return
+            after = page[-1]
+
+    def claim_pids(self, endpoint_id, worker_id, limit=DEFAULT_CLAIM_SIZE,
+                   lease_seconds=DEFAULT_LEASE_SECONDS):
+        """
+        Lease up to `limit` pending PIDs to `worker_id`.
+
+        Rows are locked with FOR UPDATE SKIP LOCKED, so concurrent workers
+        never claim the same PID. PIDs whose lease has expired (e.g. held
+        by a worker that died) are claimable again. PIDs waiting for a
+        retry are only claimed once their `next_attempt_at` has passed.
+
+        Returns:
+            List[str]: the claimed PIDs
+        """
+        with pg_connection(self.engine) as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    WITH claimable AS (
+                        SELECT pid FROM harvest_pids
+                        WHERE endpoint_id = %(endpoint_id)s
+                          AND status = 'pending'
+                          AND (lease_expires_at IS NULL OR lease_expires_at < now())
+                          AND (next_attempt_at IS NULL OR next_attempt_at <= now())
+                        ORDER BY pid
+                        LIMIT %(limit)s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    UPDATE harvest_pids h
+                    SET claimed_by = %(worker_id)s,
+                        lease_expires_at = now() + %(lease_seconds)s * interval '1 second',
+                        updated_at = now()
+                    FROM claimable c
+                    WHERE h.endpoint_id = %(endpoint_id)s AND h.pid = c.pid
+                    RETURNING h.pid
+                """, {
+                    "endpoint_id": endpoint_id,
+                    "worker_id": worker_id,
+                    "limit": limit,
+                    "lease_seconds": lease_seconds,
+                })
+                return [row[0] for row in cur.fetchall()]
+
+    def mark_duplicates(self, endpoint_id, pids):
+        """
+        Settle the PIDs whose dataset another endpoint already harvested at
+        the same or a newer datestamp (see harvest_datasets): they get
+        status 'duplicate' and `duplicate_of` that endpoint, and are not
+        fetched. PIDs without a datestamp are never duplicates.
+
+        Returns:
+            Set[str]: the PIDs marked as duplicates
+        """
+        if not pids:
+            return set()
+        with pg_connection(self.engine) as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE harvest_pids h
+                    SET status = 'duplicate', duplicate_of = d.endpoint_id,
+                        claimed_by = NULL, lease_expires_at = NULL,
+                        attempts = 0, next_attempt_at = NULL, updated_at = now()
+                    FROM harvest_datasets d
+                    WHERE h.endpoint_id = %s AND h.pid = ANY(%s)
+                      AND d.dataset_pid = normalize_pid(h.pid)
+                      AND d.endpoint_id <> h.endpoint_id
+                      AND d.datestamp >= h.datestamp
+                    RETURNING h.pid
+                """, (endpoint_id, list(pids)))
+                return {row[0] for row in cur.fetchall()}
+
+    def iter_claimed_pids(self, endpoint_id, worker_id, batch_size=DEFAULT_CLAIM_SIZE,
+                          lease_seconds=DEFAULT_LEASE_SECONDS):
+        """
+        Yield pending PIDs, claiming a new batch each time the previous one
+        is consumed, until no claimable PIDs are left.
+        """
+        while pids := self.claim_pids(endpoint_id, worker_id, batch_size, lease_seconds):
+            yield from pids
+
+    def release_pids(self, endpoint_id, worker_id):
+        """
+        Give up all leases held by `worker_id`, e.g. on shutdown.
+
+        Returns:
+            int: number of released PIDs
+        """
+        with pg_connection(self.engine) as conn:
             with conn.cursor() as cur:
                 cur.execute("""
                     UPDATE harvest_pids
-                    SET status = 'done',  updated_at = now()
-                    WHERE endpoint_id = %s AND pid = %s
-                """, (endpoint_id, pid))
+                    SET claimed_by = NULL, lease_expires_at = NULL
+                    WHERE endpoint_id = %s AND claimed_by = %s
+                """, (endpoint_id, worker_id))
+                return cur.rowcount
+
+    def renew_leases(self, endpoint_id, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """
+        Extend the leases `worker_id` still holds on pending PIDs to
+        `lease_seconds` from now, e.g. for PIDs staged by an initial load
+        that are only marked done at its next merge. Leases that expired
+        and were claimed by another worker meanwhile are left alone.
+
+        Returns:
+            int: number of renewed leases
+        """
+        with pg_connection(self.engine) as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE harvest_pids
+                    SET lease_expires_at = now() + %s * interval '1 second'
+                    WHERE endpoint_id = %s AND claimed_by = %s AND status = 'pending'
+                """, (lease_seconds, endpoint_id, worker_id))
+                return cur.rowcount
+
+    def reclaim_expired_leases(self, endpoint_id):
+        """
+        Clear leases that expired without the PID being finished.
+
+        Expired leases are already claimable; this only makes the table
+        reflect it.
+
+        Returns:
+            int: number of reclaimed PIDs
+        """
+        with pg_connection(self.engine) as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE harvest_pids
+                    SET claimed_by = NULL, lease_expires_at = NULL
+                    WHERE endpoint_id = %s
+                      AND status = 'pending'
+                      AND lease_expires_at < now()
+                """, (endpoint_id,))
+                return cur.rowcount
+
+    def set_statuses(self, endpoint_id, transitions, connection=None):
+        """
+        Apply many status transitions with a single UPDATE ... FROM unnest.
+        transitions = [(pid, status), ...]
+
+        Pass `connection` (a SQLAlchemy Connection) to make the update part
+        of that connection's transaction, e.g. the one writing the files.
+
+        The datasets of PIDs set to 'done' are recorded in harvest_datasets
+        as harvested by this endpoint at the PID's datestamp, unless another
+        endpoint already harvested them at a newer one. The same listing on
+        other endpoints then becomes a duplicate (see mark_duplicates).
+
+        Returns:
+            int: number of updated rows
+        """
+        if not transitions:
+            return 0
+        pids = [pid for pid, _ in transitions]
+        statuses = [status for _, status in transitions]
+        with pg_connection(self.engine, connection) as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    WITH updated AS (
+                        UPDATE harvest_pids h
+                        SET status = t.status, updated_at = now(),
+                            claimed_by = NULL, lease_expires_at = NULL,
+                            attempts = CASE WHEN t.status = 'done' THEN 0 ELSE h.attempts END,
+                            next_attempt_at = NULL
+                        FROM unnest(%(pids)s::text[], %(statuses)s::text[]) AS t(pid, status)
+                        WHERE h.endpoint_id = %(endpoint_id)s AND h.pid = t.pid
+                        RETURNING h.pid, h.status, h.datestamp
+                    ), harvested AS (
+                        INSERT INTO harvest_datasets (dataset_pid, endpoint_id, datestamp)
+                        SELECT DISTINCT ON (normalize_pid(pid))
+                               normalize_pid(pid), %(endpoint_id)s, datestamp
+                        FROM updated
+                        WHERE status = 'done'
+                        ORDER BY normalize_pid(pid), datestamp DESC NULLS LAST
+                        ON CONFLICT (dataset_pid) DO UPDATE
+                        SET endpoint_id = EXCLUDED.endpoint_id, datestamp = EXCLUDED.datestamp,
+                            updated_at = now()
+                        WHERE harvest_datasets.endpoint_id = EXCLUDED.endpoint_id
+                           OR harvest_datasets.datestamp IS NULL
+                           OR EXCLUDED.datestamp > harvest_datasets.datestamp
+                    )
+                    SELECT count(*) FROM updated
+                """, {"pids": pids, "statuses": statuses, "endpoint_id": endpoint_id})
+                return cur.fetchone()[0]
+
+    def record_failures(self, endpoint_id, failures, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                        base_delay=DEFAULT_RETRY_BASE_DELAY, max_delay=DEFAULT_RETRY_MAX_DELAY,
+                        connection=None):
+        """
+        Record failed attempts with a single UPDATE ... FROM unnest.
+        failures = [(pid, Failure), ...] (see fetch.retry.classify_error)
+
+        A retryable failure puts the PID back to pending with
+        next_attempt_at set by exponential backoff with jitter:
+        min(max_delay, base_delay * 2^attempts) * [0.5, 1), but not before
+        the failure's `min_delay` (Retry-After, open circuit). PIDs that
+        fail permanently, or reach `max_attempts`, get status 'error'.
+        Failures that do not count as an attempt leave `attempts` as is.
+
+        Returns:
+            int: number of updated rows
+        """
+        if not failures:
+            return 0
+        with pg_connection(self.engine, connection) as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE harvest_pids h
+                    SET attempts = h.attempts + f.counts,
+                        error_class = f.error_class,
+                        last_error = f.message,
+                        status = CASE WHEN f.retryable AND h.attempts + f.counts < %(max_attempts)s
+                                      THEN 'pending' ELSE 'error' END,
+                        next_attempt_at = CASE
+                            WHEN f.retryable AND h.attempts + f.counts < %(max_attempts)s
+                            THEN now() + GREATEST(
+                                f.min_delay,
+                                LEAST(%(max_delay)s, %(base_delay)s * power(2, h.attempts))
+                                    * (0.5 + random() / 2)
+                            ) * interval '1 second'
+                        END,
+                        claimed_by = NULL, lease_expires_at = NULL, updated_at = now()
+                    FROM unnest(%(pids)s::text[], %(classes)s::text[], %(messages)s::text[],
+                                %(retryable)s::boolean[], %(min_delays)s::float8[],
+                                %(counts)s::integer[])
+                         AS f(pid, error_class, message, retryable, min_delay, counts)
+                    WHERE h.endpoint_id = %(endpoint_id)s AND h.pid = f.pid
+                """, {
+                    "endpoint_id": endpoint_id,
+                    "max_attempts": max_attempts,
+                    "base_delay": base_delay,
+                    "max_delay": max_delay,
+                    "pids": [pid for pid, _ in failures],
+                    "classes": [f.error_class for _, f in failures],
+                    "messages": [f.message for _, f in failures],
+                    "retryable": [f.retryable for _, f in failures],
+                    "min_delays": [float(f.min_delay or 0) for _, f in failures],
+                    "counts": [1 if f.counts else 0 for _, f in failures],
+                })
+                return cur.rowcount
+
+    def mark_done(self, endpoint_id, pid):
+        self.set_statuses(endpoint_id, [(pid, "done")])
     
     def mark_failed(self, endpoint_id, pid):
-        with psycopg.connect(self.dsn) as conn:
+        with pg_connection(self.engine) as conn:
             with conn.cursor() as cur:
                 cur.execute("""
                     UPDATE harvest_pids
-                    SET status = 'error',  updated_at = now()
+                    SET status = 'error',  updated_at = now(),
+                        claimed_by = NULL, lease_expires_at = NULL
                     WHERE endpoint_id = %s AND pid = %s
                 """, (endpoint_id, pid))
 
+
+class PIDStatusWriter:
+    """
+    Buffer status transitions and failed attempts of one endpoint and
+    write them in bulk with PIDStore.set_statuses and
+    PIDStore.record_failures.
+
+    The buffer is flushed when it holds `max_pending` transitions, when
+    `flush_interval` seconds passed since the last flush, on `flush()` and
+    on `close()`. Not thread-safe: use it from a single thread.
+    """
+
+    def __init__(self, store, endpoint_id, max_pending=DEFAULT_STATUS_BUFFER,
+                 flush_interval=DEFAULT_STATUS_FLUSH_INTERVAL, retry_policy=None):
+        self.store = store
+        self.endpoint_id = endpoint_id
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        # keyword arguments of record_failures: max_attempts, base_delay, max_delay
+        self.retry_policy = retry_policy or {}
+        self._pending = {}
+        self._failures = {}
+        self._last_flush = monotonic()
+
+    def add(self, pid, status):
+        self._failures.pop(pid, None)
+        self._pending[pid] = status
+        self._maybe_flush()
+
+    def add_failure(self, pid, failure):
+        self._pending.pop(pid, None)
+        self._failures[pid] = failure
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if (len(self._pending) + len(self._failures) >= self.max_pending
+                or monotonic() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self, connection=None, transitions=()):
+        """
+        Write the buffered transitions, plus `transitions`, in one statement.
+
+        With `connection` the write joins that connection's transaction, so
+        the statuses commit (or roll back) together with the data written
+        in it. `transitions` are never buffered: if the write fails they are
+        dropped, and only the buffered ones are kept for the next flush.
+        """
+        pending = {**self._pending, **dict(transitions)}
+        failures = {pid: f for pid, f in self._failures.items() if pid not in pending}
+        self.store.set_statuses(self.endpoint_id, list(pending.items()), connection)
+        self.store.record_failures(self.endpoint_id, list(failures.items()),
+                                   connection=connection, **self.retry_policy)
+        self._pending.clear()
+        self._failures.clear()
+        self._last_flush = monotonic()
+
+    def close(self):
+        if self._pending or self._failures:
+            self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def default_worker_id():
+    """
+    Identify this process as a lease holder: host, pid and a random suffix.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
@@ -0,0 +1,282 @@
+import json
+import threading
+import zlib
+from filemeta_harvester.db.connection import pg_connection
+
+try:
+    import zstandard
+except ImportError:  # optional, see the "compact" extra; zlib is used instead
+    zstandard = None
+
+DEFAULT_CODEC = "zstd" if zstandard is not None else "zlib"
+ZSTD_LEVEL = 10
+ZLIB_LEVEL = 9
+DEFAULT_DICT_SIZE = 112640
+# zlib only uses the last 32 KiB of a preset dictionary
+ZLIB_DICT_SIZE = 32768
+DEFAULT_SAMPLE_SIZE = 2000
+# unreferenced blobs written or reused more recently than this may belong
+# to a write in progress
+PRUNE_GRACE = "1 hour"
+
+
+def encode_payload(raw_metadata) -> bytes:
+    return json.dumps(raw_metadata, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+class RawBlobStore:
+    """
+    Content-addressed store of compressed raw dataset payloads.
+
+    Payloads are kept once per content_hash (see filestore.content_hash) in
+    raw_metadata_blobs, compressed with zstd (when zstandard is installed)
+    or zlib, using the newest dictionary of raw_metadata_dicts if one was
+    trained. A blob records its codec and dictionary, so blobs written
+    before a new dictionary or with another codec stay readable.
+    """
+
+    def __init__(self, engine, codec: str = DEFAULT_CODEC):
+        if codec == "zstd" and zstandard is None:
+            raise ValueError("The zstd codec needs the zstandard package")
+        self.engine = engine
+        self.codec = codec
+        self._lock = threading.Lock()
+        self._dicts = {}
+        self._current = None
+        # zstd (de)compressors are not thread-safe
+        self._local = threading.local()
+
+    def init_schema(self, connection=None):
+        with pg_connection(self.engine, connection) as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS raw_metadata_dicts (
+                        id SERIAL PRIMARY KEY,
+                        codec TEXT NOT NULL,
+                        data BYTEA NOT NULL,
+                        created_at TIMESTAMPTZ DEFAULT now()
+                    )
+                """)
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS raw_metadata_blobs (
+                        content_hash TEXT PRIMARY KEY,
+                        codec TEXT NOT NULL,
+                        dict_id INTEGER REFERENCES raw_metadata_dicts (id),
+                        raw_size INTEGER NOT NULL,
+                        data BYTEA NOT NULL,
+                        -- also moved forward whenever the blob is reused
+                        created_at TIMESTAMPTZ DEFAULT now()
+                    )
+                """)
+                # already compressed: keep TOAST from trying again
+                cur.execute("ALTER TABLE raw_metadata_blobs ALTER COLUMN data SET STORAGE EXTERNAL")
+
+    def save_many(self, payloads: dict, connection=None) -> int:
+        """
+        Store the payloads not stored yet and touch the others (see touch),
+        so prune keeps every blob of `payloads` for at least PRUNE_GRACE.
+        Pass the `connection` of the transaction that writes the rows
+        referring to them.
+        payloads = {content_hash: raw_metadata, ...}
+
+        Returns:
+            int: number of payloads compressed and stored
+        """
+        if not payloads:
+            return 0
+        with pg_connection(self.engine, connection) as conn:
+            with conn.cursor() as cur:
+                existing = self._touch(cur, payloads)
+                dict_id = self.current_dictionary(connection)
+                rows = []
+                for digest in sorted(payloads.keys() - existing):
+                    payload = encode_payload(payloads[digest])
+                    rows.append((digest, self.codec, dict_id, len(payload),
+                                 self.compress(payload, dict_id)))
+                if rows:
+                    cur.executemany("""
+                        INSERT INTO raw_metadata_blobs (content_hash, codec, dict_id, raw_size, data)
+                        VALUES (%s, %s, %s, %s, %s)
+                        ON CONFLICT (content_hash) DO UPDATE SET created_at = now()
+                    """, rows)
+        return len(rows)
+
+    def touch(self, hashes, connection=None) -> set:
+        """
+        Move the created_at of the stored blobs among `hashes` to now. The
+        rows stay locked until the transaction ends: a prune running
+        concurrently either deleted a blob before (it is then not
+        returned) or waits and finds it recent.
+
+        Returns:
+            Set[str]: the hashes stored
+        """
+        with pg_connection(self.engine, connection) as conn:
+            with conn.cursor() as cur:
+                return self._touch(cur, hashes)
+
+    def _touch(self, cur, hashes):
+        # locked in a fixed order, so concurrent writers cannot deadlock
+        cur.execute("""
+            UPDATE raw_metadata_blobs b SET created_at = now()
+            FROM (
+                SELECT content_hash FROM raw_metadata_blobs
+                WHERE content_hash = ANY(%s)
+                ORDER BY content_hash
+                FOR UPDATE
+            ) locked
+            WHERE b.content_hash = locked.content_hash
+            RETURNING b.content_hash
+        """, (sorted(hashes),))
+        return {row[0] for row in cur.fetchall()}
+
+    def load_many(self, hashes, connection=None) -> dict:
+        """
+        Returns:
+            Dict: {content_hash: raw_metadata} for the hashes stored
+        """
+        with pg_connection(self.engine, connection) as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT content_hash, codec, dict_id, data FROM raw_metadata_blobs
+                    WHERE content_hash = ANY(%s)
+                """, (list(hashes),))
+                return {digest: json.loads(self.decompress(codec, dict_id, data))
+                        for digest, codec, dict_id, data in cur.fetchall()}
+
+    def compress(self, payload: bytes, dict_id=None) -> bytes:
+        if self.codec == "zstd":
+            compressors = self._thread_cache("compressors")
+            if dict_id not in compressors:
+                dictionary = self._dictionary(dict_id)
+                compressors[dict_id] = zstandard.ZstdCompressor(
+                    level=ZSTD_LEVEL,
+                    dict_data=zstandard.ZstdCompressionDict(dictionary) if dictionary else None,
+                )
+            return compressors[dict_id].compress(payload)
+        dictionary = self._dictionary(dict_id)
+        compressor = zlib.compressobj(ZLIB_LEVEL, zdict=dictionary) if dictionary \
+            else zlib.compressobj(ZLIB_LEVEL)
+        return compressor.compress(payload) + compressor.flush()
+
+    def decompress(self, codec, dict_id, data) -> bytes:
+        dictionary = self._dictionary(dict_id)
+        if codec == "zstd":
+            if zstandard is None:
+                raise RuntimeError("Reading zstd blobs needs the zstandard package")
+            decompressors = self._thread_cache("decompressors")
+            if dict_id not in decompressors:
+                decompressors[dict_id] = zstandard.ZstdDecompressor(
+                    dict_data=zstandard.ZstdCompressionDict(dictionary) if dictionary else None,
+                )
+            return decompressors[dict_id].decompress(data)
+        decompressor = zlib.decompressobj(zdict=dictionary) if dictionary \
+            else zlib.decompressobj()
+        return decompressor.decompress(bytes(data)) + decompressor.flush()
+
+    def train_dictionary(self, samples: int = DEFAULT_SAMPLE_SIZE,
+                         size: int = DEFAULT_DICT_SIZE):
+        """
+        Build a compression dictionary from a random sample of stored
+        payloads; blobs written from now on use it. Worth repeating when
+        the payloads of the endpoints change shape.
+
+        Returns:
+            int: id of the new dictionary, or None if there is too little
+            data to train on
+        """
+        with pg_connection(self.engine) as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT convert_to(raw_metadata::text, 'UTF8') FROM file_raw_metadata
+                    WHERE raw_metadata IS NOT NULL ORDER BY random() LIMIT %s
+                """, (samples,))
+                payloads = [bytes(row[0]) for row in cur.fetchall()]
+                cur.execute("""
+                    SELECT codec, dict_id, data FROM raw_metadata_blobs
+                    ORDER BY random() LIMIT %s
+                """, (max(0, samples - len(payloads)),))
+                payloads += [self.decompress(*row) for row in cur.fetchall()]
+                if self.codec == "zstd":
+                    try:
+                        dictionary = zstandard.train_dictionary(size, payloads).as_bytes()
+                    except zstandard.ZstdError as e:
+                        print(f"Not training a raw metadata dictionary: {e}")
+                        return None
+                elif payloads:
+                    # zlib looks for matches in the end of the dictionary first
+                    dictionary = b"".join(payloads)[-ZLIB_DICT_SIZE:]
+                else:
+                    return None
+                cur.execute(
+                    "INSERT INTO raw_metadata_dicts (codec, data) VALUES (%s, %s) RETURNING id",
+                    (self.codec, dictionary),
+                )
+                dict_id = cur.fetchone()[0]
+        with self._lock:
+            self._dicts[dict_id] = dictionary
+            self._current = dict_id
+        print(f"Trained raw metadata dictionary {dict_id} ({self.codec}, {len(dictionary)} bytes, "
+              f"{len(payloads)} samples)")
+        return dict_id
+
+    def prune(self) -> int:
+        """
+        Delete the blobs no dataset refers to any more, unless they were
+        written or reused (see touch) within PRUNE_GRACE.
+
+        Returns:
+            int: number of blobs deleted
+        """
+        with pg_connection(self.engine) as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                    DELETE FROM raw_metadata_blobs b
+                    WHERE b.created_at < now() - interval '{PRUNE_GRACE}'
+                      AND NOT EXISTS (
+                          SELECT 1 FROM file_raw_metadata r WHERE r.content_hash = b.content_hash
+                      )
+                """)
+                return cur.rowcount
+
+    def current_dictionary(self, connection=None):
+        """
+        Id of the dictionary new blobs are compressed with, or None.
+        """
+        with self._lock:
+            if self._current is not None:
+                return self._current or None
+        with pg_connection(self.engine, connection) as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT id, data FROM raw_metadata_dicts WHERE codec = %s
+                    ORDER BY id DESC LIMIT 1
+                """, (self.codec,))
+                row = cur.fetchone()
+        with self._lock:
+            # 0: no dictionary trained yet
+            self._current = row[0] if row else 0
+            if row:
+                self._dicts[row[0]] = bytes(row[1])
+            return self._current or None
+
+    def _dictionary(self, dict_id):
+        if dict_id is None:
+            return None
+        with self._lock:
+            if dict_id in self._dicts:
+                return self._dicts[dict_id]
+        with pg_connection(self.engine) as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT data FROM raw_metadata_dicts WHERE id = %s", (dict_id,))
+                dictionary = bytes(cur.fetchone()[0])
+        with self._lock:
+            self._dicts[dict_id] = dictionary
+        return dictionary
+
+    def _thread_cache(self, name):
+        cache = getattr(self._local, name, None)
+        if cache is None:
+            cache = {}
+            setattr(self._local, name, cache)
+        return cache
@@ -0,0 +1,85 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_AGE = 300
+
+
+class RecordCache:
+    """
+    In-process LRU cache of the file records of datasets, for
+    FileRecordStore's batched reads.
+
+    Holds at most `max_entries` datasets (the least recently used are
+    evicted first), each for at most `max_age` seconds. Only writes through
+    the same store object invalidate the datasets they touch. The harvester
+    writes through its own stores, in its own processes, so its writes are
+    never seen here: `max_age` is what bounds how stale an entry gets.
+
+    Cached records are shared between callers: treat them as read-only.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, max_age: float = DEFAULT_MAX_AGE):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        # key -> (expires_at, value), least recently used first
+        self._entries = OrderedDict()
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def version(self):
+        """
+        Token to pass to `put_many`: values loaded after taking it are only
+        stored if nothing was invalidated in the meantime.
+        """
+        with self._lock:
+            return self._version
+
+    def get_many(self, keys):
+        """
+        Returns:
+            Dict: {key: value} of the keys cached and not expired
+        """
+        found = {}
+        now = monotonic()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if entry[0] < now:
+                    del self._entries[key]
+                    continue
+                self._entries.move_to_end(key)
+                found[key] = entry[1]
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, values: dict, version=None):
+        """
+        Cache {key: value}, unless an invalidation happened since `version`.
+        """
+        expires_at = monotonic() + self.max_age
+        with self._lock:
+            if version is not None and version != self._version:
+                return
+            for key, value in values.items():
+                self._entries[key] = (expires_at, value)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, keys):
+        with self._lock:
+            self._version += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
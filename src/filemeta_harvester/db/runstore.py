@@ -0,0 +1,51 @@
+from psycopg.types.json import Jsonb
+from filemeta_harvester.db.connection import pg_connection
+
+
+class RunStore:
+    """
+    One summary row per harvest run (a fetch_pids or process_pending_pids
+    call): when it ran, how it ended, its counters and the time spent in
+    each stage.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def init_schema(self, connection=None):
+        with pg_connection(self.engine, connection) as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS harvest_runs (
+                        id BIGSERIAL PRIMARY KEY,
+                        endpoint_id TEXT NOT NULL,
+                        kind TEXT NOT NULL,
+                        worker_id TEXT,
+                        started_at TIMESTAMPTZ NOT NULL,
+                        finished_at TIMESTAMPTZ NOT NULL,
+                        status TEXT NOT NULL,
+                        error TEXT,
+                        counters JSONB NOT NULL DEFAULT '{}',
+                        stages JSONB NOT NULL DEFAULT '{}'
+                    )
+                """)
+                cur.execute("""
+                    CREATE INDEX IF NOT EXISTS harvest_runs_endpoint_idx
+                    ON harvest_runs (endpoint_id, started_at)
+                """)
+
+    def save_run(self, endpoint_id, kind, worker_id, started_at, finished_at,
+                 status, counters, stages, error=None):
+        """
+        Store the summary of one run.
+        counters = {series: value}
+        stages = {stage: {'count': int, 'seconds': float}}
+        """
+        with pg_connection(self.engine) as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO harvest_runs (endpoint_id, kind, worker_id, started_at,
+                                              finished_at, status, error, counters, stages)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                """, (endpoint_id, kind, worker_id, started_at, finished_at, status,
+                      error, Jsonb(counters), Jsonb(stages)))
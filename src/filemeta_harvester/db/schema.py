@@ -0,0 +1,199 @@
+import argparse
+import threading
+from filemeta_harvester.db.connection import get_engine, pg_connection
+
+# any constant; serializes migrations between processes
+MIGRATION_LOCK_KEY = 0x66696c656d657461
+
+
+# A migration takes the SQLAlchemy Connection of `migrate`, and runs in its
+# transaction, together with the schema_version row recording it.
+
+def _baseline(connection):
+    # the schema as the stores created it before it was versioned; they
+    # only import sqlmodel when a migration actually runs
+    from filemeta_harvester.db.filestore import FileRawRecordStore, FileRecordStore
+    from filemeta_harvester.db.pidstore import PIDStore
+    from filemeta_harvester.db.runstore import RunStore
+    engine = connection.engine
+    PIDStore(engine).init_schema(connection)
+    RunStore(engine).init_schema(connection)
+    FileRecordStore(engine).init_schema(connection)
+    FileRawRecordStore(engine).init_schema(connection)
+
+
+def _endpoint_capabilities(connection):
+    with pg_connection(connection.engine, connection) as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                ALTER TABLE harvest_state
+                ADD COLUMN IF NOT EXISTS capabilities JSONB,
+                ADD COLUMN IF NOT EXISTS probed_at TIMESTAMPTZ
+            """)
+
+
+def _dataset_index(connection):
+    with pg_connection(connection.engine, connection) as conn:
+        with conn.cursor() as cur:
+            # the prefixes removed by tasks.harvester_tasks.strip_pid
+            cur.execute("""
+                CREATE OR REPLACE FUNCTION normalize_pid(pid TEXT) RETURNS TEXT
+                LANGUAGE sql IMMUTABLE PARALLEL SAFE
+                AS $$ SELECT regexp_replace(pid, '^(doi:|hdl:|ark:/)', '') $$
+            """)
+            # one row per dataset, whichever endpoints list it
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS harvest_datasets (
+                    dataset_pid TEXT PRIMARY KEY,
+                    endpoint_id TEXT NOT NULL,
+                    datestamp TIMESTAMPTZ,
+                    updated_at TIMESTAMPTZ DEFAULT now()
+                )
+            """)
+            cur.execute("""
+                ALTER TABLE harvest_pids ADD COLUMN IF NOT EXISTS duplicate_of TEXT
+            """)
+            cur.execute("""
+                INSERT INTO harvest_datasets (dataset_pid, endpoint_id, datestamp)
+                SELECT DISTINCT ON (normalize_pid(pid)) normalize_pid(pid), endpoint_id, datestamp
+                FROM harvest_pids
+                WHERE status = 'done'
+                ORDER BY normalize_pid(pid), datestamp DESC NULLS LAST, endpoint_id
+                ON CONFLICT (dataset_pid) DO NOTHING
+            """)
+
+
+# (version, description, migration(connection)), in order. Schema changes go
+# into a new migration here, not into the stores' init_schema.
+MIGRATIONS = [
+    (1, "baseline: harvest, run and file tables", _baseline),
+    (2, "endpoint capabilities in harvest_state", _endpoint_capabilities),
+    (3, "cross-endpoint dataset index", _dataset_index),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+_ready = set()
+_ready_lock = threading.Lock()
+
+
+def is_partitioned(cur, table):
+    """
+    Whether `table` is a partitioned table, through a psycopg cursor.
+    """
+    cur.execute("""
+        SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s))
+    """, (table,))
+    return cur.fetchone()[0]
+
+
+def schema_version(engine=None):
+    """
+    The version of the database schema, 0 if it was never migrated.
+    """
+    engine = engine or get_engine()
+    with pg_connection(engine) as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+            if not cur.fetchone()[0]:
+                return 0
+            cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+            return cur.fetchone()[0]
+
+
+def migrate(engine=None):
+    """
+    Apply the migrations the database has not had yet. Each one commits in
+    a single transaction with the schema_version row recording it, so a
+    crash never leaves a migration applied but unrecorded. The transaction
+    holds an advisory lock, so concurrent workers do not migrate at the
+    same time; the ones that wait find the work done.
+
+    Returns:
+        int: the schema version
+    """
+    engine = engine or get_engine()
+    current = 0
+    with engine.connect() as connection:
+        for version, description, migration in MIGRATIONS:
+            with connection.begin():
+                with pg_connection(engine, connection) as conn:
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_KEY,))
+                        cur.execute("""
+                            CREATE TABLE IF NOT EXISTS schema_version (
+                                version INTEGER PRIMARY KEY,
+                                description TEXT NOT NULL,
+                                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                            )
+                        """)
+                        cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+                        current = cur.fetchone()[0]
+                if version <= current:
+                    continue
+                print(f"Migrating the schema to version {version}: {description}")
+                migration(connection)
+                with pg_connection(engine, connection) as conn:
+                    with conn.cursor() as cur:
+                        cur.execute(
+                            "INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                            (version, description),
+                        )
+                current = version
+    return current
+
+
+def ensure_schema(engine=None):
+    """
+    Make sure the database schema is current: one version lookup, and the
+    pending migrations only if there are any. Checked once per engine and
+    process.
+    """
+    engine = engine or get_engine()
+    with _ready_lock:
+        if engine.url in _ready:
+            return
+    if schema_version(engine) < SCHEMA_VERSION:
+        migrate(engine)
+    with _ready_lock:
+        _ready.add(engine.url)
+
+
+def apply_partitioning(engine=None, storage=None):
+    """
+    Partition harvest_pids by endpoint and file_metadata by hash of
+    dataset_pid if the [storage] section asks for it and they are not
+    partitioned yet. Partitioning is optional, so it is not one of the
+    migrations; it is never undone.
+    """
+    from filemeta_harvester.config import load_storage_config
+    from filemeta_harvester.db.filestore import FileRecordStore
+    from filemeta_harvester.db.pidstore import PIDStore
+    engine = engine or get_engine()
+    storage = storage or load_storage_config()
+    if storage.partition_harvest_pids and PIDStore(engine).partition_by_endpoint():
+        print("Partitioned harvest_pids by endpoint")
+    if storage.file_metadata_partitions and \
+            FileRecordStore(engine).partition_by_hash(storage.file_metadata_partitions):
+        print(f"Partitioned file_metadata into {storage.file_metadata_partitions} "
+              f"hash partitions")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bring the database schema up to date; run once per deployment, "
+                    "before the harvesters start.")
+    parser.add_argument("--drop-endpoint", metavar="ENDPOINT_ID", action="append",
+                        help="forget an endpoint's PIDs and harvest state (repeatable)")
+    args = parser.parse_args()
+    engine = get_engine()
+    print(f"Schema version {migrate(engine)}")
+    apply_partitioning(engine)
+    if args.drop_endpoint:
+        from filemeta_harvester.db.pidstore import PIDStore
+        for endpoint_id in args.drop_endpoint:
+            PIDStore(engine).drop_endpoint(endpoint_id)
+            print(f"Dropped endpoint {endpoint_id}")
+
+
+if __name__ == "__main__":
+    main()
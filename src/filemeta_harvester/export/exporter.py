@@ -0,0 +1,328 @@
+import argparse
+import csv
+import gzip
+import json
+from datetime import datetime, timezone
+from pathlib import Path
+from filemeta_harvester.db.connection import get_engine, pg_connection
+from filemeta_harvester.db.rawblobs import RawBlobStore
+
+DEFAULT_ROW_GROUP_ROWS = 50000
+STATE_FILE = "_export_state.json"
+
+FORMATS = ("parquet", "jsonl", "csv")
+PARTITIONS = ("endpoint", "year")
+
+# exported columns per table; raw_metadata is read as JSON text (or
+# decoded from raw_metadata_blobs) and written as is
+TABLES = {
+    "file_metadata": (
+        ("id", "int64"), ("dataset_pid", "string"), ("name", "string"), ("link", "string"),
+        ("size", "int64"), ("mime_type", "string"), ("ext", "string"),
+        ("checksum_value", "string"), ("checksum_type", "string"),
+        ("access_request", "bool"), ("publication_date", "timestamptz"),
+        ("embargo", "timestamptz"), ("file_pid", "string"), ("fingerprint", "string"),
+        ("last_updated", "timestamp"),
+    ),
+    "file_raw_metadata": (
+        ("id", "int64"), ("dataset_pid", "string"), ("raw_metadata", "json"),
+        ("content_hash", "string"), ("last_updated", "timestamp"),
+    ),
+}
+
+
+def export_table(table: str, out_dir: str | Path, fmt: str = "parquet",
+                 since: datetime | None = None, partition_by: str | None = None,
+                 row_group_rows: int = DEFAULT_ROW_GROUP_ROWS,
+                 compression: str | None = None, engine=None) -> dict:
+    """
+    Stream a table into files under `out_dir/<table>/`.
+
+    Rows are read through a server-side cursor, `row_group_rows` at a
+    time, and written before the next batch is fetched, so memory stays
+    bounded by one batch whatever the size of the table. Each batch
+    becomes one Parquet row group.
+
+    last_updated is the start time of the writing transaction, so a
+    transaction still running during the export can later commit rows
+    older than the newest exported one. The watermark is therefore capped
+    just before the start of the oldest transaction running when the export
+    began (as far as pg_stat_activity shows it to the exporting role); rows
+    after it may be exported again by the next incremental export.
+
+    Args:
+        table (str): "file_metadata" or "file_raw_metadata"
+        out_dir: directory of the export
+        fmt (str): "parquet", "jsonl" or "csv"
+        since (datetime): only rows with a later `last_updated`
+        partition_by (str): None, "endpoint" or "year" (of publication_date,
+            file_metadata only); files go to hive-style directories such as
+            `publication_year=2021/`
+        row_group_rows (int): rows per fetch and per Parquet row group
+        compression (str): Parquet codec (default "zstd"), or "gzip" for
+            JSONL and CSV (default none)
+
+    Returns:
+        Dict: {"rows": int, "files": [str, ...], "watermark": the
+        last_updated up to which all rows are exported, or None}
+    """
+    if table not in TABLES:
+        raise ValueError(f"Unknown table '{table}', expected one of {', '.join(TABLES)}")
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format '{fmt}', expected one of {', '.join(FORMATS)}")
+    if partition_by not in (None, *PARTITIONS):
+        raise ValueError(f"Unknown partitioning '{partition_by}'")
+    if partition_by == "year" and table != "file_metadata":
+        raise ValueError("Only file_metadata can be partitioned by publication year")
+
+    engine = engine or get_engine()
+    columns = TABLES[table]
+    select = ", ".join(f"t.{name}::text" if kind == "json" else f"t.{name}"
+                       for name, kind in columns)
+    joins = ""
+    blobs = None
+    if table == "file_raw_metadata":
+        # payloads kept in the blob store are decoded client-side
+        blobs = RawBlobStore(engine)
+        select += ", b.codec, b.dict_id, b.data"
+        joins = ("LEFT JOIN raw_metadata_blobs b "
+                 "ON t.raw_metadata IS NULL AND b.content_hash = t.content_hash")
+    partition_name, partition = None, "NULL"
+    if partition_by == "endpoint":
+        partition_name = "endpoint"
+        partition = "COALESCE(e.endpoint_id, 'unknown')"
+        # the endpoint that harvested the dataset, see PIDStore.set_statuses
+        joins += " LEFT JOIN harvest_datasets e ON e.dataset_pid = t.dataset_pid"
+    elif partition_by == "year":
+        partition_name = "publication_year"
+        # publication_date holds naive UTC (see filestore.to_utc_datetime):
+        # its year is read as stored, whatever the session's TimeZone
+        partition = ("COALESCE(extract(year FROM t.publication_date)::int::text, "
+                     "'unknown')")
+    where, params = "", []
+    if since is not None:
+        where = "WHERE t.last_updated > %s"
+        params.append(since.astimezone(timezone.utc).replace(tzinfo=None)
+                      if since.tzinfo else since)
+    # sorted by partition, so one output file is open at a time
+    query = f"""
+        SELECT {partition} AS partition, {select}
+        FROM {table} t {joins}
+        {where}
+        ORDER BY 1, t.id
+    """
+
+    summary = {"rows": 0, "files": [], "watermark": None}
+    last_updated = [name for name, _ in columns].index("last_updated")
+    raw_index = [kind for _, kind in columns].index("json") if blobs is not None else None
+    writer = _PartitionedWriter(Path(out_dir) / table, partition_name, fmt, columns,
+                                compression)
+    with pg_connection(engine) as conn:
+        with conn.cursor() as cur:
+            # read before the export's snapshot: a transaction that is not
+            # in it was either running now or starts after now
+            cur.execute("""
+                SELECT (COALESCE(min(xact_start), now()) - interval '1 microsecond')::timestamp
+                FROM pg_stat_activity
+                WHERE datname = current_database() AND pid <> pg_backend_pid()
+                  AND xact_start IS NOT NULL
+            """)
+            cap = cur.fetchone()[0]
+        with conn.cursor(name=f"export_{table}") as cur:
+            cur.itersize = row_group_rows
+            cur.execute(query, params)
+            try:
+                while rows := cur.fetchmany(row_group_rows):
+                    if blobs is not None:
+                        rows = _inline_blobs(rows, blobs, 1 + raw_index)
+                    writer.write(rows)
+                    summary["rows"] += len(rows)
+                    newest = min(max(row[1 + last_updated] for row in rows), cap)
+                    if summary["watermark"] is None or newest > summary["watermark"]:
+                        summary["watermark"] = newest
+            finally:
+                writer.close()
+    summary["files"] = writer.files
+    return summary
+
+
+def export(out_dir: str | Path, tables=tuple(TABLES), fmt: str = "parquet",
+           incremental: bool = False, since: datetime | None = None, **options) -> dict:
+    """
+    Export several tables (see export_table for the options).
+
+    With `incremental`, each table is exported from the watermark its
+    previous incremental export left in `out_dir/_export_state.json`, and
+    the new watermarks are saved there. Deleted files are not part of an
+    incremental export; a full export reflects them.
+
+    Returns:
+        Dict: {table: summary}
+    """
+    state_path = Path(out_dir) / STATE_FILE
+    state = json.loads(state_path.read_text()) if incremental and state_path.exists() else {}
+    results = {}
+    for table in tables:
+        table_since = since
+        if incremental and state.get(table):
+            table_since = datetime.fromisoformat(state[table])
+        results[table] = summary = export_table(table, out_dir, fmt, since=table_since,
+                                                **options)
+        print(f"Exported {summary['rows']} rows of {table} to {len(summary['files'])} file(s)")
+        if summary["watermark"] is not None:
+            state[table] = summary["watermark"].isoformat()
+    if incremental:
+        state_path.parent.mkdir(parents=True, exist_ok=True)
+        state_path.write_text(json.dumps(state, indent=2))
+    return results
+
+
+def _inline_blobs(rows, blobs, raw_index):
+    # (partition, *columns, codec, dict_id, data) -> (partition, *columns)
+    inlined = []
+    for row in rows:
+        *values, codec, dict_id, data = row
+        if values[raw_index] is None and data is not None:
+            values[raw_index] = blobs.decompress(codec, dict_id, data).decode()
+        inlined.append(values)
+    return inlined
+
+
+class _PartitionedWriter:
+    """
+    Write batches of (partition, *columns) rows sorted by partition to one
+    file per partition, under hive-style `<partition_name>=<partition>/`
+    directories (or straight into `base` without a partition_name). A
+    batch may span partitions; a partition may span batches.
+    """
+
+    def __init__(self, base, partition_name, fmt, columns, compression):
+        self.base = base
+        self.partition_name = partition_name
+        self.fmt = fmt
+        self.columns = columns
+        self.compression = compression
+        self.stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+        self.files = []
+        self.writer, self.current = None, None
+
+    def write(self, rows):
+        start = 0
+        for end in range(1, len(rows) + 1):
+            if end < len(rows) and rows[end][0] == rows[start][0]:
+                continue
+            if self.writer is None or rows[start][0] != self.current:
+                self.close()
+                self.current = rows[start][0]
+                directory = self.base / f"{self.partition_name}={self.current}" \
+                    if self.partition_name else self.base
+                directory.mkdir(parents=True, exist_ok=True)
+                self.writer = _WRITERS[self.fmt](directory / f"part-{self.stamp}",
+                                                 self.columns, self.compression)
+                self.files.append(str(self.writer.path))
+            self.writer.write([row[1:] for row in rows[start:end]])
+            start = end
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class _ParquetWriter:
+    def __init__(self, path, columns, compression):
+        # pyarrow is only needed for Parquet exports
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        types = {
+            "int64": pa.int64(), "string": pa.string(), "json": pa.string(),
+            "bool": pa.bool_(), "timestamp": pa.timestamp("us"),
+            "timestamptz": pa.timestamp("us", tz="UTC"),
+        }
+        self.schema = pa.schema([(name, types[kind]) for name, kind in columns])
+        self.path = path.with_suffix(".parquet")
+        self.writer = pq.ParquetWriter(self.path, self.schema,
+                                       compression=compression or "zstd")
+
+    def write(self, rows):
+        arrays = [self.pa.array(values, type=field.type)
+                  for values, field in zip(zip(*rows), self.schema)]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema),
+                                row_group_size=len(rows))
+
+    def close(self):
+        self.writer.close()
+
+
+def _open_text(path, compression):
+    if compression == "gzip":
+        return path.with_name(path.name + ".gz"), gzip.open(path.with_name(path.name + ".gz"),
+                                                            "wt", encoding="utf-8", newline="")
+    if compression:
+        raise ValueError(f"Unsupported compression '{compression}' for text exports")
+    return path, path.open("w", encoding="utf-8", newline="")
+
+
+def _iso(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+class _JsonlWriter:
+    def __init__(self, path, columns, compression):
+        self.path, self.file = _open_text(path.with_suffix(".jsonl"), compression)
+        self.names = [name for name, _ in columns]
+        # JSON columns arrive as JSON text and are spliced in unparsed
+        self.json_columns = [i for i, (_, kind) in enumerate(columns) if kind == "json"]
+
+    def write(self, rows):
+        for row in rows:
+            line = json.dumps({name: _iso(value) for i, (name, value)
+                               in enumerate(zip(self.names, row))
+                               if i not in self.json_columns}, ensure_ascii=False)
+            for i in self.json_columns:
+                line = f'{line[:-1]}, "{self.names[i]}": {row[i] or "null"}}}'
+            self.file.write(line + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class _CsvWriter:
+    def __init__(self, path, columns, compression):
+        self.path, self.file = _open_text(path.with_suffix(".csv"), compression)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([name for name, _ in columns])
+
+    def write(self, rows):
+        self.writer.writerows([_iso(value) for value in row] for row in rows)
+
+    def close(self):
+        self.file.close()
+
+
+_WRITERS = {"parquet": _ParquetWriter, "jsonl": _JsonlWriter, "csv": _CsvWriter}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export harvested file metadata.")
+    parser.add_argument("out_dir", help="directory to write the export to")
+    parser.add_argument("--format", choices=FORMATS, default="parquet")
+    parser.add_argument("--table", action="append", choices=tuple(TABLES),
+                        help="table to export; repeat for several (default: all)")
+    parser.add_argument("--partition-by", choices=PARTITIONS)
+    parser.add_argument("--since", type=datetime.fromisoformat,
+                        help="only rows updated after this ISO 8601 time")
+    parser.add_argument("--incremental", action="store_true",
+                        help=f"continue from the watermarks in <out_dir>/{STATE_FILE}")
+    parser.add_argument("--row-group-rows", type=int, default=DEFAULT_ROW_GROUP_ROWS)
+    parser.add_argument("--compression",
+                        help="Parquet codec (default zstd), or gzip for jsonl/csv")
+    args = parser.parse_args()
+    export(args.out_dir, tables=args.table or tuple(TABLES), fmt=args.format,
+           incremental=args.incremental, since=args.since, partition_by=args.partition_by,
+           row_group_rows=args.row_group_rows, compression=args.compression)
+
+
+if __name__ == "__main__":
+    main()
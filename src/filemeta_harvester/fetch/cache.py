@@ -0,0 +1,191 @@
+import base64
+import hashlib
+import json
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import urlparse
+from requests import Response
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+# headers describing the wire format, not the (decoded) body we store
+_WIRE_HEADERS = ("content-encoding", "content-length", "transfer-encoding")
+
+_scope = threading.local()
+_original_send = HTTPAdapter.send
+_install_lock = threading.Lock()
+
+
+def _cached_send(adapter, request, **kwargs):
+    cache = getattr(_scope, "cache", None)
+    if cache is None or request.method != "GET" or kwargs.get("stream"):
+        return _original_send(adapter, request, **kwargs)
+    return cache._send(adapter, request, **kwargs)
+
+
+def _install():
+    # requests offers no global hook, and filefetcher creates its own
+    # sessions, so the adapter's send is wrapped once per process; outside
+    # `ResponseCache.dataset` it passes every request through unchanged
+    with _install_lock:
+        if HTTPAdapter.send is not _cached_send:
+            HTTPAdapter.send = _cached_send
+
+
+class ResponseCache:
+    """
+    Cache for the HTTP GET responses made while fetching one dataset.
+
+    Inside `with cache.dataset(pid) as hosts:` every GET issued by the
+    current thread (by filefetcher or anything it uses) is looked up first
+    in the responses already received for that dataset, so the raw and the
+    normalized records filefetcher builds come from one retrieval of the
+    listing. `hosts` collects the hosts that answered, other than with a
+    429 or 5xx.
+
+    With a `directory`, responses carrying an ETag or Last-Modified are
+    also kept on disk, per dataset PID, as JSON. A stored response is never
+    served as it is: it is revalidated with If-None-Match /
+    If-Modified-Since, and its body is reused only on 304, so a listing is
+    downloaded again only when it changed. The least recently used
+    datasets are evicted once the directory grows beyond `max_bytes`.
+    """
+
+    def __init__(self, directory: str | Path | None = None, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.directory = Path(directory) if directory else None
+        self.max_bytes = max_bytes
+        self._written = 0
+        self._prune_lock = threading.Lock()
+        _install()
+
+    @contextmanager
+    def dataset(self, pid: str):
+        """
+        Cache GET responses made by this thread while fetching `pid`.
+
+        Yields:
+            Set[str]: filled with the hosts that answered a request, other
+            than with a 429 or 5xx
+        """
+        _scope.cache = self
+        _scope.pid = pid
+        _scope.responses = {}
+        _scope.hosts = set()
+        try:
+            yield _scope.hosts
+        finally:
+            _scope.cache = None
+            _scope.responses = None
+            _scope.hosts = None
+            if self.directory and self._written > self.max_bytes // 10:
+                self.prune()
+
+    def prune(self):
+        """
+        Remove the least recently used datasets until the cache fits in
+        `max_bytes`.
+        """
+        with self._prune_lock:
+            self._written = 0
+            datasets = []
+            total = 0
+            for path in self.directory.glob("*/*"):
+                size = sum(f.stat().st_size for f in path.iterdir())
+                datasets.append((path.stat().st_mtime, size, path))
+                total += size
+            for _, size, path in sorted(datasets):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+    def _send(self, adapter, request, **kwargs):
+        responses = _scope.responses
+        if request.url in responses:
+            return _to_response(responses[request.url], request, adapter)
+
+        entry = self._load(_scope.pid, request.url)
+        if entry:
+            if entry["etag"]:
+                request.headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                request.headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = _original_send(adapter, request, **kwargs)
+        # throttled or failing hosts did not answer in the breaker's sense
+        if response.status_code < 500 and response.status_code != 429:
+            _scope.hosts.add(urlparse(request.url).hostname)
+        if response.status_code == 304 and entry:
+            response.close()
+        elif response.status_code == 200:
+            entry = _to_entry(response)
+            if entry["etag"] or entry["last_modified"]:
+                self._store(_scope.pid, request.url, entry)
+        else:
+            return response
+        responses[request.url] = entry
+        return _to_response(entry, request, adapter)
+
+    def _path(self, pid, url):
+        pid_key = hashlib.sha256(pid.encode()).hexdigest()
+        url_key = hashlib.sha256(url.encode()).hexdigest()
+        return self.directory / pid_key[:2] / pid_key / f"{url_key}.json"
+
+    def _load(self, pid, url):
+        if not self.directory:
+            return None
+        path = self._path(pid, url)
+        try:
+            with path.open("rb") as f:
+                stored = json.load(f)
+            entry = {**stored, "body": base64.b64decode(stored["body"])}
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        # the dataset directory's mtime is its LRU timestamp
+        os.utime(path.parent)
+        return entry
+
+    def _store(self, pid, url, entry):
+        if not self.directory:
+            return
+        path = self._path(pid, url)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{threading.get_ident()}.tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            json.dump({**entry, "body": base64.b64encode(entry["body"]).decode("ascii")}, f)
+        os.replace(tmp, path)
+        os.utime(path.parent)
+        self._written += len(entry["body"])
+
+
+def _to_entry(response):
+    headers = {k: v for k, v in response.headers.items()
+               if k.lower() not in _WIRE_HEADERS}
+    return {
+        "url": response.url,
+        "status_code": response.status_code,
+        "headers": headers,
+        "encoding": response.encoding,
+        "body": response.content,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+
+
+def _to_response(entry, request, adapter):
+    response = Response()
+    response.status_code = entry["status_code"]
+    response.reason = "OK"
+    response.headers = CaseInsensitiveDict(entry["headers"])
+    response.encoding = entry["encoding"]
+    response._content = entry["body"]
+    response._content_consumed = True
+    response.url = entry["url"]
+    response.request = request
+    response.connection = adapter
+    return response
@@ -0,0 +1,206 @@
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from time import monotonic
+from urllib.parse import urlparse
+import requests
+from sqlalchemy.exc import DBAPIError, IntegrityError, DataError, OperationalError
+
+# HTTP statuses worth retrying: throttling, timeouts and server-side trouble
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+# consecutive transient failures against a host that open its circuit
+CIRCUIT_FAILURE_THRESHOLD = 5
+# seconds an open circuit waits before letting a trial request through
+CIRCUIT_RESET_SECONDS = 60.0
+
+Failure = namedtuple("Failure", [
+    "error_class",  # e.g. "http_503", "timeout", "invalid_data"
+    "message",
+    "retryable",
+    "min_delay",  # seconds the next attempt must wait at least (Retry-After), or 0
+    "host",  # remote host of the failed request, if known
+    "counts",  # False when the attempt was never made (open circuit)
+])
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, host, retry_in):
+        super().__init__(f"Circuit for host {host} is open, retry in {retry_in:.0f}s")
+        self.host = host
+        self.retry_in = retry_in
+
+
+def _host(exc):
+    for source in (getattr(exc, "response", None), getattr(exc, "request", None)):
+        url = getattr(source, "url", None)
+        if url:
+            return urlparse(url).hostname
+    return None
+
+
+def _retry_after(response):
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return 0
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        return max(0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return 0
+
+
+def classify_error(exc) -> Failure:
+    """
+    Decide whether the failure of a dataset is worth retrying.
+
+    Throttling (429), server errors, timeouts, connection problems and
+    transient database errors are retryable; client errors such as 404,
+    constraint violations and malformed data are permanent. Unknown
+    exceptions are retried, as attempts are capped anyway.
+    """
+    message = str(exc)[:1000]
+    host = _host(exc)
+    if isinstance(exc, CircuitOpenError):
+        return Failure("circuit_open", message, True, exc.retry_in, exc.host, False)
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        status = exc.response.status_code
+        return Failure(f"http_{status}", message, status in RETRYABLE_STATUS,
+                       _retry_after(exc.response), host, True)
+    if isinstance(exc, requests.Timeout):
+        return Failure("timeout", message, True, 0, host, True)
+    if isinstance(exc, requests.ConnectionError):
+        return Failure("connection", message, True, 0, host, True)
+    if isinstance(exc, (IntegrityError, DataError)):
+        return Failure("database_data", message, False, 0, None, True)
+    if isinstance(exc, (OperationalError, DBAPIError)):
+        return Failure("database", message, True, 0, None, True)
+    if isinstance(exc, (ValueError, TypeError, KeyError, AttributeError)):
+        return Failure("invalid_data", message, False, 0, None, True)
+    return Failure(type(exc).__name__, message, True, 0, host, True)
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker shared by the harvests of a process.
+
+    After `failure_threshold` consecutive transient failures against a
+    host its circuit opens: `check` raises CircuitOpenError for every
+    scope (endpoint) that fetches from that host, so the host gets a rest
+    instead of a retry storm. After `reset_seconds` one trial call is let
+    through; an answer from the host closes the circuit, anything else
+    opens it again.
+
+    Hosts are learned from failures: a scope is tied to the hosts its
+    failed requests went to.
+    """
+
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+                 reset_seconds=CIRCUIT_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = {}
+        self._opened_at = {}
+        self._trial = set()
+        self._hosts = {}
+
+    @contextmanager
+    def guard(self, scope):
+        """
+        Run the body as a call for `scope`: refused with CircuitOpenError
+        while a host of `scope` is resting, and recorded as its outcome
+        otherwise. A transient failure counts against its host; any other
+        answer from a host (e.g. a 404) shows the host is up. A trial call
+        that ends without either reopens its circuit, so a half-open
+        circuit is always resolved.
+
+        The guard yields a set the body adds the hosts that answered it to.
+        A successful call closes their circuits only; one that names no
+        host counts as an answer from the hosts it was the trial of.
+        """
+        trial = self.check(scope)
+        answered = set()
+        try:
+            yield answered
+        except Exception as e:
+            failure = classify_error(e)
+            if failure.counts and failure.host:
+                if failure.retryable:
+                    self.record_failure(scope, failure.host)
+                else:
+                    self.record_success(failure.host)
+            raise
+        else:
+            for host in answered or trial:
+                self.record_success(host)
+        finally:
+            self._reopen(trial)
+
+    def check(self, scope):
+        """
+        Raise CircuitOpenError if a host of `scope` is resting; otherwise
+        return, possibly as the trial call of a half-open circuit.
+
+        Returns:
+            Set[str]: the hosts this call is the trial of; the caller must
+            end their trial with record_success or record_failure
+        """
+        with self._lock:
+            resting = self._resting(scope)
+            if resting:
+                raise CircuitOpenError(*resting)
+            trial = {host for host in self._hosts.get(scope, ()) if host in self._opened_at}
+            self._trial |= trial
+            return trial
+
+    def is_open(self, scope):
+        """
+        Whether calls for `scope` would currently be refused.
+        """
+        with self._lock:
+            return self._resting(scope) is not None
+
+    def _resting(self, scope):
+        for host in self._hosts.get(scope, ()):
+            opened_at = self._opened_at.get(host)
+            if opened_at is None:
+                continue
+            retry_in = opened_at + self.reset_seconds - monotonic()
+            if retry_in > 0 or host in self._trial:
+                return host, max(retry_in, 1.0)
+        return None
+
+    def record_success(self, host):
+        # only the answering host: the other hosts of its scopes may still
+        # be failing
+        with self._lock:
+            self._failures[host] = 0
+            self._opened_at.pop(host, None)
+            self._trial.discard(host)
+
+    def record_failure(self, scope, host):
+        with self._lock:
+            self._hosts.setdefault(scope, set()).add(host)
+            self._failures[host] = self._failures.get(host, 0) + 1
+            if host in self._trial or self._failures[host] >= self.failure_threshold:
+                if host not in self._opened_at or host in self._trial:
+                    print(f"Opening circuit for host {host} after "
+                          f"{self._failures[host]} failures")
+                self._opened_at[host] = monotonic()
+                self._trial.discard(host)
+
+    def _reopen(self, hosts):
+        # trials among `hosts` that no outcome resolved fail
+        with self._lock:
+            for host in hosts & self._trial:
+                print(f"Opening circuit for host {host} again: its trial call got no answer")
+                self._opened_at[host] = monotonic()
+                self._trial.discard(host)
+
+
+# the circuit breaker all harvests of a process share
+BREAKER = CircuitBreaker()
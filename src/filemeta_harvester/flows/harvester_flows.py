@@ -1,10 +1,15 @@
 import datetime
-from filemeta_harvester.config import load_endpoints_config
-from multiprocessing import Process
+import signal
+import sys
+from filemeta_harvester.config import (load_endpoints_config, load_harvest_config,
+                                       load_metrics_config, load_pipeline_config,
+                                       load_scheduler_config)
+from filemeta_harvester.flows.scheduler import HarvestScheduler
+from filemeta_harvester.metrics.registry import start_metrics_server
 from filemeta_harvester.tasks.harvester_tasks import (
-            initialize_db, 
-            initialize_file_db, 
-            check_endpoint, 
+            initialize_db,
+            initialize_file_db,
+            check_endpoint,
             fetch_pids,
             process_pending_pids
 )
@@ -13,22 +18,44 @@ from filemeta_harvester.tasks.harvester_tasks import (
 def generate_timestamp():
     return datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
 
-def filemeta_harvest_flow(endpoint: dict):
+def filemeta_harvest_flow(endpoint: dict, harvest_config=None, pipeline_config=None,
+                          check=True):
+    """
+    Harvest one endpoint: finish the PIDs left pending, list the new and
+    updated PIDs and process them. The database schema must be initialized.
+
+    Returns:
+        int: number of datasets processed after listing whose files were
+        new or changed; unchanged datasets do not count
+    """
     print(f"Starting harvest flow for endpoint: {endpoint['name']}")
-    check_endpoint(endpoint["oai_url"], endpoint["name"], endpoint.get("metadata_prefix", "oai_dc"))
-    initialize_db()
-    initialize_file_db()
-    process_pending_pids(endpoint['id'])
-    fetch_pids(endpoint['oai_url'], endpoint['id'], endpoint['name'], endpoint.get('metadata_prefix', 'oai_dc'))
-    process_pending_pids(endpoint['id'])
+    harvest_config = harvest_config or load_harvest_config(endpoint)
+    pipeline_config = pipeline_config or load_pipeline_config(endpoint)
+    if check:
+        check_endpoint(endpoint["oai_url"], endpoint["name"], endpoint.get("metadata_prefix", "oai_dc"),
+                       endpoint["id"], harvest_config.probe_ttl)
+    process_pending_pids(endpoint['id'], pipeline_config)
+    fetch_pids(endpoint['oai_url'], endpoint['id'], endpoint['name'], endpoint.get('metadata_prefix', 'oai_dc'),
+               harvest_config)
+    counts = process_pending_pids(endpoint['id'], pipeline_config)
+    return counts["done"] - counts["unchanged"]
+
+def _scheduled_harvest(schedule):
+    return filemeta_harvest_flow(schedule.endpoint, schedule.harvest_config,
+                                 schedule.pipeline_config, check=not schedule.checked)
 
 
 if __name__ == "__main__":
-    endpoints_config = load_endpoints_config()
-    deployed_flows = []
-    for endpoint in endpoints_config:
-        p = Process(target=filemeta_harvest_flow, args=(endpoint,))
-        p.start()
-        deployed_flows.append(p)
-    for p in deployed_flows:
-        p.join()
+    # --once harvests every endpoint a single time and exits
+    once = "--once" in sys.argv[1:]
+    metrics_config = load_metrics_config()
+    if metrics_config.port:
+        start_metrics_server(metrics_config.port)
+    initialize_db()
+    initialize_file_db()
+    scheduler = HarvestScheduler(load_endpoints_config(), load_scheduler_config(),
+                                 _scheduled_harvest)
+    # finish the running harvests, then exit
+    signal.signal(signal.SIGTERM, lambda *_: scheduler.stop())
+    signal.signal(signal.SIGINT, lambda *_: scheduler.stop())
+    scheduler.run(once=once)
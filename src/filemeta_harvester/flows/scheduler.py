@@ -0,0 +1,153 @@
+import random
+import threading
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import monotonic
+from urllib.parse import urlparse
+from filemeta_harvester.config import (SchedulerConfig, load_harvest_config, load_pipeline_config,
+                                       load_schedule_config)
+
+# growth of the polling interval after a harvest without changes
+INTERVAL_GROWTH = 1.5
+# longest wait before the scheduler re-checks for due endpoints
+_MAX_SLEEP = 60.0
+
+
+class EndpointSchedule:
+    """
+    Scheduling state of one endpoint. The configs are read once, when the
+    scheduler starts.
+    """
+
+    def __init__(self, endpoint: dict):
+        self.endpoint = endpoint
+        self.host = urlparse(endpoint["oai_url"]).hostname
+        self.harvest_config = load_harvest_config(endpoint)
+        self.pipeline_config = load_pipeline_config(endpoint)
+        schedule_config = load_schedule_config(endpoint)
+        self.priority = schedule_config.priority
+        self.interval = schedule_config.poll_interval
+        self.next_run = 0.0
+        self.runs = 0
+        # the endpoint is (re-)checked before its first harvest and after a failure
+        self.checked = False
+        self.running = False
+
+
+class HarvestScheduler:
+    """
+    Long-running scheduler that harvests every endpoint repeatedly in one
+    process.
+
+    At most `workers` harvests run at the same time, in a thread pool, and
+    at most `max_per_host` of them against one OAI-PMH host. Among the due
+    endpoints the highest `priority` starts first, then the longest
+    overdue. Each endpoint's polling interval adapts to its change rate:
+    it is halved after a harvest that found new or updated datasets and
+    grows by INTERVAL_GROWTH after one that found none, within
+    [`min_interval`, `max_interval`]. Every next run is shifted by a random
+    `jitter` fraction so endpoints do not synchronise.
+
+    Idle endpoints hold no thread and no database connection: a harvest
+    borrows them from the shared pools only while it runs.
+
+    Args:
+        endpoints (List[dict]): the `[[endpoints]]` entries of harvester.toml
+        config (SchedulerConfig): pool size, host cap and interval bounds
+        harvest (callable): `harvest(schedule)` runs one harvest of an
+            endpoint and returns the number of datasets it found changed
+    """
+
+    def __init__(self, endpoints, config: SchedulerConfig, harvest):
+        self.config = config
+        self.harvest = harvest
+        self.schedules = [EndpointSchedule(endpoint) for endpoint in endpoints]
+        self._stop = threading.Event()
+        # spread the first runs instead of starting every endpoint at once
+        now = monotonic()
+        for schedule in self.schedules:
+            schedule.next_run = now + random.uniform(0, config.jitter * config.min_interval)
+
+    def stop(self):
+        """
+        Ask `run` to return once the running harvests have finished.
+        """
+        self._stop.set()
+
+    def run(self, once=False):
+        """
+        Harvest endpoints as they become due until `stop` is called. With
+        `once`, every endpoint is harvested a single time and `run` returns.
+        """
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.config.workers) as pool:
+            while True:
+                if not self._stop.is_set():
+                    for schedule in self._due(once):
+                        schedule.running = True
+                        running[pool.submit(self.harvest, schedule)] = schedule
+                if not running and (self._stop.is_set() or
+                                    (once and all(s.runs for s in self.schedules))):
+                    return
+                timeout = self._sleep_time(once)
+                if running:
+                    done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._reschedule(running.pop(future), future)
+                else:
+                    self._stop.wait(timeout)
+
+    def _busy(self):
+        return Counter(s.host for s in self.schedules if s.running)
+
+    def _due(self, once):
+        now = monotonic()
+        busy = self._busy()
+        slots = self.config.workers - sum(busy.values())
+        due = [s for s in self.schedules
+               if not s.running and s.next_run <= now and not (once and s.runs)]
+        due.sort(key=lambda s: (-s.priority, s.next_run))
+        for schedule in due:
+            if slots <= 0:
+                return
+            if busy[schedule.host] >= self.config.max_per_host:
+                continue
+            busy[schedule.host] += 1
+            slots -= 1
+            yield schedule
+
+    def _sleep_time(self, once):
+        # Only endpoints that could start count: one whose host is at
+        # max_per_host, or any while every worker is busy, waits for a
+        # running harvest to finish, which wakes `run` anyway.
+        busy = self._busy()
+        if sum(busy.values()) >= self.config.workers:
+            return _MAX_SLEEP
+        waiting = [s.next_run for s in self.schedules
+                   if not s.running and busy[s.host] < self.config.max_per_host
+                   and not (once and s.runs)]
+        if not waiting:
+            return _MAX_SLEEP
+        return min(_MAX_SLEEP, max(0.0, min(waiting) - monotonic()))
+
+    def _reschedule(self, schedule, future):
+        schedule.running = False
+        schedule.runs += 1
+        config = self.config
+        name = schedule.endpoint["name"]
+        try:
+            changed = future.result()
+        except Exception as e:
+            print(f"Harvest of endpoint '{name}' failed: {e}")
+            schedule.checked = False
+            schedule.interval = min(config.max_interval, schedule.interval * 2)
+        else:
+            schedule.checked = True
+            if changed:
+                schedule.interval = max(config.min_interval, schedule.interval / 2)
+            else:
+                schedule.interval = min(config.max_interval,
+                                        schedule.interval * INTERVAL_GROWTH)
+        jitter = random.uniform(-config.jitter, config.jitter)
+        schedule.next_run = monotonic() + schedule.interval * (1 + jitter)
+        print(f"Next harvest of endpoint '{name}' in {schedule.interval * (1 + jitter):.0f}s")
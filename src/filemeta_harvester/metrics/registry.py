@@ -0,0 +1,172 @@
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+# upper bounds (seconds) of the stage latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+STAGE_SECONDS = "harvest_stage_seconds"
+
+_HELP = {
+    STAGE_SECONDS: "Time spent per harvest stage.",
+    "harvest_oai_pages_total": "OAI-PMH list pages received.",
+    "harvest_pids_listed_total": "PIDs received from OAI-PMH list pages.",
+    "harvest_datasets_total": "Datasets processed, by outcome.",
+    "harvest_files_total": "File rows written, by change.",
+    "harvest_errors_total": "Failed datasets, by error class.",
+}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class MetricsRegistry:
+    """
+    Thread-safe counters and latency histograms of the harvest tasks.
+
+    Series are identified by a name and keyword labels (at least
+    `endpoint`), e.g. `inc("harvest_datasets_total", endpoint="easy",
+    outcome="done")`. `render` returns all series in the Prometheus text
+    exposition format.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = {}
+        # series -> [bucket counts..., sum, count]
+        self._histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [0] * (len(self.buckets) + 2)
+            index = bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += seconds
+            series[-1] += 1
+
+    @contextmanager
+    def timer(self, stage, endpoint):
+        """
+        Record the duration of the block in `harvest_stage_seconds`.
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(STAGE_SECONDS, perf_counter() - start, endpoint=endpoint, stage=stage)
+
+    def timed(self, func, stage, endpoint):
+        """
+        Wrap `func` so each call is recorded like `timer(stage, endpoint)`.
+        """
+        def wrapper(*args, **kwargs):
+            with self.timer(stage, endpoint):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def snapshot(self, endpoint):
+        """
+        Current totals of one endpoint's series.
+
+        Returns:
+            dict: {"counters": {series: value}, "stages": {stage: {"count", "seconds"}}}
+            where a counter series is its name followed by its other label
+            values, e.g. "harvest_datasets_total:done"
+        """
+        counters = {}
+        stages = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                labels = dict(labels)
+                if labels.pop("endpoint", None) != endpoint:
+                    continue
+                counters[":".join([name, *map(str, labels.values())])] = value
+            for (name, labels), series in self._histograms.items():
+                labels = dict(labels)
+                if name != STAGE_SECONDS or labels.get("endpoint") != endpoint:
+                    continue
+                stages[labels["stage"]] = {"count": series[-1], "seconds": series[-2]}
+        return {"counters": counters, "stages": stages}
+
+    def render(self):
+        """
+        All series in the Prometheus text exposition format (version 0.0.4).
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# HELP {name} {_HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), series in histograms:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# HELP {name} {_HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {series[-1]}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {series[-2]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {series[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+# the registry all harvest tasks of a process report to
+METRICS = MetricsRegistry()
+
+
+def start_metrics_server(port, registry=METRICS, host="0.0.0.0"):
+    """
+    Serve `registry.render()` on http://<host>:<port>/metrics from a daemon
+    thread.
+
+    Returns:
+        ThreadingHTTPServer: call shutdown() to stop serving
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
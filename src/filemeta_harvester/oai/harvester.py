@@ -1,14 +1,28 @@
-from datetime import datetime
-from sickle import Sickle
+from datetime import date, timedelta
+import requests
+from sickle import Sickle, oaiexceptions
+from filemeta_harvester.oai.parser import (DAY_GRANULARITY, SECONDS_GRANULARITY, ListResponse,
+                                           normalize_datestamp)
+
+REQUEST_TIMEOUT = 120
 
 
 class OAIHarvester:
-    def __init__(self, endpoint_url: str, prefix: str = "oai_dc"):
+    def __init__(self, endpoint_url: str, prefix: str = "oai_dc", capabilities: dict = None):
+        """
+        Args:
+            endpoint_url (str): base URL of the OAI-PMH endpoint
+            prefix (str): metadata prefix to harvest
+            capabilities (dict): the result of an earlier `probe`, to skip
+                the ListMetadataFormats and Identify requests
+        """
         self.endpoint = endpoint_url
         self.prefix = prefix
         self.sickle = Sickle(self.endpoint)
-        formats = self.sickle.ListMetadataFormats()
-        self.supported_formats = [fmt.metadataPrefix for fmt in formats]
+        # list pages are fetched and parsed without Sickle, see get_pid_pages
+        self.session = requests.Session()
+        self.capabilities = capabilities or self.probe()
+        self.supported_formats = self.capabilities["formats"]
         if self.prefix not in self.supported_formats:
             raise ValueError(f"Metadata prefix '{self.prefix}' not supported by endpoint '{self.endpoint}'")
 
@@ -23,6 +37,35 @@ class OAIHarvester:
         identity = self.sickle.Identify()
         return identity
 
+    def probe(self):
+        """
+        Ask the endpoint what it supports, with ListMetadataFormats and
+        Identify.
+
+        Returns:
+            Dict: {"formats": [prefix, ...], "granularity": str,
+            "earliest_datestamp": str, "repository_name": str}
+        """
+        formats = [fmt.metadataPrefix for fmt in self.sickle.ListMetadataFormats()]
+        identity = self.identify()
+        granularity = getattr(identity, "granularity", None)
+        return {
+            "formats": formats,
+            "granularity": SECONDS_GRANULARITY if granularity == SECONDS_GRANULARITY
+            else DAY_GRANULARITY,
+            "earliest_datestamp": getattr(identity, "earliestDatestamp", None),
+            "repository_name": getattr(identity, "repositoryName", None),
+        }
+
+    def granularity(self):
+        """
+        The finest datestamp granularity the endpoint accepts in from/until.
+
+        Returns:
+            str: "YYYY-MM-DD" or "YYYY-MM-DDThh:mm:ssZ"
+        """
+        return self.capabilities["granularity"]
+
     def get_records(self, from_date: str = None, until_date: str = None):
         records = self.sickle.ListRecords(**{
             'metadataPrefix': self.prefix,
@@ -33,30 +76,142 @@ class OAIHarvester:
 
     def get_pid_list(self, from_date: str = None, until_date: str = None):
         """
-        Get list of PIDs (and datestamps) from the OAI-PMH endpoint.
+        Get PIDs (and datestamps) from the OAI-PMH endpoint.
+
+        PIDs are yielded as the endpoint's pages are consumed, so only one
+        page of records is held in memory at a time.
         
         Args:
             from_date (str): optional ISO 8601 start date, e.g. "2023-01-01"
             until_date (str): optional ISO 8601 end date, e.g. "2023-12-31"
         
+        Yields:
+            Dict: {"pid": <identifier>, "datestamp": <datestamp>, "deleted": <bool>}
+        """
+        for pids, _ in self.get_pid_pages(from_date, until_date):
+            yield from pids
+
+    def get_pid_pages(self, from_date: str = None, until_date: str = None,
+                      resumption_token: str = None, set_spec: str = None):
+        """
+        Get PIDs page by page using ListIdentifiers, which returns record
+        headers only instead of full metadata payloads. Pages are parsed
+        while they stream in (see ListResponse). Deleted records are
+        included, flagged with "deleted": True.
+
+        Args:
+            from_date (str): optional ISO 8601 start date, e.g. "2023-01-01"
+            until_date (str): optional ISO 8601 end date, e.g. "2023-12-31"
+            resumption_token (str): optional token to continue an earlier
+                traversal from; the other arguments are then ignored
+            set_spec (str): optional OAI set to restrict the listing to
+
+        Yields:
+            Tuple[List[Dict], str]: the PIDs of a page and the resumption
+            token of the next page, or None on the last page
+        """
+        if resumption_token:
+            params = {'verb': 'ListIdentifiers', 'resumptionToken': resumption_token}
+        else:
+            params = {'verb': 'ListIdentifiers', 'metadataPrefix': self.prefix}
+            if from_date:
+                params['from'] = from_date
+            if until_date:
+                params['until'] = until_date
+            if set_spec:
+                params['set'] = set_spec
+
+        while True:
+            with self.session.get(self.endpoint, params=params, stream=True,
+                                  timeout=REQUEST_TIMEOUT) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                page = ListResponse(response.raw)
+                pids = [
+                    {
+                        "pid": header.identifier,
+                        "datestamp": normalize_datestamp(header.datestamp),
+                        "deleted": header.deleted,
+                    }
+                    for header in page
+                ]
+
+            if page.error:
+                code, description = page.error
+                if code == 'noRecordsMatch':
+                    return
+                exc = getattr(oaiexceptions, code[0].upper() + code[1:],
+                              oaiexceptions.OAIError)
+                raise exc(description)
+
+            yield pids, page.resumption_token
+            if not page.resumption_token:
+                return
+            params = {'verb': 'ListIdentifiers', 'resumptionToken': page.resumption_token}
+
+    def list_sets(self):
+        """
+        Get the setSpecs of the endpoint's sets.
+
         Returns:
-            List[Dict]: list of dicts {"pid": <identifier>, "datestamp": <datestamp>}
+            List[str]: setSpec per set; empty if the endpoint has no sets
         """
-        # Pass from/until if provided
-        records = self.sickle.ListRecords(**{
-            'metadataPrefix': self.prefix,
-            'from':from_date,
-            'until':until_date
-            })
+        try:
+            return [s.setSpec for s in self.sickle.ListSets()]
+        except oaiexceptions.NoSetHierarchy:
+            return []
 
-        pids = []
-        for record in records:
-            pids.append({
-                "pid": record.header.identifier,
-                "datestamp": self._to_iso(record.header.datestamp),
-            })
+    def make_windows(self, from_date: str = None, until_date: str = None,
+                     slices: int = 1, sets: list[str] = None,
+                     granularity: str = DAY_GRANULARITY, unfiltered: bool = False):
+        """
+        Split a harvest into independent windows that can be traversed
+        concurrently: `slices` consecutive date ranges, for each set in
+        `sets` (or for the whole repository). A set nested in another one of
+        `sets` (`a:b` under `a`) is dropped, its records are listed with its
+        parent. `unfiltered` adds the ranges of the whole repository as
+        well, for records that are in none of `sets`.
+
+        The first window starts exactly at from_date (or the endpoint's
+        earliest datestamp) and the last one is left open-ended when
+        until_date is not given, so no record is missed. The bounds in
+        between are whole days, written at `granularity` so a request never
+        mixes granularities.
+
+        Returns:
+            List[Dict]: {"window_id", "from_date", "until_date", "set_spec"}
+        """
+        ranges = [(from_date, until_date)]
+        if slices > 1:
+            first = date.fromisoformat(
+                (from_date or self.capabilities["earliest_datestamp"])[:10])
+            last = date.fromisoformat(until_date[:10]) if until_date else date.today()
+            days = max(1, (last - first).days + 1)
+            slices = min(slices, days)
+            starts = [first + timedelta(days=days * i // slices) for i in range(slices)]
+            ends = [start - timedelta(days=1) for start in starts[1:]] + [last]
+            if granularity == SECONDS_GRANULARITY:
+                ranges = [(f"{start.isoformat()}T00:00:00Z", f"{end.isoformat()}T23:59:59Z")
+                          for start, end in zip(starts, ends)]
+            else:
+                ranges = [(start.isoformat(), end.isoformat()) for start, end in zip(starts, ends)]
+            ranges[0] = (from_date or ranges[0][0], ranges[0][1])
+            # keep the last window open: records may still arrive after `last`
+            ranges[-1] = (ranges[-1][0], until_date)
 
-        return pids
+        sets = outermost_sets(sets or [])
+        windows = []
+        for set_spec in sets + [None] if unfiltered or not sets else sets:
+            for start, end in ranges:
+                window_id = "" if len(ranges) == 1 and not sets else \
+                    f"{set_spec or '*'}:{start or ''}:{end or ''}"
+                windows.append({
+                    "window_id": window_id,
+                    "from_date": start,
+                    "until_date": end,
+                    "set_spec": set_spec,
+                })
+        return windows
 
     def _to_iso(self, datestamp: str) -> str:
         """
@@ -68,23 +223,13 @@ class OAIHarvester:
         Returns:
             str: ISO 8601 string "YYYY-MM-DDTHH:MM:SSZ"
         """
-        # Try parsing date-only
-        try:
-            dt = datetime.strptime(datestamp, "%Y-%m-%d")
-            return dt.strftime("%Y-%m-%dT%H:%M:%SZ")  # add time 00:00:00
-        except ValueError:
-            pass
-
-        # Try parsing datetime with seconds
-        try:
-            dt = datetime.strptime(datestamp, "%Y-%m-%dT%H:%M:%SZ")
-            return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
-        except ValueError:
-            pass
-
-        # Add more parsing formats if needed
-        raise ValueError(f"Unknown datestamp format: {datestamp}")
-
-
-        
+        return normalize_datestamp(datestamp)
 
+def outermost_sets(sets: list[str]) -> list[str]:
+    """
+    Drop the setSpecs that lie below another one of `sets` in the set
+    hierarchy (`a:b` below `a`), keeping the order of the rest.
+    """
+    specs = set(sets)
+    return [s for i, s in enumerate(sets) if s not in sets[:i] and not any(
+        s.startswith(parent + ":") for parent in specs if parent != s)]
@@ -0,0 +1,107 @@
+import re
+from collections import namedtuple
+from datetime import datetime, timezone
+from functools import lru_cache
+from xml.etree.ElementTree import iterparse
+
+OAI_NS = "{http://www.openarchives.org/OAI/2.0/}"
+
+_HEADER = OAI_NS + "header"
+_RECORD = OAI_NS + "record"
+_IDENTIFIER = OAI_NS + "identifier"
+_DATESTAMP = OAI_NS + "datestamp"
+_TOKEN = OAI_NS + "resumptionToken"
+_ERROR = OAI_NS + "error"
+
+_DATESTAMP_RE = re.compile(
+    r"(\d{4})-(\d{2})-(\d{2})(?:T(\d{2}):(\d{2}):(\d{2})Z)?"
+)
+
+DAY_GRANULARITY = "YYYY-MM-DD"
+SECONDS_GRANULARITY = "YYYY-MM-DDThh:mm:ssZ"
+
+OAIHeader = namedtuple("OAIHeader", ["identifier", "datestamp", "deleted"])
+
+
+@lru_cache(maxsize=65536)
+def normalize_datestamp(datestamp: str) -> str:
+    """
+    Convert an OAI-PMH datestamp to ISO 8601 "YYYY-MM-DDTHH:MM:SSZ".
+
+    Accepts day ("2023-07-01") and seconds ("2023-07-01T12:34:56Z")
+    granularity. Well-formed values take a precompiled regex path instead
+    of strptime, and results are cached: a page usually repeats few values.
+    """
+    match = _DATESTAMP_RE.fullmatch(datestamp)
+    if match:
+        # validates the ranges (month 13, Feb 30, hour 25, ...)
+        datetime(*(int(part) for part in match.groups() if part is not None))
+        if match.group(4) is None:
+            return f"{datestamp}T00:00:00Z"
+        return datestamp
+    # unpadded values such as "2023-7-1"
+    for fmt in ("%Y-%m-%d", "%Y-%m-%dT%H:%M:%SZ"):
+        try:
+            return datetime.strptime(datestamp, fmt).strftime("%Y-%m-%dT%H:%M:%SZ")
+        except ValueError:
+            pass
+    raise ValueError(f"Unknown datestamp format: {datestamp}")
+
+
+def format_datestamp(value: datetime, granularity: str = DAY_GRANULARITY) -> str:
+    """
+    Format a datetime as an OAI-PMH from/until argument at the endpoint's
+    granularity (as reported by Identify), in UTC.
+    """
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    if granularity == SECONDS_GRANULARITY:
+        return value.strftime("%Y-%m-%dT%H:%M:%SZ")
+    return value.date().isoformat()
+
+
+class ListResponse:
+    """
+    Streaming parser for a ListIdentifiers or ListRecords response.
+
+    Iterating yields an OAIHeader per record header, deleted ones
+    included, while the XML is read from `source` (a binary file-like
+    object). Each header (or record) element is discarded as soon as it is
+    consumed, so memory does not grow with the page size and record
+    metadata is never kept. `resumption_token` and `error` are set once
+    iteration is finished.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.resumption_token = None
+        self.complete_list_size = None
+        self.error = None
+
+    def __iter__(self):
+        container = None
+        depth = 0
+        for event, elem in iterparse(self.source, events=("start", "end")):
+            if event == "start":
+                depth += 1
+                # the verb element (e.g. ListIdentifiers) holds the items
+                if depth == 2:
+                    container = elem
+                continue
+            depth -= 1
+            tag = elem.tag
+            if tag == _HEADER:
+                yield OAIHeader(
+                    identifier=elem.findtext(_IDENTIFIER),
+                    datestamp=elem.findtext(_DATESTAMP),
+                    deleted=elem.get("status") == "deleted",
+                )
+                if depth == 2:
+                    container.clear()
+            elif tag == _RECORD and depth == 2:
+                container.clear()
+            elif tag == _TOKEN:
+                self.resumption_token = (elem.text or "").strip() or None
+                self.complete_list_size = elem.get("completeListSize")
+            elif tag == _ERROR:
+                self.error = (elem.get("code", "UNKNOWN"), elem.text or "")
@@ -1,76 +1,212 @@
-import filefetcher
+import os
 # from prefect import task
-from datetime import datetime
-from filemeta_harvester.oai.harvester import OAIHarvester 
-from filemeta_harvester.db.filestore import FileRecord, FileRawRecord, FileRawRecordStore, FileRecordStore, create_pg_engine
-from filemeta_harvester.db.pidstore import PIDStore
-from filemeta_harvester.config import load_config
-from time import sleep
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from functools import partial
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
+from filemeta_harvester.oai.parser import format_datestamp
+from filemeta_harvester.db.filestore import (FileRawRecord, FileRawRecordStore, FileRecordStore,
+                                             content_hash, file_rows)
+from filemeta_harvester.db.bulkload import InitialLoad
+from filemeta_harvester.db.connection import get_engine
+from filemeta_harvester.db.pidstore import PIDStore, PIDStatusWriter, default_worker_id
+from filemeta_harvester.db.schema import ensure_schema
+from filemeta_harvester.db.runstore import RunStore
+from filemeta_harvester.config import (HarvestConfig, PipelineConfig, load_cache_config,
+                                       load_metrics_config, load_storage_config)
+from filemeta_harvester.fetch.cache import ResponseCache
+from filemeta_harvester.fetch.retry import BREAKER, classify_error
+from filemeta_harvester.metrics.registry import METRICS
+from filemeta_harvester.metrics.profiler import SamplingProfiler
+from filemeta_harvester.tasks.pipeline import StagedPipeline
+
+# imported on first use (see _filefetcher): only processing needs it
+filefetcher = None
 
 
 # @task(log_prints=True)
 def initialize_db():
     """
-    Initialize the PID store schema in the database.
+    Bring the database schema up to date (see db.schema.migrate).
     """
 
-    db = load_config()
-
-    dsn = f"host={db.host} dbname={db.name} user={db.user} password={db.password} port={db.port}"
-    store = PIDStore(dsn)
-    store.init_schema()
+    ensure_schema(get_engine())
     print("Harvest schema initialized.")
 
 # @task(log_prints=True)
 def initialize_file_db():
     """
-    Initialize the file record store schema in the database.
+    Bring the database schema up to date; the file tables are part of the
+    same versioned schema as the harvest tables.
     """
 
-    db = load_config()
-    pg_dsn = f"postgresql://{db.user}:{db.password}@{db.host}:{db.port}/{db.name}"
-    file_store = FileRecordStore(create_pg_engine(pg_dsn))
-    file_store.init_schema()
+    ensure_schema(get_engine())
     print("File schema initialized.")
-    raw_file_store = FileRawRecordStore(create_pg_engine(pg_dsn))
-    raw_file_store.init_schema()
-    print("Raw File schema initialized.")
 
 # @task(log_prints=True)
-def check_endpoint(endpoint_url, name, prefix):
+def check_endpoint(endpoint_url, name, prefix, endpoint_id=None, max_age=0):
     """
     Check the health of the OAI-PMH endpoint by performing an Identify request.
+
+    With an `endpoint_id` and a `max_age` (seconds), a probe of the
+    endpoint saved less than `max_age` ago is trusted instead.
     """
-    
-    harvester = OAIHarvester(endpoint_url, prefix)
-    identity = harvester.identify()
-    print(f"Identified endpoint '{name}': {identity}")
+
+    harvester = _harvester(endpoint_url, prefix, endpoint_id, max_age)
+    print(f"Identified endpoint '{name}': {harvester.capabilities}")
     return True
 
+def _harvester(endpoint_url, prefix, endpoint_id=None, max_age=0, store=None):
+    """
+    An OAIHarvester for the endpoint, built from the capabilities saved in
+    its harvest state while they are younger than `max_age` seconds, and
+    probing the endpoint (then saving the result) otherwise.
+    """
+    # sickle is only imported by the processes that talk OAI-PMH
+    from filemeta_harvester.oai.harvester import OAIHarvester
+    if endpoint_id is None:
+        return OAIHarvester(endpoint_url, prefix)
+    store = store or PIDStore(get_engine())
+    capabilities = store.get_capabilities(endpoint_id, max_age) if max_age else None
+    if capabilities and prefix not in capabilities["formats"]:
+        # the prefix may have been added since: probe again before failing
+        capabilities = None
+    harvester = OAIHarvester(endpoint_url, prefix, capabilities=capabilities)
+    if capabilities is None:
+        store.save_capabilities(endpoint_id, harvester.capabilities)
+    return harvester
+
+@contextmanager
+def _recorded_run(endpoint_id, kind, worker_id=None):
+    """
+    Save a harvest_runs summary of the block: its outcome and how the
+    endpoint's counters and stage timings changed while it ran. With a
+    [metrics] profile_dir the block is also profiled.
+    """
+    metrics_config = load_metrics_config()
+    started_at = datetime.now(timezone.utc)
+    before = METRICS.snapshot(endpoint_id)
+    profiler = None
+    if metrics_config.profile_dir:
+        path = os.path.join(metrics_config.profile_dir,
+                            f"{endpoint_id}-{kind}-{started_at:%Y%m%dT%H%M%S}.folded")
+        profiler = SamplingProfiler(path, metrics_config.profile_interval)
+        profiler.start()
+    status, error = "ok", None
+    try:
+        yield
+    except BaseException as e:
+        status, error = "failed", repr(e)
+        raise
+    finally:
+        if profiler:
+            profiler.stop()
+            print(f"Profile written to {profiler.path}")
+        after = METRICS.snapshot(endpoint_id)
+        counters = {series: value - before["counters"].get(series, 0)
+                    for series, value in after["counters"].items()
+                    if value != before["counters"].get(series, 0)}
+        stages = {}
+        for stage, totals in after["stages"].items():
+            previous = before["stages"].get(stage, {"count": 0, "seconds": 0.0})
+            if totals["count"] != previous["count"]:
+                stages[stage] = {"count": totals["count"] - previous["count"],
+                                 "seconds": totals["seconds"] - previous["seconds"]}
+        try:
+            RunStore(get_engine()).save_run(endpoint_id, kind, worker_id, started_at,
+                                            datetime.now(timezone.utc), status,
+                                            counters, stages, error)
+        except Exception as e:
+            print(f"Error saving the run summary for endpoint {endpoint_id}: {e}")
+
 # @task(log_prints=True)
-def fetch_pids(endpoint_url, endpoint_id, name, prefix):
+def fetch_pids(endpoint_url, endpoint_id, name, prefix,
+               harvest_config: HarvestConfig | None = None):
     """
     Fetch PIDs from the OAI-PMH endpoint starting from the last done timestamp.
+
+    The harvest is split into `windows` date ranges (per OAI set if `sets`
+    is configured) traversed by `parallelism` threads. Each window keeps
+    its own checkpoint, so an interrupted harvest only resumes the windows
+    that did not finish.
     """
     print(f"Fetching PIDs from endpoint '{name}' ({endpoint_url}) with prefix '{prefix}'")
-    sleep(60)  # DEV
-    return 
-
-    db = load_config()
-    dsn = f"host={db.host} dbname={db.name} user={db.user} password={db.password} port={db.port}"
-    store = PIDStore(dsn)
-    last_done = store.get_most_recent_timestamp(endpoint_id)
-    if last_done:
-        print(f"Resuming from last done timestamp: {last_done}")
-        dt = datetime.fromisoformat(last_done)
-        #last_done = f"{dt.date().isoformat()}T00:00:00Z"
-        last_done = dt.date().isoformat()
-    harvester = OAIHarvester(endpoint_url, prefix)
-    print(f"Last done timestamp: {last_done}")
-    pids = harvester.get_pid_list(from_date=last_done)
-    store.save_pids(endpoint_id, pids)
-    print(f"Fetched {len(pids)} PIDs")
-    return len(pids)
+    with _recorded_run(endpoint_id, "fetch_pids"):
+        return _fetch_pids(endpoint_url, endpoint_id, prefix, harvest_config)
+
+def _fetch_pids(endpoint_url, endpoint_id, prefix, harvest_config):
+    harvest_config = harvest_config or HarvestConfig()
+    store = PIDStore(get_engine())
+    harvester = _harvester(endpoint_url, prefix, endpoint_id, harvest_config.probe_ttl, store)
+
+    windows = store.get_checkpoints(endpoint_id)
+    if windows:
+        print(f"Resuming {len(windows)} unfinished window(s) of an interrupted harvest")
+    else:
+        state = store.get_state(endpoint_id)
+        granularity = state["granularity"]
+        if not granularity:
+            granularity = harvester.granularity()
+            store.set_granularity(endpoint_id, granularity)
+        last_done = None
+        if state["watermark"]:
+            # from is inclusive: only records stamped exactly at the
+            # watermark (or on its day, at day granularity) are listed again
+            last_done = format_datestamp(state["watermark"], granularity)
+            print(f"Resuming from last done timestamp: {last_done}")
+        print(f"Last done timestamp: {last_done}")
+        sets = harvest_config.sets
+        # the sets an endpoint lists need not cover all its records: unless
+        # configured so, the whole repository is listed alongside them
+        unfiltered = False
+        if sets is True:
+            sets = harvester.list_sets()
+            unfiltered = not harvest_config.sets_cover_repository
+        windows = harvester.make_windows(from_date=last_done,
+                                         slices=harvest_config.windows,
+                                         sets=sets or None,
+                                         granularity=granularity,
+                                         unfiltered=unfiltered)
+        store.start_windows(endpoint_id, windows)
+
+    with ThreadPoolExecutor(max_workers=harvest_config.parallelism) as pool:
+        counts = pool.map(lambda w: _harvest_window(harvester, store, endpoint_id, w), windows)
+        count = sum(counts)
+    store.finish_harvest(endpoint_id)
+    print(f"Fetched {count} PIDs")
+    return count
+
+def _harvest_window(harvester, store, endpoint_id, window):
+    """
+    Walk the ListIdentifiers pages of one window, checkpointing each page.
+    An expired resumption token restarts the window from its start.
+    """
+    from sickle import oaiexceptions
+    try:
+        return _save_pid_pages(harvester, store, endpoint_id, window,
+                               window.get("resumption_token"))
+    except oaiexceptions.BadResumptionToken:
+        print(f"Resumption token expired, restarting window '{window['window_id']}'")
+        return _save_pid_pages(harvester, store, endpoint_id, window)
+
+def _save_pid_pages(harvester, store, endpoint_id, window, resumption_token=None):
+    count = 0
+    pages = harvester.get_pid_pages(from_date=window["from_date"],
+                                    until_date=window["until_date"],
+                                    resumption_token=resumption_token,
+                                    set_spec=window["set_spec"])
+    while True:
+        # the request and the parsing of the page
+        with METRICS.timer("oai_page", endpoint_id):
+            page = next(pages, None)
+        if page is None:
+            return count
+        pids, next_token = page
+        METRICS.inc("harvest_oai_pages_total", endpoint=endpoint_id)
+        METRICS.inc("harvest_pids_listed_total", len(pids), endpoint=endpoint_id)
+        with METRICS.timer("db_save_pids", endpoint_id):
+            count += store.save_pid_page(endpoint_id, pids, next_token, window)
 
 def strip_pid(pid):
     """
@@ -90,60 +226,231 @@ def strip_pid(pid):
     return pid
 
 # @task(log_prints=True)
-def process_pending_pids(endpoint_id):
+def process_pending_pids(endpoint_id, pipeline_config: PipelineConfig | None = None):
     """
     Process pending PIDs: fetch file records and create file entries in the database.
+
+    PIDs are claimed in leased batches, so several workers can share an
+    endpoint's backlog. They go through a staged pipeline:
+    `fetch_concurrency` threads fetch datasets, one thread builds the
+    records and the calling thread writes them in batches of
+    `write_batch_size`.
+
+    A failed PID is classified (see fetch.retry.classify_error): transient
+    failures are retried later with exponential backoff, permanent ones
+    and those out of attempts get status 'error'. When the circuit of the
+    endpoint's file host opens, no further PIDs are claimed this run.
+
+    The first harvest of an endpoint (see PipelineConfig.initial_load) is
+    written through db.bulkload.InitialLoad: batches are staged with COPY
+    and merged every `initial_load_merge_rows` file rows, together with
+    their 'done' statuses.
     """
     print(f"Processing pending PIDs for endpoint ID: {endpoint_id}")
-    return # DEV
-
-    db = load_config()
-    dsn = f"host={db.host} dbname={db.name} user={db.user} password={db.password} port={db.port}"
-    store = PIDStore(dsn)
-    pending = store.get_pending_pids(endpoint_id)
-    pg_dsn = f"postgresql://{db.user}:{db.password}@{db.host}:{db.port}/{db.name}"
-    file_store = FileRecordStore(create_pg_engine(pg_dsn))
-    raw_file_store = FileRawRecordStore(create_pg_engine(pg_dsn))
-    failed_cnt = 0
-    done_cnt = 0
-
-    for pid in pending:
-        try:
-            files = filefetcher.file_records(strip_pid(pid))
-            raw_files = filefetcher.file_raw_records(strip_pid(pid))
-            raw_record = FileRawRecord(
-                dataset_pid=strip_pid(pid),
-                raw_metadata=raw_files,
-            )
-            raw_file_store.create_one(raw_record)
-            record_list = []
-            for f in files:
-                record = FileRecord(
-                    name=f.get("name"),
-                    dataset_pid=f.get("dataset_pid"),
-                    link=f.get("link"),
-                    size=int(f.get("size")),
-                    mime_type=f.get("mime_type"),
-                    ext=f.get("ext"),
-                    checksum_value=f.get("checksum_value"),
-                    checksum_type=f.get("checksum_type"),
-                    access_request=f.get("access_request"),
-                    publication_date=f.get("publication_date"),
-                    embargo=f.get("embargo"),
-                    file_pid=f.get("file_pid"),
-                )
-                record_list.append(record)
-            file_store.create_many(record_list)
+    worker_id = default_worker_id()
+    with _recorded_run(endpoint_id, "process_pending_pids", worker_id):
+        return _process_pending_pids(endpoint_id, pipeline_config, worker_id)
+
+def _process_pending_pids(endpoint_id, pipeline_config, worker_id):
+    pipeline_config = pipeline_config or PipelineConfig()
+    engine = get_engine()
+    store = PIDStore(engine)
+    store.reclaim_expired_leases(endpoint_id)
+    counts = {"done": 0, "failed": 0, "unchanged": 0, "retry": 0, "duplicate": 0}
+    pending = _claim_pids(store, endpoint_id, worker_id, pipeline_config, counts)
+    file_store = FileRecordStore(engine)
+    raw_file_store = FileRawRecordStore(
+        engine, compact=load_storage_config().raw_metadata == "blob")
+
+    cache_config = load_cache_config()
+    cache = ResponseCache(cache_config.directory, max_bytes=cache_config.max_bytes)
+    status_writer = PIDStatusWriter(store, endpoint_id, retry_policy={
+        "max_attempts": pipeline_config.max_attempts,
+        "base_delay": pipeline_config.retry_base_delay,
+        "max_delay": pipeline_config.retry_max_delay,
+    })
 
+    initial_load = pipeline_config.initial_load
+    if initial_load == "auto":
+        initial_load = not store.has_pids(endpoint_id, "done")
+    loader = None
+    # every lease this run holds was taken or renewed after this time
+    leases_renewed_at = monotonic()
+
+    def renew_leases():
+        # staged PIDs stay claimed until the next merge, which can take
+        # longer than a lease on a slow endpoint; renewed at half the lease
+        # so other workers do not claim them again meanwhile
+        nonlocal leases_renewed_at
+        if monotonic() - leases_renewed_at < pipeline_config.lease_seconds / 2:
+            return
+        leases_renewed_at = monotonic()
+        store.renew_leases(endpoint_id, worker_id, pipeline_config.lease_seconds)
+
+    def merge_staged():
+        nonlocal loader
+        pids = list(loader.staged_pids)
+        try:
+            with METRICS.timer("db_merge", endpoint_id):
+                files = loader.merge(before_commit=lambda conn: status_writer.flush(
+                    connection=conn, transitions=[(pid, "done") for pid in pids]))
         except Exception as e:
-            print(f"Error creating file record for PID {pid}: {e}")
-            store.mark_failed(endpoint_id, pid)
-            failed_cnt += 1
-            continue
+            # the staged PIDs stay claimed and are released as pending below
+            print(f"Initial load merge failed, writing batches one by one from now on: {e}")
+            loader.discard()
+            loader = None
+            return
+        counts["done"] += len(pids)
+        METRICS.inc("harvest_datasets_total", len(pids), endpoint=endpoint_id, outcome="done")
+        for change, count in files.items():
+            METRICS.inc("harvest_files_total", count, endpoint=endpoint_id, change=change)
 
-        store.mark_done(endpoint_id, pid)
-        done_cnt += 1
-        # DEV
-        break
-    return {"done": done_cnt, "failed": failed_cnt}
+    def write_datasets(datasets):
+        if loader is not None:
+            with METRICS.timer("db_stage", endpoint_id):
+                loader.add(datasets)
+            return
+        # files and 'done' statuses commit in one transaction
+        with engine.begin() as conn:
+            with METRICS.timer("db_read_hashes", endpoint_id):
+                stored = raw_file_store.get_hashes(
+                    [raw.dataset_pid for _, (raw, _) in datasets], connection=conn)
+            changed = [(raw, files) for _, (raw, files) in datasets
+                       if stored.get(raw.dataset_pid) != raw.content_hash]
+            with METRICS.timer("db_write_raw", endpoint_id):
+                raw_file_store.upsert_many([raw for raw, _ in changed], connection=conn)
+            with METRICS.timer("db_write_files", endpoint_id):
+                files = file_store.sync_datasets(
+                    {raw.dataset_pid: files for raw, files in changed}, connection=conn)
+            with METRICS.timer("db_status", endpoint_id):
+                status_writer.flush(connection=conn,
+                                    transitions=[(pid, "done") for pid, _ in datasets])
+        counts["done"] += len(datasets)
+        counts["unchanged"] += len(datasets) - len(changed)
+        METRICS.inc("harvest_datasets_total", len(changed), endpoint=endpoint_id, outcome="done")
+        METRICS.inc("harvest_datasets_total", len(datasets) - len(changed),
+                    endpoint=endpoint_id, outcome="unchanged")
+        for change, count in files.items():
+            METRICS.inc("harvest_files_total", count, endpoint=endpoint_id, change=change)
 
+    def fail(pid, error):
+        failure = classify_error(error)
+        print(f"Error creating file record for PID {pid} ({failure.error_class}): {error}")
+        status_writer.add_failure(pid, failure)
+        outcome = "retry" if failure.retryable else "failed"
+        counts[outcome] += 1
+        METRICS.inc("harvest_datasets_total", endpoint=endpoint_id, outcome=outcome)
+        METRICS.inc("harvest_errors_total", endpoint=endpoint_id,
+                    error_class=failure.error_class)
+
+    def write_batch(batch):
+        succeeded = [(pid, records) for pid, records, error in batch if error is None]
+        for pid, _, error in batch:
+            if error is not None:
+                fail(pid, error)
+        if not succeeded:
+            return
+        try:
+            write_datasets(succeeded)
+        except Exception:
+            # isolate the dataset(s) that made the batch fail
+            for dataset in succeeded:
+                try:
+                    write_datasets([dataset])
+                except Exception as e:
+                    fail(dataset[0], e)
+        if loader is not None and loader.staged_rows >= loader.merge_rows:
+            merge_staged()
+        elif loader is not None and loader.staged_pids:
+            renew_leases()
+
+    pipeline = StagedPipeline(
+        fetch=METRICS.timed(partial(_fetch_dataset, cache=cache, endpoint_id=endpoint_id),
+                            "fetch", endpoint_id),
+        transform=METRICS.timed(_build_records, "transform", endpoint_id),
+        write_batch=write_batch,
+        fetch_workers=pipeline_config.fetch_concurrency,
+        queue_size=pipeline_config.queue_size,
+        batch_size=pipeline_config.write_batch_size,
+    )
+    bulk = InitialLoad(engine, merge_rows=pipeline_config.initial_load_merge_rows,
+                       defer_indexes=pipeline_config.initial_load_defer_indexes,
+                       blobs=raw_file_store.blobs if raw_file_store.compact else None) \
+        if initial_load else nullcontext()
+    try:
+        with bulk as loader:
+            if loader is not None:
+                print(f"Initial load of endpoint {endpoint_id}: staging file records in bulk")
+            pipeline.run(_while_circuit_closed(pending, endpoint_id))
+            if loader is not None:
+                merge_staged()
+    finally:
+        with METRICS.timer("db_status", endpoint_id):
+            status_writer.close()
+        store.release_pids(endpoint_id, worker_id)
+    return counts
+
+def _claim_pids(store, endpoint_id, worker_id, pipeline_config, counts):
+    """
+    Yield pending PIDs, claiming a batch at a time. PIDs whose dataset
+    another endpoint already harvested at the same datestamp are recorded
+    as duplicates instead of being fetched again.
+    """
+    while pids := store.claim_pids(endpoint_id, worker_id, pipeline_config.queue_size,
+                                   pipeline_config.lease_seconds):
+        duplicates = store.mark_duplicates(endpoint_id, pids)
+        if duplicates:
+            counts["duplicate"] += len(duplicates)
+            METRICS.inc("harvest_datasets_total", len(duplicates), endpoint=endpoint_id,
+                        outcome="duplicate")
+        yield from (pid for pid in pids if pid not in duplicates)
+
+def _while_circuit_closed(pids, endpoint_id):
+    # PIDs left claimed when this stops are released at the end of the run
+    for pid in pids:
+        if BREAKER.is_open(endpoint_id):
+            print(f"Pausing endpoint {endpoint_id}: its file host is failing")
+            return
+        yield pid
+
+def _filefetcher():
+    global filefetcher
+    if filefetcher is None:
+        import filefetcher as module
+        filefetcher = module
+    return filefetcher
+
+def _fetch_dataset(pid, cache, endpoint_id):
+    """
+    Fetch the file listing of a dataset. Runs in the pipeline's fetch workers.
+
+    filefetcher retrieves the same listing for the raw and the normalized
+    records; within `cache.dataset` the second call is served from the
+    response of the first, so both describe one retrieval. The call is
+    guarded by the circuit breaker of the hosts the endpoint's datasets are
+    fetched from; a success closes the circuits of the hosts that answered.
+    """
+    dataset_pid = strip_pid(pid)
+    with BREAKER.guard(endpoint_id) as answered:
+        with cache.dataset(dataset_pid) as hosts:
+            fetcher = _filefetcher()
+            raw_files = fetcher.file_raw_records(dataset_pid)
+            files = fetcher.file_records(dataset_pid)
+        answered |= hosts
+    return files, raw_files
+
+def _build_records(pid, fetched):
+    """
+    Build the records of a fetched dataset. Files become FileRows, which
+    the bulk writers take as they are.
+
+    Returns:
+        Tuple[FileRawRecord, List[FileRow]]
+    """
+    files, raw_files = fetched
+    raw_record = FileRawRecord(
+        dataset_pid=strip_pid(pid),
+        raw_metadata=raw_files,
+        content_hash=content_hash(raw_files),
+    )
+    return raw_record, file_rows(files)
@@ -0,0 +1,145 @@
+import threading
+from queue import Queue, Empty, Full
+from time import monotonic
+
+_DONE = object()
+_POLL_INTERVAL = 0.1
+
+
+class StagedPipeline:
+    """
+    Run items through three stages connected by bounded queues:
+
+    - fetch: `fetch_workers` threads calling `fetch(item)`
+    - transform: one thread calling `transform(item, fetched)`
+    - write: the calling thread, passing batches of
+      `(item, transformed, error)` tuples to `write_batch(batch)`
+
+    Because the queues are bounded, a slow stage blocks the stages in
+    front of it instead of letting work pile up in memory. An exception
+    raised by `fetch` or `transform` is handed to the write stage as the
+    `error` of its item. An exception raised by `write_batch` (or by
+    iterating over the input) stops the whole pipeline and is re-raised
+    by `run`.
+    """
+
+    def __init__(self, fetch, transform, write_batch, fetch_workers: int = 4,
+                 queue_size: int = 100, batch_size: int = 50,
+                 flush_interval: float = 5.0):
+        self.fetch = fetch
+        self.transform = transform
+        self.write_batch = write_batch
+        self.fetch_workers = max(1, fetch_workers)
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+    def run(self, items):
+        """
+        Process `items` (any iterable) and block until all of them are written.
+        """
+        self._stop = threading.Event()
+        self._errors = []
+        fetch_q = Queue(self.queue_size)
+        transform_q = Queue(self.queue_size)
+        write_q = Queue(self.queue_size)
+
+        threads = [threading.Thread(target=self._guard, args=(self._feed, items, fetch_q),
+                                    daemon=True)]
+        for _ in range(self.fetch_workers):
+            threads.append(threading.Thread(target=self._guard,
+                                            args=(self._fetch_stage, fetch_q, transform_q),
+                                            daemon=True))
+        threads.append(threading.Thread(target=self._guard,
+                                        args=(self._transform_stage, transform_q, write_q),
+                                        daemon=True))
+        for t in threads:
+            t.start()
+        try:
+            self._guard(self._write_stage, write_q)
+        finally:
+            if self._errors:
+                self._stop.set()
+            for t in threads:
+                t.join()
+        if self._errors:
+            raise self._errors[0]
+
+    def _guard(self, target, *args):
+        try:
+            target(*args)
+        except BaseException as e:
+            self._errors.append(e)
+            self._stop.set()
+
+    def _put(self, q, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=_POLL_INTERVAL)
+                return
+            except Full:
+                continue
+
+    def _get(self, q, timeout=None):
+        deadline = None if timeout is None else monotonic() + timeout
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=_POLL_INTERVAL)
+            except Empty:
+                if deadline is not None and monotonic() >= deadline:
+                    return None
+        return _DONE
+
+    def _feed(self, items, fetch_q):
+        try:
+            for item in items:
+                self._put(fetch_q, item)
+                if self._stop.is_set():
+                    return
+        finally:
+            for _ in range(self.fetch_workers):
+                self._put(fetch_q, _DONE)
+
+    def _fetch_stage(self, fetch_q, transform_q):
+        while (item := self._get(fetch_q)) is not _DONE:
+            try:
+                result = (item, self.fetch(item), None)
+            except Exception as e:
+                result = (item, None, e)
+            self._put(transform_q, result)
+        self._put(transform_q, _DONE)
+
+    def _transform_stage(self, transform_q, write_q):
+        finished = 0
+        while finished < self.fetch_workers:
+            result = self._get(transform_q)
+            if result is _DONE:
+                if self._stop.is_set():
+                    return
+                finished += 1
+                continue
+            item, fetched, error = result
+            if error is None:
+                try:
+                    result = (item, self.transform(item, fetched), None)
+                except Exception as e:
+                    result = (item, None, e)
+            self._put(write_q, result)
+        self._put(write_q, _DONE)
+
+    def _write_stage(self, write_q):
+        batch = []
+        last_flush = monotonic()
+        while True:
+            result = self._get(write_q, timeout=self.flush_interval)
+            if result is _DONE:
+                break
+            if result is not None:
+                batch.append(result)
+            if batch and (len(batch) >= self.batch_size
+                          or monotonic() - last_flush >= self.flush_interval):
+                self.write_batch(batch)
+                batch = []
+                last_flush = monotonic()
+        if batch and not self._stop.is_set():
+            self.write_batch(batch)
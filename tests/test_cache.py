@@ -0,0 +1,120 @@
+import os
+
+import pytest
+import requests
+
+from filemeta_harvester.fetch import cache as cache_module
+from filemeta_harvester.fetch.cache import ResponseCache
+
+URL = "https://files.example.org/api/datasets/doi:10.1/a"
+
+
+class Origin:
+    """Stand-in for the network behind HTTPAdapter.send."""
+
+    def __init__(self, body=b'{"files": []}', headers=None):
+        self.body = body
+        self.headers = {"ETag": '"v1"'} if headers is None else headers
+        self.status = 200
+        self.requests = []
+
+    def __call__(self, adapter, request, **kwargs):
+        self.requests.append(dict(request.headers))
+        response = requests.Response()
+        response.url = request.url
+        response.request = request
+        response._content_consumed = True
+        etag = request.headers.get("If-None-Match")
+        if etag is not None and etag == self.headers.get("ETag"):
+            response.status_code = 304
+            response._content = b""
+        else:
+            response.status_code = self.status
+            response.headers.update(self.headers)
+            response._content = self.body
+        return response
+
+
+@pytest.fixture
+def origin(monkeypatch):
+    origin = Origin()
+    monkeypatch.setattr(cache_module, "_original_send", origin)
+    return origin
+
+
+def test_one_retrieval_per_dataset(origin):
+    cache = ResponseCache()
+    session = requests.Session()
+
+    with cache.dataset("10.1/a"):
+        first = session.get(URL).json()
+        second = requests.get(URL).json()
+    requests.get(URL)
+
+    assert first == second == {"files": []}
+    # two GETs in the scope, one outside it
+    assert len(origin.requests) == 2
+
+
+def test_hosts_that_answered_are_reported(origin):
+    with ResponseCache().dataset("10.1/a") as hosts:
+        requests.get(URL)
+    assert hosts == {"files.example.org"}
+
+    origin.body, origin.headers = b"", {}
+    with ResponseCache().dataset("10.1/a") as hosts:
+        origin.status = 503
+        requests.get(URL)
+    assert hosts == set()
+
+
+def test_disk_entries_are_revalidated(origin, tmp_path):
+    with ResponseCache(tmp_path).dataset("10.1/a"):
+        requests.get(URL)
+
+    with ResponseCache(tmp_path).dataset("10.1/a"):
+        assert requests.get(URL).json() == {"files": []}
+    assert origin.requests[-1]["If-None-Match"] == '"v1"'
+
+    origin.body, origin.headers = b'{"files": [1]}', {"ETag": '"v2"'}
+    with ResponseCache(tmp_path).dataset("10.1/a"):
+        assert requests.get(URL).json() == {"files": [1]}
+    with ResponseCache(tmp_path).dataset("10.1/a"):
+        assert requests.get(URL).json() == {"files": [1]}
+    assert origin.requests[-1]["If-None-Match"] == '"v2"'
+    assert len(origin.requests) == 4
+
+
+def test_responses_without_validators_are_not_stored(origin, tmp_path):
+    origin.headers = {}
+
+    with ResponseCache(tmp_path).dataset("10.1/a"):
+        requests.get(URL)
+
+    assert not list(tmp_path.iterdir())
+
+
+def test_unreadable_entries_are_fetched_again(origin, tmp_path):
+    with ResponseCache(tmp_path).dataset("10.1/a"):
+        requests.get(URL)
+    for path in tmp_path.glob("*/*/*.json"):
+        path.write_text("{not json")
+
+    with ResponseCache(tmp_path).dataset("10.1/a"):
+        assert requests.get(URL).json() == {"files": []}
+    assert "If-None-Match" not in origin.requests[-1]
+
+
+def test_prune_evicts_least_recently_used_datasets(origin, tmp_path):
+    origin.body = b"x" * 1000
+    cache = ResponseCache(tmp_path, max_bytes=10 ** 6)
+    for i, pid in enumerate(["10.1/old", "10.1/new"]):
+        with cache.dataset(pid):
+            requests.get(f"{URL}{i}")
+    old, new = sorted(tmp_path.glob("*/*"), key=lambda path: path.stat().st_mtime)
+    os.utime(old, (0, 0))
+
+    cache.max_bytes = 2000
+    cache.prune()
+
+    assert not old.exists() and new.exists()
@@ -0,0 +1,61 @@
+import json
+from datetime import datetime
+from pathlib import Path
+
+from filemeta_harvester.export.exporter import TABLES, _JsonlWriter, _PartitionedWriter
+
+RAW_COLUMNS = TABLES["file_raw_metadata"]
+
+
+def read_jsonl(path):
+    return [json.loads(line) for line in Path(path).read_text(encoding="utf-8").splitlines()]
+
+
+def test_jsonl_splices_json_text_unparsed(tmp_path):
+    writer = _JsonlWriter(tmp_path / "part", RAW_COLUMNS, None)
+    stamp = datetime(2024, 5, 1, 12, 30)
+    writer.write([
+        (1, "10.1/a", '{"files": [{"name": "a \\"b\\".csv", "size": 3}]}', "h1", stamp),
+        (2, "10.1/b", None, "h2", stamp),
+        (3, "10.1/ü", '[]', None, None),
+    ])
+    writer.close()
+
+    rows = read_jsonl(writer.path)
+    assert rows[0] == {
+        "id": 1, "dataset_pid": "10.1/a", "content_hash": "h1",
+        "last_updated": "2024-05-01T12:30:00",
+        "raw_metadata": {"files": [{"name": 'a "b".csv', "size": 3}]},
+    }
+    assert rows[1]["raw_metadata"] is None
+    assert rows[2]["dataset_pid"] == "10.1/ü"
+    assert rows[2]["raw_metadata"] == []
+
+
+def test_partition_switches_within_and_across_batches(tmp_path):
+    writer = _PartitionedWriter(tmp_path, "endpoint", "jsonl", RAW_COLUMNS, None)
+    writer.write([
+        ("a", 1, "10.1/1", "{}", "h", None),
+        ("a", 2, "10.1/2", "{}", "h", None),
+        ("b", 3, "10.1/3", "{}", "h", None),
+    ])
+    writer.write([
+        ("b", 4, "10.1/4", "{}", "h", None),
+        ("c", 5, "10.1/5", "{}", "h", None),
+    ])
+    writer.close()
+
+    assert [Path(f).parent.name for f in writer.files] == [
+        "endpoint=a", "endpoint=b", "endpoint=c"]
+    ids = {Path(f).parent.name: [row["id"] for row in read_jsonl(f)] for f in writer.files}
+    assert ids == {"endpoint=a": [1, 2], "endpoint=b": [3, 4], "endpoint=c": [5]}
+
+
+def test_unpartitioned_rows_share_one_file(tmp_path):
+    writer = _PartitionedWriter(tmp_path, None, "jsonl", RAW_COLUMNS, None)
+    writer.write([(None, 1, "10.1/1", "{}", "h", None)])
+    writer.write([(None, 2, "10.1/2", "{}", "h", None)])
+    writer.close()
+
+    assert [Path(f).parent for f in writer.files] == [tmp_path]
+    assert [row["id"] for row in read_jsonl(writer.files[0])] == [1, 2]
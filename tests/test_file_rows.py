@@ -0,0 +1,102 @@
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+from filemeta_harvester.db.filestore import (FILE_KEY, FILE_VALUES, FileRecord, FileRow,
+                                             file_fingerprint, file_rows, to_bool, to_int,
+                                             to_utc_datetime)
+
+
+def listing(**values):
+    return {"dataset_pid": "10.1/a", "name": "a.csv", "link": "https://x/a", **values}
+
+
+def test_file_rows_normalise_column_by_column():
+    rows = file_rows([
+        listing(size=" 12 ", access_request="true", publication_date="2023-07-01",
+                embargo="2024-01-01T10:00:00+02:00", mime_type="text/csv"),
+        listing(name="b.csv", size=7, access_request=0, publication_date="2023-07-01"),
+        listing(name="c.csv", size="n/a", access_request=None, publication_date=None),
+    ])
+
+    assert [type(row) for row in rows] == [FileRow] * 3
+    assert [row.size for row in rows] == [12, 7, None]
+    assert [row.access_request for row in rows] == [True, False, None]
+    assert rows[0].publication_date == datetime(2023, 7, 1)
+    assert rows[0].embargo == datetime(2024, 1, 1, 8)
+    assert rows[2].publication_date is None
+    assert rows[0].mime_type == "text/csv" and rows[1].mime_type is None
+
+
+def test_file_rows_reject_unparseable_values():
+    with pytest.raises(ValueError):
+        file_rows([listing(publication_date="yesterday")])
+    with pytest.raises(ValueError):
+        file_rows([listing(access_request="maybe")])
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, None), (5, 5), (5.0, 5), ("  42 ", 42), ("", None), ("4.5", None), ([], None),
+])
+def test_to_int(value, expected):
+    assert to_int(value) == expected
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, None), (True, True), ("Yes", True), ("off", False), ("0", False), ("", None),
+    (1, True), (0, False),
+])
+def test_to_bool(value, expected):
+    assert to_bool(value) is expected
+
+
+def test_to_utc_datetime():
+    # naive UTC, as the timestamp columns store it
+    assert to_utc_datetime(None) is None
+    assert to_utc_datetime(" ") is None
+    assert to_utc_datetime(date(2023, 7, 1)) == datetime(2023, 7, 1)
+    assert to_utc_datetime(datetime(2023, 7, 1, 12)) == datetime(2023, 7, 1, 12)
+    assert to_utc_datetime(datetime(2023, 7, 1, 12, tzinfo=timezone(timedelta(hours=2)))) \
+        == datetime(2023, 7, 1, 10)
+    assert to_utc_datetime("2023-07-01T12:00:00Z").tzinfo is None
+
+
+def file_records(files):
+    # the per-record path file_rows replaced
+    return [FileRecord(name=f.get("name"), dataset_pid=f.get("dataset_pid"), link=f.get("link"),
+                       size=int(f.get("size")), mime_type=f.get("mime_type"), ext=f.get("ext"),
+                       checksum_value=f.get("checksum_value"),
+                       checksum_type=f.get("checksum_type"),
+                       access_request=f.get("access_request"),
+                       publication_date=f.get("publication_date"), embargo=f.get("embargo"),
+                       file_pid=f.get("file_pid"))
+            for f in files]
+
+
+def stored(record):
+    # the values the timestamp columns keep, normalised by the model
+    values = {c: getattr(record, c) for c in FILE_KEY + FILE_VALUES}
+    for c in ("publication_date", "embargo"):
+        values[c] = FileRecord.normalise_datetime(values[c])
+    return values
+
+
+def test_file_rows_match_the_file_record_path():
+    utc, cest = timezone.utc, timezone(timedelta(hours=2))
+    files = [
+        listing(size=12, mime_type="text/csv", ext="csv", checksum_value="ab",
+                checksum_type="MD5", access_request=False,
+                publication_date=datetime(2023, 7, 1, tzinfo=utc), embargo=None,
+                file_pid="10.1/a/1"),
+        listing(name="b.csv", size=0, access_request=True,
+                publication_date=datetime(2023, 7, 1, 1, tzinfo=cest),
+                embargo=datetime(2030, 1, 1, tzinfo=utc)),
+        listing(name="c.csv", size=7, publication_date=datetime(2023, 7, 1, 12)),
+    ]
+
+    rows = file_rows(files)
+    expected = [stored(record) for record in file_records(files)]
+
+    assert [row._asdict() for row in rows] == expected
+    assert [file_fingerprint(row._asdict()) for row in rows] == \
+        [file_fingerprint(values) for values in expected]
@@ -0,0 +1,47 @@
+from filemeta_harvester.metrics.registry import STAGE_SECONDS, MetricsRegistry
+
+
+def test_render_counters_in_text_format():
+    registry = MetricsRegistry()
+    registry.inc("harvest_datasets_total", endpoint="easy", outcome="done")
+    registry.inc("harvest_datasets_total", 2, endpoint="easy", outcome="done")
+    registry.inc("harvest_datasets_total", endpoint='a "quoted"\nname', outcome="failed")
+
+    assert registry.render().splitlines() == [
+        "# HELP harvest_datasets_total Datasets processed, by outcome.",
+        "# TYPE harvest_datasets_total counter",
+        'harvest_datasets_total{endpoint="a \\"quoted\\"\\nname",outcome="failed"} 1',
+        'harvest_datasets_total{endpoint="easy",outcome="done"} 3',
+    ]
+
+
+def test_render_histograms_with_cumulative_buckets():
+    registry = MetricsRegistry(buckets=(0.1, 1.0))
+    registry.observe(STAGE_SECONDS, 0.05, endpoint="easy", stage="fetch")
+    registry.observe(STAGE_SECONDS, 0.5, endpoint="easy", stage="fetch")
+    registry.observe(STAGE_SECONDS, 3.0, endpoint="easy", stage="fetch")
+
+    lines = registry.render().splitlines()
+    labels = 'endpoint="easy",stage="fetch"'
+    assert lines[:2] == ["# HELP harvest_stage_seconds Time spent per harvest stage.",
+                         "# TYPE harvest_stage_seconds histogram"]
+    assert lines[2:] == [
+        f'harvest_stage_seconds_bucket{{{labels},le="0.1"}} 1',
+        f'harvest_stage_seconds_bucket{{{labels},le="1.0"}} 2',
+        f'harvest_stage_seconds_bucket{{{labels},le="+Inf"}} 3',
+        f"harvest_stage_seconds_sum{{{labels}}} 3.55",
+        f"harvest_stage_seconds_count{{{labels}}} 3",
+    ]
+
+
+def test_snapshot_of_one_endpoint():
+    registry = MetricsRegistry()
+    registry.inc("harvest_files_total", 5, endpoint="easy", change="inserted")
+    registry.inc("harvest_files_total", 7, endpoint="other", change="inserted")
+    with registry.timer("write", "easy"):
+        pass
+    registry.timed(lambda: None, "write", "easy")()
+
+    snapshot = registry.snapshot("easy")
+    assert snapshot["counters"] == {"harvest_files_total:inserted": 5}
+    assert snapshot["stages"]["write"]["count"] == 2
@@ -0,0 +1,77 @@
+from filemeta_harvester.oai.harvester import OAIHarvester, outermost_sets
+from filemeta_harvester.oai.parser import DAY_GRANULARITY, SECONDS_GRANULARITY
+
+
+def harvester(earliest="2020-01-01"):
+    # make_windows needs no connection to the endpoint
+    h = OAIHarvester.__new__(OAIHarvester)
+    h.capabilities = {"formats": ["oai_dc"], "granularity": DAY_GRANULARITY,
+                      "earliest_datestamp": earliest}
+    return h
+
+
+def test_single_window_covers_the_whole_range():
+    assert harvester().make_windows(from_date="2023-01-05") == [
+        {"window_id": "", "from_date": "2023-01-05", "until_date": None, "set_spec": None}]
+
+
+def test_slices_are_consecutive_and_open_ended():
+    windows = harvester().make_windows(from_date="2023-01-01", until_date="2023-01-10",
+                                       slices=3)
+
+    assert [(w["from_date"], w["until_date"]) for w in windows] == [
+        ("2023-01-01", "2023-01-03"), ("2023-01-04", "2023-01-06"), ("2023-01-07", "2023-01-10")]
+    assert len({w["window_id"] for w in windows}) == 3
+
+    open_ended = harvester().make_windows(from_date="2023-01-01", slices=2)
+    assert open_ended[0]["from_date"] == "2023-01-01"
+    assert open_ended[-1]["until_date"] is None
+
+
+def test_slices_start_at_the_earliest_datestamp():
+    windows = harvester(earliest="2023-01-01T08:00:00Z").make_windows(
+        until_date="2023-01-04", slices=2)
+
+    assert windows[0]["from_date"] == "2023-01-01"
+    assert windows[-1]["until_date"] == "2023-01-04"
+
+
+def test_slices_never_outnumber_days():
+    windows = harvester().make_windows(from_date="2023-01-01", until_date="2023-01-02", slices=5)
+
+    assert len(windows) == 2
+
+
+def test_seconds_granularity_bounds():
+    windows = harvester().make_windows(from_date="2023-01-01T06:00:00Z",
+                                       until_date="2023-01-04T00:00:00Z", slices=2,
+                                       granularity=SECONDS_GRANULARITY)
+
+    assert [(w["from_date"], w["until_date"]) for w in windows] == [
+        ("2023-01-01T06:00:00Z", "2023-01-02T23:59:59Z"),
+        ("2023-01-03T00:00:00Z", "2023-01-04T00:00:00Z"),
+    ]
+
+
+def test_windows_per_set():
+    windows = harvester().make_windows(from_date="2023-01-01", until_date="2023-01-04",
+                                       slices=2, sets=["a", "b"])
+
+    assert [(w["set_spec"], w["from_date"]) for w in windows] == [
+        ("a", "2023-01-01"), ("a", "2023-01-03"), ("b", "2023-01-01"), ("b", "2023-01-03")]
+    assert len({w["window_id"] for w in windows}) == 4
+
+
+def test_nested_sets_are_dropped():
+    windows = harvester().make_windows(from_date="2023-01-01", sets=["a:b", "a", "c", "a:b:c", "c"])
+
+    assert [w["set_spec"] for w in windows] == ["a", "c"]
+    assert outermost_sets(["x:y", "x:z"]) == ["x:y", "x:z"]
+    assert outermost_sets(["ab", "a"]) == ["ab", "a"]
+
+
+def test_unfiltered_lists_the_whole_repository_too():
+    windows = harvester().make_windows(from_date="2023-01-01", sets=["a"], unfiltered=True)
+
+    assert [w["set_spec"] for w in windows] == ["a", None]
+    assert len({w["window_id"] for w in windows}) == 2
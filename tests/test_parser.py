@@ -0,0 +1,86 @@
+import io
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from filemeta_harvester.oai.parser import (DAY_GRANULARITY, SECONDS_GRANULARITY, ListResponse,
+                                           OAIHeader, format_datestamp, normalize_datestamp)
+
+
+def page(items, token=None):
+    token = "" if token is None else token
+    return io.BytesIO(f"""<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+  <responseDate>2024-01-01T00:00:00Z</responseDate>
+  <request verb="ListIdentifiers">https://example.org/oai</request>
+  <ListIdentifiers>{items}{token}</ListIdentifiers>
+</OAI-PMH>""".encode())
+
+
+def header(identifier, datestamp, deleted=False):
+    status = ' status="deleted"' if deleted else ""
+    return (f"<header{status}><identifier>{identifier}</identifier>"
+            f"<datestamp>{datestamp}</datestamp><setSpec>a</setSpec></header>")
+
+
+def test_list_response_yields_headers_and_token():
+    response = ListResponse(page(
+        header("doi:10.1/a", "2023-07-01") + header("doi:10.1/b", "2023-07-02T10:00:00Z", True),
+        '<resumptionToken completeListSize="1200" cursor="0">tok|100</resumptionToken>'))
+
+    assert list(response) == [
+        OAIHeader("doi:10.1/a", "2023-07-01", False),
+        OAIHeader("doi:10.1/b", "2023-07-02T10:00:00Z", True),
+    ]
+    assert response.resumption_token == "tok|100"
+    assert response.complete_list_size == "1200"
+    assert response.error is None
+
+
+def test_list_response_empty_token_ends_the_list():
+    response = ListResponse(page(header("doi:10.1/a", "2023-07-01"),
+                                 '<resumptionToken completeListSize="1"/>'))
+
+    assert len(list(response)) == 1
+    assert response.resumption_token is None
+
+
+def test_list_response_reads_headers_of_records():
+    records = "".join(f"<record>{header(f'doi:10.1/{i}', '2023-07-01')}"
+                      f"<metadata><dc>title {i}</dc></metadata></record>" for i in range(3))
+
+    assert [h.identifier for h in ListResponse(page(records))] == [
+        "doi:10.1/0", "doi:10.1/1", "doi:10.1/2"]
+
+
+def test_list_response_reports_oai_errors():
+    response = ListResponse(io.BytesIO(b"""<?xml version="1.0"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+  <error code="noRecordsMatch">No records</error>
+</OAI-PMH>"""))
+
+    assert list(response) == []
+    assert response.error == ("noRecordsMatch", "No records")
+
+
+@pytest.mark.parametrize("datestamp, expected", [
+    ("2023-07-01", "2023-07-01T00:00:00Z"),
+    ("2023-07-01T12:34:56Z", "2023-07-01T12:34:56Z"),
+    ("2023-7-1", "2023-07-01T00:00:00Z"),
+])
+def test_normalize_datestamp(datestamp, expected):
+    assert normalize_datestamp(datestamp) == expected
+
+
+@pytest.mark.parametrize("datestamp", ["2023-13-01", "2023-02-30", "2023-07-01T25:00:00Z",
+                                       "01-07-2023", ""])
+def test_normalize_datestamp_rejects_invalid_values(datestamp):
+    with pytest.raises(ValueError):
+        normalize_datestamp(datestamp)
+
+
+def test_format_datestamp_uses_utc_and_granularity():
+    value = datetime(2023, 7, 1, 23, 30, tzinfo=timezone(timedelta(hours=-2)))
+
+    assert format_datestamp(value, SECONDS_GRANULARITY) == "2023-07-02T01:30:00Z"
+    assert format_datestamp(value, DAY_GRANULARITY) == "2023-07-02"
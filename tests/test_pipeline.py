@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+
+from filemeta_harvester.tasks.pipeline import StagedPipeline
+
+
+def run(items, fetch=lambda item: item * 10, transform=lambda item, fetched: fetched + 1,
+        **options):
+    batches = []
+    pipeline = StagedPipeline(fetch, transform, batches.append, **options)
+    pipeline.run(items)
+    return batches
+
+
+def test_every_item_is_written_once():
+    batches = run(range(100), fetch_workers=4, queue_size=5, batch_size=7)
+
+    written = sorted((item, result) for batch in batches for item, result, _ in batch)
+    assert written == [(i, i * 10 + 1) for i in range(100)]
+    assert all(len(batch) <= 7 for batch in batches)
+
+
+def test_fetch_and_transform_errors_reach_the_writer():
+    def fetch(item):
+        if item == 2:
+            raise ValueError("bad listing")
+        return item
+
+    def transform(item, fetched):
+        if item == 3:
+            raise KeyError("name")
+        return fetched
+
+    batches = run(range(5), fetch=fetch, transform=transform, fetch_workers=2)
+
+    results = {item: (result, error) for batch in batches for item, result, error in batch}
+    assert sorted(results) == [0, 1, 2, 3, 4]
+    assert isinstance(results[2][1], ValueError) and results[2][0] is None
+    assert isinstance(results[3][1], KeyError) and results[3][0] is None
+    assert results[4] == (4, None)
+
+
+def test_write_error_stops_the_pipeline_and_is_raised():
+    fetched = []
+    lock = threading.Lock()
+
+    def fetch(item):
+        with lock:
+            fetched.append(item)
+        return item
+
+    def write_batch(batch):
+        raise RuntimeError("database gone")
+
+    pipeline = StagedPipeline(fetch, lambda item, f: f, write_batch, fetch_workers=2,
+                              queue_size=2, batch_size=1)
+    with pytest.raises(RuntimeError, match="database gone"):
+        pipeline.run(range(10000))
+
+    # the bounded queues stop the stages long before the input is consumed
+    assert len(fetched) < 100
+
+
+def test_input_error_stops_the_pipeline_and_is_raised():
+    def items():
+        yield 1
+        yield 2
+        raise OSError("listing interrupted")
+
+    with pytest.raises(OSError, match="listing interrupted"):
+        run(items())
+
+
+def test_partial_batch_is_flushed_after_the_interval():
+    release = threading.Event()
+    batches = []
+
+    def items():
+        yield 1
+        # the second item only arrives after the first was flushed
+        release.wait(5)
+        yield 2
+
+    def write_batch(batch):
+        batches.append([item for item, _, _ in batch])
+        release.set()
+
+    pipeline = StagedPipeline(lambda item: item, lambda item, f: f, write_batch,
+                              batch_size=50, flush_interval=0.2)
+    pipeline.run(items())
+
+    assert batches == [[1], [2]]
@@ -0,0 +1,51 @@
+import pytest
+
+from filemeta_harvester.db import rawblobs
+from filemeta_harvester.db.rawblobs import RawBlobStore, encode_payload
+
+PAYLOAD = {"files": [{"name": f"file {i}.csv", "size": i, "note": "ünïcode"} for i in range(50)]}
+CODECS = ["zlib"] + (["zstd"] if rawblobs.zstandard is not None else [])
+
+
+def store(codec, dictionary=None):
+    blobs = RawBlobStore(engine=None, codec=codec)
+    if dictionary is not None:
+        # as if loaded from raw_metadata_dicts
+        blobs._dicts[1] = dictionary
+    return blobs
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_round_trip_without_dictionary(codec):
+    blobs = store(codec)
+    payload = encode_payload(PAYLOAD)
+
+    data = blobs.compress(payload)
+
+    assert len(data) < len(payload)
+    assert blobs.decompress(codec, None, data) == payload
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_round_trip_with_dictionary(codec):
+    dictionary = encode_payload(PAYLOAD)[-4096:]
+    blobs = store(codec, dictionary)
+    payload = encode_payload(PAYLOAD)
+
+    data = blobs.compress(payload, 1)
+
+    assert blobs.decompress(codec, 1, data) == payload
+    assert len(data) <= len(blobs.compress(payload))
+
+
+def test_zlib_blobs_stay_readable_by_a_zstd_store():
+    if rawblobs.zstandard is None:
+        pytest.skip("zstandard not installed")
+    payload = encode_payload(PAYLOAD)
+    data = store("zlib").compress(payload)
+
+    assert store("zstd").decompress("zlib", None, data) == payload
+
+
+def test_encode_payload_is_compact_utf8():
+    assert encode_payload({"a": [1, "é"]}) == '{"a":[1,"é"]}'.encode()
@@ -0,0 +1,54 @@
+from filemeta_harvester.db import recordcache
+from filemeta_harvester.db.recordcache import RecordCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = RecordCache(max_entries=2)
+    cache.put_many({"a": 1, "b": 2})
+    assert cache.get_many(["a"]) == {"a": 1}
+
+    cache.put_many({"c": 3})
+
+    assert cache.get_many(["a", "b", "c"]) == {"a": 1, "c": 3}
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_entries_expire_after_max_age(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(recordcache, "monotonic", clock)
+    cache = RecordCache(max_age=10)
+    cache.put_many({"a": 1})
+
+    clock.now += 9
+    assert cache.get_many(["a"]) == {"a": 1}
+    clock.now += 2
+    assert cache.get_many(["a"]) == {}
+
+
+def test_invalidate_drops_entries_and_stale_loads():
+    cache = RecordCache()
+    cache.put_many({"a": 1, "b": 2})
+    version = cache.version()
+
+    cache.invalidate(["a"])
+    # loaded before the invalidation: not cached
+    cache.put_many({"a": 10}, version=version)
+
+    assert cache.get_many(["a", "b"]) == {"b": 2}
+    cache.put_many({"a": 11}, version=cache.version())
+    assert cache.get_many(["a"]) == {"a": 11}
+
+
+def test_clear():
+    cache = RecordCache()
+    cache.put_many({"a": 1})
+    cache.clear()
+    assert cache.get_many(["a"]) == {}
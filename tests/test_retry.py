@@ -0,0 +1,111 @@
+import pytest
+import requests
+
+from filemeta_harvester.fetch import retry
+from filemeta_harvester.fetch.retry import CircuitBreaker, CircuitOpenError
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(retry, "monotonic", clock)
+    return clock
+
+
+def http_error(status, url="https://files.example.org/api/datasets/1"):
+    response = requests.Response()
+    response.status_code = status
+    response.url = url
+    return requests.HTTPError(f"{status} Error", response=response)
+
+
+def open_breaker(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=60)
+    breaker.record_failure("ep", "files.example.org")
+    assert breaker.is_open("ep")
+    clock.now += 61
+    return breaker
+
+
+def test_half_open_trial_answered_with_404_closes_circuit(clock):
+    breaker = open_breaker(clock)
+
+    with pytest.raises(requests.HTTPError):
+        with breaker.guard("ep"):
+            raise http_error(404)
+
+    assert not breaker.is_open("ep")
+    with breaker.guard("ep"):
+        pass
+
+
+def test_half_open_trial_with_transient_failure_reopens_circuit(clock):
+    breaker = open_breaker(clock)
+
+    with pytest.raises(requests.HTTPError):
+        with breaker.guard("ep"):
+            raise http_error(503)
+
+    assert breaker.is_open("ep")
+    clock.now += 61
+    assert not breaker.is_open("ep")
+
+
+def test_half_open_trial_without_answer_reopens_circuit(clock):
+    breaker = open_breaker(clock)
+
+    with pytest.raises(ValueError):
+        with breaker.guard("ep"):
+            raise ValueError("unreadable listing")
+
+    with pytest.raises(CircuitOpenError):
+        breaker.check("ep")
+    clock.now += 61
+    assert not breaker.is_open("ep")
+
+
+def test_only_one_trial_call_while_half_open(clock):
+    breaker = open_breaker(clock)
+
+    with breaker.guard("ep"):
+        with pytest.raises(CircuitOpenError):
+            breaker.check("ep")
+
+    assert not breaker.is_open("ep")
+
+
+def test_success_resets_only_the_answering_host(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=60)
+    breaker.record_failure("ep", "a.example.org")
+    breaker.record_failure("ep", "b.example.org")
+
+    with breaker.guard("ep") as answered:
+        answered.add("a.example.org")
+    breaker.record_failure("ep", "a.example.org")
+    assert not breaker.is_open("ep")
+
+    breaker.record_failure("ep", "b.example.org")
+    assert breaker.is_open("ep")
+
+
+def test_non_retryable_answer_resets_its_host(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=60)
+    breaker.record_failure("ep", "files.example.org")
+    breaker.record_failure("ep", "other.example.org")
+
+    with pytest.raises(requests.HTTPError):
+        with breaker.guard("ep"):
+            raise http_error(404)
+    breaker.record_failure("ep", "files.example.org")
+    assert not breaker.is_open("ep")
+
+    breaker.record_failure("ep", "other.example.org")
+    assert breaker.is_open("ep")
@@ -0,0 +1,124 @@
+import threading
+import time
+
+from filemeta_harvester.config import SchedulerConfig
+from filemeta_harvester.flows.scheduler import INTERVAL_GROWTH, HarvestScheduler
+
+
+def endpoint(id, host="oai.example.org", **settings):
+    return {"id": id, "name": id, "oai_url": f"https://{host}/oai", **settings}
+
+
+def config(**settings):
+    return SchedulerConfig(**{"workers": 4, "max_per_host": 1, "min_interval": 10,
+                              "max_interval": 1000, "jitter": 0.0, **settings})
+
+
+class Harvests:
+    """Fake harvest callable recording how many harvests overlap."""
+
+    def __init__(self, duration=0.05, changed=0):
+        self.duration = duration
+        self.changed = changed
+        self.lock = threading.Lock()
+        self.started = []
+        self.active = 0
+        self.max_active = 0
+
+    def __call__(self, schedule):
+        with self.lock:
+            self.started.append(schedule.endpoint["id"])
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.duration)
+        with self.lock:
+            self.active -= 1
+        if isinstance(self.changed, Exception):
+            raise self.changed
+        return self.changed
+
+
+def test_once_harvests_every_endpoint_a_single_time():
+    harvests = Harvests()
+    endpoints = [endpoint("a", "one.org"), endpoint("b", "two.org"), endpoint("c", "three.org")]
+
+    HarvestScheduler(endpoints, config(), harvests).run(once=True)
+
+    assert sorted(harvests.started) == ["a", "b", "c"]
+    assert harvests.max_active > 1
+
+
+def test_harvests_per_host_are_capped():
+    harvests = Harvests()
+    endpoints = [endpoint(id) for id in "abc"]
+
+    HarvestScheduler(endpoints, config(max_per_host=1), harvests).run(once=True)
+
+    assert sorted(harvests.started) == ["a", "b", "c"]
+    assert harvests.max_active == 1
+
+
+def test_higher_priority_starts_first():
+    harvests = Harvests(duration=0)
+    endpoints = [endpoint("low", priority=0), endpoint("high", priority=5)]
+
+    HarvestScheduler(endpoints, config(), harvests).run(once=True)
+
+    assert harvests.started == ["high", "low"]
+
+
+def test_interval_adapts_to_changes():
+    endpoints = [endpoint("a", poll_interval=100)]
+
+    changed = HarvestScheduler(endpoints, config(), Harvests(duration=0, changed=3))
+    changed.run(once=True)
+    unchanged = HarvestScheduler(endpoints, config(), Harvests(duration=0, changed=0))
+    unchanged.run(once=True)
+    failed = HarvestScheduler(endpoints, config(), Harvests(duration=0,
+                                                           changed=RuntimeError("down")))
+    failed.run(once=True)
+
+    assert changed.schedules[0].interval == 50
+    assert unchanged.schedules[0].interval == 100 * INTERVAL_GROWTH
+    assert failed.schedules[0].interval == 200
+    assert failed.schedules[0].checked is False
+
+
+def test_interval_stays_within_bounds():
+    endpoints = [endpoint("a", poll_interval=12)]
+
+    scheduler = HarvestScheduler(endpoints, config(), Harvests(duration=0, changed=1))
+    scheduler.run(once=True)
+
+    assert scheduler.schedules[0].interval == 10
+
+
+def test_stop_returns_after_running_harvests():
+    harvests = Harvests(duration=0.2)
+    scheduler = HarvestScheduler([endpoint("a")], config(), harvests)
+    thread = threading.Thread(target=scheduler.run)
+    thread.start()
+    time.sleep(0.1)
+
+    scheduler.stop()
+    thread.join(5)
+
+    assert not thread.is_alive()
+    assert harvests.started == ["a"]
+    assert scheduler.schedules[0].runs == 1
+
+
+def test_waiting_for_a_busy_host_does_not_spin():
+    harvests = Harvests(duration=0.3)
+    scheduler = HarvestScheduler([endpoint("a"), endpoint("b")], config(max_per_host=1),
+                                 harvests)
+    sleeps = []
+    sleep_time = scheduler._sleep_time
+    scheduler._sleep_time = lambda once: sleeps.append(sleep_time(once)) or sleeps[-1]
+
+    scheduler.run(once=True)
+
+    assert sorted(harvests.started) == ["a", "b"]
+    # one wait per finished harvest, not a loop while "b" is due but blocked
+    assert len(sleeps) <= 3
+    assert all(sleep > 0 for sleep in sleeps)